@@ -18,6 +18,7 @@ from mango.template_utils.utils import configure_templates
 SESSION_SECRET_KEY = os.environ.get('SESSION_SECRET_KEY')
 DATABASE_NAME = os.environ.get('DATABASE_NAME')
 TEMPLATE_DIRECTORY = os.environ.get('TEMPLATE_DIRECTORY')
+LOAD_USER_CACHE_TTL = float(os.environ.get('LOAD_USER_CACHE_TTL', 30))
 templates = configure_templates(directory=TEMPLATE_DIRECTORY)
 
 manager = LoginManager(
@@ -142,6 +143,7 @@ def load_user(email:str, database):
       },
     ],
     cursor={},
+    cache_ttl=LOAD_USER_CACHE_TTL,
   )
   role_list_result = run_pipeline_sync(ap)
   if any(role_list_result['cursor']['firstBatch']):
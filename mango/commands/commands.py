@@ -4,9 +4,14 @@ load_dotenv()
 import click
 import os
 import requests
+import statistics
+import time
 from csv import DictReader
 from mango.db import api
 from mango.db import models
+from mango.db import rest
+from mango.db.cache import query_cache
+from mango.db.single_flight import single_flight
 
 __author__ = "Matt Duffield"
 
@@ -438,6 +443,68 @@ async def bulk_insert_products(file_name: str, database: str, collection: str):
 
   await api.bulk_write(batch)
 
+@main.command()
+@coro
+@click.argument('database')
+@click.argument('collection')
+@click.option('--concurrency', default=50, help='Number of requests issued at the same time.')
+@click.option('--rounds', default=5, help='Number of concurrent bursts per backend.')
+@click.option('--limit', default=100, help='Documents returned by each find.')
+async def benchmark_concurrent_reads(database: str, collection: str, concurrency: int, rounds: int, limit: int):
+  """This compares concurrent find latency on the blocking and the async backend"""
+  query = models.Query(database=database, collection=collection, limit=limit)
+
+  async def blocking_find(q: models.Query):
+    # what the async handlers did before: a synchronous MongoClient call on the event loop
+    return rest.find_sync(q)
+
+  async def timed(fn, q: models.Query):
+    started = time.perf_counter()
+    await fn(q)
+    return time.perf_counter() - started
+
+  backends = [
+    ('before (MongoClient)', blocking_find),
+    ('after (Motor)', rest.find),
+  ]
+  # every request goes to the database: identical finds would otherwise be
+  # merged by single flight or served by the query cache
+  single_flight_enabled = single_flight.enabled
+  cached = query_cache.is_enabled(collection)
+  single_flight.enabled = False
+  query_cache.disable(collection)
+  try:
+    for label, fn in backends:
+      # warm up the pool so connection setup is not measured
+      await fn(query.copy(deep=True))
+      latencies = []
+      started = time.perf_counter()
+      for _ in range(rounds):
+        burst = [timed(fn, query.copy(deep=True)) for _ in range(concurrency)]
+        latencies.extend(await asyncio.gather(*burst))
+      elapsed = time.perf_counter() - started
+      latencies.sort()
+      p50 = statistics.median(latencies) * 1000
+      p95 = latencies[int(len(latencies) * 0.95) - 1] * 1000
+      worst = latencies[-1] * 1000
+      click.echo(f'{label}: requests={len(latencies)} p50={p50:.1f}ms p95={p95:.1f}ms max={worst:.1f}ms throughput={len(latencies) / elapsed:.1f}/s')
+  finally:
+    single_flight.enabled = single_flight_enabled
+    if cached:
+      query_cache.enable(collection)
+
+@main.command()
+@click.option('--database', default='', help='Database to sync, DATABASE_NAME by default.')
+@click.option('--dry-run', is_flag=True, help='Only report drift, do not create indexes.')
+def sync_indexes(database: str, dry_run: bool):
+  """This creates the indexes the models declare and reports drift"""
+  from mango.core.indexes import sync_indexes as sync
+  report = sync(database, create=not dry_run)
+  for entry in report['indexes']:
+    click.echo(f"{entry['status']}: {entry['collection']}.{entry['name']} ({entry['source']})")
+  for entry in report['undeclared']:
+    click.echo(f"undeclared: {entry['collection']}.{entry['name']}")
+
 @main.command()
 @click.argument('app_name')
 def start_app(app_name: str):
@@ -2,12 +2,14 @@ import os
 import importlib
 from importlib.abc import Loader as _Loader, MetaPathFinder as _MetaPathFinder
 import sys
+from mango.core.metadata import get_snapshot, refresh_snapshot, register_loader
 from mango.core.models import App
 from mango.db.models import Query
 from mango.db.api import find_sync
 
 DATABASE_NAME = os.environ.get('DATABASE_NAME')
 PATH = sys.path[0]
+METADATA_LOADER = 'apps'
 
 host = None
 templates = None
@@ -23,18 +25,20 @@ def get_apps():
   global registered_apps
   return registered_apps
 
-def get_registered_apps():
-  global registered_apps
-  registered_apps = []
+def load_apps(database: str = None):
   query = Query(
-    database=DATABASE_NAME,
+    database=database or DATABASE_NAME,
     collection='apps',
     query_type='find',
     query={'is_active': True},
   )
-  result = find_sync(query)
-  for item in result:
-    registered_apps.append(App(**item))
+  return [App(**item) for item in find_sync(query)]
+
+register_loader(METADATA_LOADER, load_apps, lambda x: x.name)
+
+def get_registered_apps():
+  global registered_apps
+  registered_apps = load_apps()
 
 def get_registered_app(name):
   global registered_apps
@@ -53,9 +57,11 @@ def compile_code(module, code, global_dict = {}):
   return module
 
 def import_apps():
-  get_registered_apps()
-  apps = get_apps()
-  for item in apps:
+  global registered_apps
+  # one metadata snapshot for the whole pass, reloaded only if its version moved
+  snapshot = refresh_snapshot(METADATA_LOADER)
+  registered_apps = list(snapshot.items)
+  for item in snapshot.items:
     importlib.import_module(f'{item.name}__c')
     # script = f'import {name}'
     # exec(script, globals(), locals())
@@ -67,13 +73,11 @@ class CodeLoader(_Loader):
       return None
 
   def exec_module(self, module):
-    # force reload of registered apps
-    get_registered_apps()
     # get templates
     forms_j2, models_j2, views_j2, registration_j2 = load_templates()
-    # get registered app
+    # get registered app from the current metadata snapshot
     name = module.__name__.replace('__c', '')
-    ra = get_registered_app(name)
+    ra = get_snapshot(METADATA_LOADER).get(name)
     if ra is None:
       return
     forms_tmpl = forms_j2.render(ra = ra)
@@ -2,20 +2,25 @@ import os
 import importlib
 from importlib.abc import Loader as _Loader, MetaPathFinder as _MetaPathFinder
 import sys
+import time
 from pydantic import BaseModel
 from typing import List
+from mango.core.metadata import get_snapshot, refresh_snapshot, register_loader
 from mango.core.models import App, Model, ModelField
+from mango.db.decoder import register_schema
 from mango.db.models import Query, QueryOne
-from mango.db.rest import find_sync, bulk_read_sync
+from mango.db.rest import find_sync
 
 DATABASE_NAME = os.environ.get('DATABASE_NAME')
 PATH = sys.path[0]
+METADATA_LOADER = 'registered_apps'
 
 host = None
 templates = None
 registered_apps = []
 model_list = []
 model_field_list = []
+load_stats = {}
 
 
 class RegisteredApp(BaseModel):
@@ -33,65 +38,62 @@ def get_apps():
   global registered_apps
   return registered_apps
 
-def get_registered_apps():
-  global registered_apps
-  registered_apps = []
-  global model_list
-  global model_field_list
-  model_list = []
-  model_field_list = []
+def load_metadata(database: str = None):
+  '''
+    The active custom models and their active fields as RegisteredApps, in
+    two queries however many models there are: the models, then the fields
+    of all of them with one $in query, grouped by model_name in memory.
+  '''
+  started = time.perf_counter()
+  database = database or DATABASE_NAME
   model_query = Query(
-    database=DATABASE_NAME,
+    database=database,
     collection='model',
     query_type='find',
     query={'is_custom': True, 'is_active': True},
   )
-  model_result = find_sync(query=model_query)
-  for item in model_result:
-    model_list.append(Model(**item))
-  for model in model_list:
+  models = [Model(**item) for item in find_sync(query=model_query)]
+  fields = {model.name: [] for model in models}
+  if models:
     model_field_query = Query(
-      database=DATABASE_NAME,
+      database=database,
       collection='model_field',
       query_type='find',
-      query={'model_name': model.name, 'is_active': True},
+      query={'model_name': {'$in': list(fields)}, 'is_active': True},
     )
-    model_field_list = []
-    model_field_result = find_sync(model_field_query)
-    for model_field in model_field_result:
-      model_field_list.append(ModelField(**model_field))
-    registered_apps.append(RegisteredApp(model=model, fields=model_field_list))
+    for item in find_sync(query=model_field_query):
+      model_field = ModelField(**item)
+      if model_field.model_name in fields:
+        fields[model_field.model_name].append(model_field)
+  apps = [RegisteredApp(model=model, fields=fields[model.name]) for model in models]
+  load_stats.update(
+    models=len(models),
+    fields=sum(len(x) for x in fields.values()),
+    queries=2 if models else 1,
+    load_ms=(time.perf_counter() - started) * 1000,
+  )
+  return apps
 
-def get_batch_registered_apps():
+register_loader(METADATA_LOADER, load_metadata, lambda x: x.model.name)
+
+def get_load_stats():
+  return dict(load_stats)
+
+def apply_apps(apps: list):
   global registered_apps
-  registered_apps = []
   global model_list
   global model_field_list
-  model_list = []
-  model_field_list = []
-  model_query = Query(
-    database=DATABASE_NAME,
-    collection='model',
-    query_type='find',
-    query={'is_custom': True, 'is_active': True},
-  )
-  model_result = find_sync(query=model_query)
-  for item in model_result:
-    model_list.append(Model(**item))
-  batch = []
-  for item in model_list:
-    batch.append(
-      Query(
-        database=DATABASE_NAME,
-        collection='model_field',
-        query_type='find',
-        query={'model_name': item.name, 'is_active': True},
-      )
-    )    
-  [model_field_result] = bulk_read_sync(batch)
-  for item in model_field_result:
-    model_field_list.append(ModelField(**item))
+  registered_apps = list(apps)
+  model_list = [x.model for x in registered_apps]
+  model_field_list = [field for x in registered_apps for field in x.fields]
+  for ra in registered_apps:
+    register_schema(ra.model.name, ra.fields)
 
+def get_registered_apps():
+  apply_apps(load_metadata())
+
+def get_batch_registered_apps():
+  get_registered_apps()
   print('finished loading apps...')
 
 def get_registered_app(name):
@@ -113,9 +115,11 @@ def compile_code(module, code, global_dict = {}):
   return module
 
 def import_apps():
-  get_registered_apps()
-  apps = get_apps()
-  for item in apps:
+  # one metadata snapshot for the whole pass, reloaded only if its version moved
+  snapshot = refresh_snapshot(METADATA_LOADER)
+  apply_apps(snapshot.items)
+  print(f"metadata version {snapshot.version}: {len(snapshot.items)} apps loaded in {snapshot.load_ms:.0f} ms")
+  for item in snapshot.items:
     importlib.import_module(f'{item.model.name}__c')
 
 
@@ -125,13 +129,11 @@ class CodeLoader(_Loader):
       return None
 
   def exec_module(self, module):
-    # force reload of registered apps
-    get_registered_apps()
     # get templates
     forms_j2, models_j2, views_j2, registration_j2 = load_templates()
-    # get registered app
+    # get registered app from the current metadata snapshot
     name = module.__name__.replace('__c', '')
-    ra = get_registered_app(name)
+    ra = get_snapshot(METADATA_LOADER).get(name)
     if ra is None:
       return
     # forms_tmpl = forms_j2.render(ra = ra)
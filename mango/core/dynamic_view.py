@@ -17,9 +17,11 @@ from mango.auth.auth import can, can_can
 from mango.core.models import Action, Role, Model, ModelRecordType, ModelField, PageLayout, ListLayout, Tab, App, Lookup
 from mango.core.fields import LookupSelectField, PicklistSelectField, QuerySelectField, QuerySelectMultipleField, StringField2, FloatField2
 from mango.core.forms import get_string_form, ActionForm, RoleForm, ModelForm, ModelRecordTypeForm, ModelFieldForm, PageLayoutForm, ListLayoutForm, TabForm, AppForm, KeyValueForm, LookupForm
+from mango.core.list_page import ListPageMixin
 from mango.db.models import DateTimeAwareEncoder, datetime_parser, json_from_mongo, Query, QueryOne, Count, InsertOne, InsertMany, Update, UpdateOne, UpdateMany, Delete, DeleteOne, DeleteMany, BulkWrite, AggregatePipeline
 # from mango.db.api import find, find_one, run_pipeline, delete, delete_one, update_one, insert_one
 from mango.db.rest import find, find_one, run_pipeline, delete, delete_one, update_one, insert_one
+from mango.db.routing import pin_primary_reads, SECONDARY_READ_PREFERENCE
 from mango.template_utils.utils import configure_templates
 
 DATABASE_NAME = os.environ.get('DATABASE_NAME')
@@ -120,7 +122,7 @@ async def get_new_table_row(request: Request, form_name: str, prefix: str = '',
   return response
 
 
-class BaseDynamicView():
+class BaseDynamicView(ListPageMixin):
   '''
     It depends on a model class and its meta class to provide all the necessary 
     information required for loading data for create, update, or delete.
@@ -415,6 +417,8 @@ class BaseDynamicView():
 
     data_string = ''
 
+    self.list_layout = await self.get_list_layout(get_type)
+
     if get_type in ['get_create']:
       data = self.model_class.new_dict()
     else:
@@ -422,7 +426,6 @@ class BaseDynamicView():
 
     self.organization = await self.get_default_organization()
     self.page_designer = await self.get_page_designer(get_type)
-    self.list_layout = await self.get_list_layout(get_type)
 
     if get_type in ['get_update', 'get_delete']:
       model_data = self.model_class(**data)
@@ -500,7 +503,7 @@ class BaseDynamicView():
           for item in self.model_data.order_by:
             sort[item] = 1
           query.sort = sort      
-      data = await find(query)
+      data = await self.find_page(query)
     elif get_type in ['get_list_related']:
       query = self.related_query
       if self.model_data:
@@ -509,7 +512,19 @@ class BaseDynamicView():
           for item in self.model_data.order_by:
             sort[item] = 1
           query.sort = sort      
+      data = await self.find_page(query)
+    return data
+
+  async def find_page(self, query: Query):
+    query.projection = self.get_list_projection()
+    query.default_read_preference = SECONDARY_READ_PREFERENCE
+    page_size = self.get_page_size(self.model_data)
+    if page_size:
+      self.apply_page(query, page_size)
+      data = self.set_page(await find(query))
+    else:
       data = await find(query)
+    await self.record_projection(query, data)
     return data
 
   def get_query(self, query_type: str, collection: str, query: dict = {}, sort: dict = {}, data: dict = None):
@@ -583,11 +598,13 @@ class BaseDynamicView():
       database=DATABASE_NAME,
       aggregate=self.model_class.Meta.name,
       pipeline=pipeline_list,
-      cursor={}
+      cursor={},
+      default_read_preference=SECONDARY_READ_PREFERENCE,
     )
     return pipeline
 
   async def post(self, request: Request, post_type: str, model: str, _id: str = '', is_modal: bool = False, user = None):
+    pin_primary_reads()  # read-after-write: the rest of this request reads from the primary
     self.request = request
     self.model_name = model
     self.model_class = self.get_model_class(model)
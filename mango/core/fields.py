@@ -34,6 +34,7 @@ from wtforms_components import ColorField
 from wtforms.utils import unset_value
 from mango.db.rest import find, find_one, run_pipeline, find_sync, find_one_sync
 from mango.db.models import Query, QueryOne
+from mango.db.routing import SECONDARY_READ_PREFERENCE
 from mango.core.constants import label_class, input_class, textarea_class, chk_class, select_class, select_multiple_class, toggle_radio_class, toggle_switch_class
 from mango.core.widgets import CodeMirrorWidget, DatalistWidget, FileUploadWidget, ToggleRadioWidget, ToggleSwitchWidget, CurrencyWidget, CurrencyDecimalWidget, TomSelectWidget
 
@@ -368,7 +369,8 @@ class LookupSelectField(SelectField):
       collection=collection,
       query=query.copy(),
       projection=projection,
-      sort=sort
+      sort=sort,
+      default_read_preference=SECONDARY_READ_PREFERENCE,
     )
     self.projection = projection
     self.sort = sort
@@ -473,7 +475,8 @@ class QuerySelectField(SelectField):
       collection=collection,
       query=query.copy(),
       projection=projection,
-      sort=sort
+      sort=sort,
+      default_read_preference=SECONDARY_READ_PREFERENCE,
     )
     self.projection = projection
     self.sort = sort
@@ -535,7 +538,8 @@ class QuerySelectMultipleField(SelectMultipleField):
       collection=collection,
       query=query.copy(),
       projection=projection,
-      sort=sort
+      sort=sort,
+      default_read_preference=SECONDARY_READ_PREFERENCE,
     )
     self.projection = projection
     self.sort = sort
@@ -0,0 +1,199 @@
+'''
+  Indexes
+
+  Declarative index specs for models, and a sync step that makes the database
+  match them.
+
+  A model's indexes are derived from what its views query:
+    order_by     - the list sort, e.g. ['label'] -> label_1
+    foreign key  - every `*_id` field, followed by the sort, which serves the
+                   related lists build_related_query filters by {model}_id
+    explicit     - Meta.indexes on code models, Model.index_list on dynamic
+                   ones: a list of field-name lists, '-' for descending,
+                   e.g. [['customer_id', '-created_at']]
+  A spec that is a prefix of another spec on the same collection is dropped.
+  ListLayout adds no specs: a list layout only picks the columns, and every
+  list, whichever layout it renders, sorts by its model's order_by.
+
+  The registered apps come from dynamic_loader's metadata snapshot
+  (mango.core.metadata), loaded on first use, so the startup sync sees the
+  dynamic models before import_apps has run. Apps that do not use
+  dynamic_loader have no registered apps to index.
+
+  sync_indexes() compares the specs with index_information() and reports
+  every spec as exists, missing or created, plus the undeclared indexes found
+  on those collections. start_index_sync() runs it on a background thread;
+  `mango sync-indexes` runs it from the command line.
+
+  Settings (environment):
+    INDEX_SYNC  report: only report drift (default), create: create missing
+                indexes, off: skip the startup sync
+'''
+import os
+import threading
+from typing import List
+from pydantic import BaseModel
+from pymongo.errors import PyMongoError
+from mango.core import models as core_models
+from mango.core.models import Model
+from mango.db.index_advisor import covers
+from mango.db.pool import get_client
+
+DATABASE_NAME = os.environ.get('DATABASE_NAME')
+INDEX_SYNC = os.environ.get('INDEX_SYNC', 'report').lower()
+
+
+class IndexSpec(BaseModel):
+  collection: str
+  key: List[tuple]
+  source: str  # order_by, foreign_key or explicit
+
+  @property
+  def name(self):
+    return '_'.join(f'{field}_{direction}' for field, direction in self.key)
+
+
+def parse_key(fields: List[str]):
+  key = []
+  for field in fields:
+    if field.startswith('-'):
+      key.append((field[1:], -1))
+    elif field:
+      key.append((field, 1))
+  return key
+
+def model_specs(collection: str, order_by: List[str], field_names: List[str], explicit: List[List[str]] = []):
+  sort = parse_key(order_by or [])
+  specs = []
+  if sort:
+    specs.append(IndexSpec(collection=collection, key=sort, source='order_by'))
+  for name in field_names:
+    if name.endswith('_id') and name != '_id':
+      key = [(name, 1)] + [x for x in sort if x[0] != name]
+      specs.append(IndexSpec(collection=collection, key=key, source='foreign_key'))
+  for fields in explicit or []:
+    key = parse_key(fields)
+    if key:
+      specs.append(IndexSpec(collection=collection, key=key, source='explicit'))
+  return specs
+
+def class_specs(model_class):
+  '''
+    Specs for a code model: a pydantic class with a Meta.
+  '''
+  meta = model_class.Meta
+  return model_specs(meta.name, getattr(meta, 'order_by', []), list(model_class.__fields__), getattr(meta, 'indexes', []))
+
+def dynamic_specs(model: Model, fields: list):
+  '''
+    Specs for a registered app: its Model and ModelField definitions.
+  '''
+  return model_specs(model.name, model.order_by, [x.name for x in fields], model.index_list)
+
+def core_model_classes():
+  return [
+    x for x in vars(core_models).values()
+    if isinstance(x, type) and issubclass(x, BaseModel) and hasattr(x, 'Meta') and hasattr(x.Meta, 'name')
+  ]
+
+def merge_specs(specs: List[IndexSpec]):
+  '''
+    Drops duplicate specs and specs another spec on the collection starts with.
+  '''
+  specs = sorted(specs, key=lambda x: len(x.key), reverse=True)
+  merged = []
+  for spec in specs:
+    if any(x.collection == spec.collection and covers(x.key, tuple(spec.key), 0) for x in merged):
+      continue
+    merged.append(spec)
+  merged.sort(key=lambda x: (x.collection, x.name))
+  return merged
+
+def collect_specs(model_classes: list = None, registered_apps: list = None, database: str = ''):
+  '''
+    Specs for the code models (the core models by default) and the
+    registered apps (dynamic_loader's metadata snapshot by default).
+  '''
+  if model_classes is None:
+    model_classes = core_model_classes()
+  if registered_apps is None:
+    from mango.core.metadata import get_snapshot, metadata_store
+    registered_apps = []
+    if 'registered_apps' in metadata_store.loaders:
+      registered_apps = get_snapshot('registered_apps', database or DATABASE_NAME).items
+  specs = []
+  for model_class in model_classes:
+    specs += class_specs(model_class)
+  for ra in registered_apps:
+    specs += dynamic_specs(ra.model, ra.fields)
+  return merge_specs(specs)
+
+def sync_indexes(database: str = '', specs: List[IndexSpec] = None, create: bool = True):
+  '''
+    Creates the missing indexes (unless create is False) and reports drift:
+      indexes    - one entry per spec with status exists/missing/created/failed
+      undeclared - indexes on those collections no spec asks for
+  '''
+  db = get_client()[database or DATABASE_NAME]
+  if specs is None:
+    specs = collect_specs(database=db.name)
+  report = {'database': db.name, 'indexes': [], 'undeclared': []}
+  by_collection = {}
+  for spec in specs:
+    by_collection.setdefault(spec.collection, []).append(spec)
+  for collection, collection_specs in by_collection.items():
+    entity = db[collection]
+    try:
+      existing = entity.index_information()
+    except PyMongoError:
+      existing = {}
+    for spec in collection_specs:
+      entry = {'collection': collection, 'name': spec.name, 'key': spec.key, 'source': spec.source}
+      index = next((name for name, info in existing.items() if covers(info['key'], tuple(spec.key), 0)), None)
+      if index:
+        entry.update(status='exists', index=index)
+      elif not create:
+        entry.update(status='missing')
+      else:
+        try:
+          entry.update(status='created', index=entity.create_index(spec.key))
+        except PyMongoError as e:
+          entry.update(status='failed', error=str(e))
+      report['indexes'].append(entry)
+    for name, info in existing.items():
+      if name == '_id_':
+        continue
+      if not any(covers(info['key'], tuple(x.key), 0) for x in collection_specs):
+        report['undeclared'].append({'collection': collection, 'name': name, 'key': info['key']})
+  return report
+
+
+class IndexSync():
+  '''
+    Runs sync_indexes on a background thread and keeps the last report.
+  '''
+  def __init__(self):
+    self.report = None
+    self.error = None
+    self.thread = None
+
+  def run(self, database: str = '', create: bool = True):
+    try:
+      self.report = sync_indexes(database, create=create)
+      self.error = None
+    except PyMongoError as e:
+      self.error = str(e)
+    return self.report
+
+  def start(self, database: str = '', mode: str = INDEX_SYNC):
+    if mode == 'off' or (self.thread and self.thread.is_alive()):
+      return self.thread
+    self.thread = threading.Thread(target=self.run, args=(database, mode == 'create'), name='index-sync', daemon=True)
+    self.thread.start()
+    return self.thread
+
+
+index_sync = IndexSync()
+
+def start_index_sync(database: str = ''):
+  return index_sync.start(database)
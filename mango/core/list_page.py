@@ -0,0 +1,68 @@
+'''
+  List Page
+
+  The list view helpers BaseView (mango.core.views) and BaseDynamicView
+  (mango.core.dynamic_view) share: the list projection, keyset paging from the
+  `after` / `before` query parameters and the projection savings of a page.
+
+  A cursor that does not decode against the list's current sort (hand edited,
+  or left over from before the model's order_by changed) is dropped and the
+  first page is served instead.
+'''
+import os
+from mango.core.models import Model
+from mango.db.models import Query
+from mango.db.pagination import decode_cursor
+from mango.db.pool import get_async_client
+from mango.db.projection import build_projection, projection_stats
+
+DATABASE_NAME = os.environ.get('DATABASE_NAME')
+
+
+class ListPageMixin():
+  next_cursor = None
+  previous_cursor = None
+  list_layout = None
+  list_fields = []  # fields the list templates need beyond the list layout
+  projection_bytes_saved = 0
+
+  def get_list_projection(self):
+    '''
+      The list layout's columns plus `_id` and the view's extra list_fields.
+    '''
+    if not self.list_layout or not self.list_layout.get('field_list'):
+      return None
+    return build_projection(['_id'] + self.list_layout['field_list'] + self.list_fields)
+
+  async def record_projection(self, query: Query, data: list):
+    if query.projection and data is not None:
+      db = get_async_client()[query.database or DATABASE_NAME]
+      self.projection_bytes_saved = await projection_stats.record(db, query.collection, data)
+
+  def get_page_size(self, model: Model = None):
+    '''
+      Model.page_size wins over Meta.page_size; zero means no pagination.
+    '''
+    page_size = model.page_size if model else 0
+    if not page_size:
+      page_size = self.model_class.Meta.page_size
+    return page_size
+
+  def apply_page(self, query: Query, page_size: int):
+    query.paginate = True
+    query.limit = page_size
+    query.after = self.request.query_params.get('after')
+    query.before = self.request.query_params.get('before')
+    cursor = query.before or query.after
+    if cursor:
+      try:
+        decode_cursor(cursor, query.pageSort())
+      except ValueError:
+        query.after = None
+        query.before = None
+    return query
+
+  def set_page(self, page: dict):
+    self.next_cursor = page['next']
+    self.previous_cursor = page['previous']
+    return page['data']
@@ -0,0 +1,138 @@
+'''
+  Metadata
+
+  Immutable snapshots of the app metadata the code loaders build modules
+  from. Each loader registers its own load function and gets its own
+  snapshot: app_loader the `apps` documents, dynamic_loader the active custom
+  models with their fields. Importing one loader never loads (or imports)
+  the other. import_apps() refreshes its loader's snapshot once per pass and
+  every CodeLoader.exec_module of that pass reads it, instead of reloading
+  the metadata for each `__c` module it imports.
+
+  Each snapshot carries the version of the metadata it was loaded from: a
+  counter in the `_metadata` collection (mango.db.metadata_version), bumped
+  by the mango.db write endpoints after every write to apps, model or
+  model_field. A refresh costs one find_one when the version has not moved.
+  Call bump_metadata_version() after changing metadata any other way, e.g.
+  from the mongo shell.
+'''
+import os
+import threading
+import time
+from typing import Callable
+from mango.db.metadata_version import bump_metadata_version, read_version
+
+DATABASE_NAME = os.environ.get('DATABASE_NAME')
+
+
+class MetadataSnapshot():
+  '''
+    One loader's metadata as a tuple, with lookups by name. Attributes cannot
+    be set once the snapshot is built.
+  '''
+  __slots__ = ('loader', 'database', 'version', 'loaded_at', 'load_ms', 'items', '_items')
+
+  def __init__(self, loader: str, database: str, version: int, items: list, key: Callable, load_ms: float = 0.0):
+    values = {
+      'loader': loader,
+      'database': database,
+      'version': version,
+      'loaded_at': time.time(),
+      'load_ms': load_ms,
+      'items': tuple(items),
+      '_items': {key(x): x for x in items},
+    }
+    for name, value in values.items():
+      object.__setattr__(self, name, value)
+
+  def __setattr__(self, name, value):
+    raise AttributeError('MetadataSnapshot is immutable')
+
+  def get(self, name: str):
+    return self._items.get(name)
+
+  def stats(self):
+    return {
+      'loader': self.loader,
+      'database': self.database,
+      'version': self.version,
+      'loaded_at': self.loaded_at,
+      'load_ms': self.load_ms,
+      'items': len(self.items),
+    }
+
+
+class MetadataStore():
+
+  def __init__(self):
+    self.loaders = {}
+    self.snapshots = {}
+    self.loads = 0
+    self.checks = 0
+    self._lock = threading.Lock()
+
+  def register(self, loader: str, load: Callable, key: Callable):
+    '''
+      Adds a loader: load(database) returns its metadata, key(item) the name
+      get() looks an item up by.
+    '''
+    self.loaders[loader] = (load, key)
+
+  def load(self, loader: str, database: str):
+    '''
+      Reads the version first, so a write racing with the load leaves the
+      snapshot behind and the next refresh picks it up.
+    '''
+    load, key = self.loaders[loader]
+    started = time.perf_counter()
+    version = read_version(database)
+    items = load(database)
+    return MetadataSnapshot(loader, database, version, items, key, load_ms=(time.perf_counter() - started) * 1000)
+
+  def get(self, loader: str, database: str = None):
+    '''
+      The current snapshot, loaded if there is none yet. No version check.
+    '''
+    database = database or DATABASE_NAME
+    snapshot = self.snapshots.get((loader, database))
+    if snapshot is None:
+      snapshot = self.refresh(loader, database)
+    return snapshot
+
+  def refresh(self, loader: str, database: str = None):
+    '''
+      The current snapshot, reloaded when the stored version has moved.
+    '''
+    database = database or DATABASE_NAME
+    with self._lock:
+      snapshot = self.snapshots.get((loader, database))
+      if snapshot is not None:
+        self.checks += 1
+        if read_version(database) == snapshot.version:
+          return snapshot
+      snapshot = self.snapshots[(loader, database)] = self.load(loader, database)
+      self.loads += 1
+      return snapshot
+
+  def invalidate(self, database: str = None):
+    database = database or DATABASE_NAME
+    with self._lock:
+      for key in [x for x in self.snapshots if x[1] == database]:
+        del self.snapshots[key]
+
+  def stats(self):
+    with self._lock:
+      snapshots = [x.stats() for x in self.snapshots.values()]
+    return {'loaders': sorted(self.loaders), 'loads': self.loads, 'checks': self.checks, 'snapshots': snapshots}
+
+
+metadata_store = MetadataStore()
+
+def register_loader(loader: str, load: Callable, key: Callable):
+  metadata_store.register(loader, load, key)
+
+def get_snapshot(loader: str, database: str = None):
+  return metadata_store.get(loader, database)
+
+def refresh_snapshot(loader: str, database: str = None):
+  return metadata_store.refresh(loader, database)
@@ -112,6 +112,7 @@ class Model(BaseModel):
   order_by: List[str] = []  # holds the order sequence for sorting
   page_size: int = 0  # if zero, then no pagination
   field_order: List[str] = []  # holds the order sequence for page fields
+  index_list: List[List[str]] = []  # extra indexes, each a list of field names ('-' prefix for descending)
   is_custom: bool = True
   is_locked: bool = False
   is_active: bool = True
@@ -120,7 +121,7 @@ class Model(BaseModel):
     return self.label
 
   def new_dict():
-    return {'label': '', 'label_plural': '', 'name': '', 'to_string': '', 'order_by': [], 'page_size': 0, 'field_order': [], 'field_layout_list': [], 'is_locked': False, 'is_active': True}
+    return {'label': '', 'label_plural': '', 'name': '', 'to_string': '', 'order_by': [], 'page_size': 0, 'field_order': [], 'index_list': [], 'field_layout_list': [], 'is_locked': False, 'is_active': True}
 
   class Meta:
     name = 'model'
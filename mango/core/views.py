@@ -16,9 +16,11 @@ from mango.auth.auth import can, can_can, manager
 from mango.core.models import Action, Role, Model, ModelRecordType, ModelField, PageLayout, ListLayout, Tab, App, Lookup, PageElement
 from mango.core.fields import LookupSelectField, QuerySelectField, QuerySelectMultipleField, StringField2
 from mango.core.forms import get_dynamic_form, get_string_form, ActionForm, RoleForm, ModelForm, ModelRecordTypeForm, ModelFieldForm, PageLayoutForm, ListLayoutForm, TabForm, AppForm, KeyValueForm, LookupForm, PageElementForm
+from mango.core.list_page import ListPageMixin
 from mango.db.models import datetime_parser, json_from_mongo, Query, QueryOne, Count, InsertOne, InsertMany, Update, UpdateOne, UpdateMany, Delete, DeleteOne, DeleteMany, BulkWrite, AggregatePipeline
 from mango.db.api import find, find_one, run_pipeline, delete, delete_one, update_one, insert_one
 from mango.db.rest import find_one_sync, find_sync, bulk_read_sync
+from mango.db.routing import pin_primary_reads, SECONDARY_READ_PREFERENCE
 from mango.template_utils.utils import configure_templates
 
 DATABASE_NAME = os.environ.get('DATABASE_NAME')
@@ -108,7 +110,8 @@ async def get_select_options(request: Request, collection: str, filter_key: str,
   query = Query(
     database=DATABASE_NAME,
     collection=collection,
-    query=where
+    query=where,
+    default_read_preference=SECONDARY_READ_PREFERENCE,
   )
   data = await find(query)
   context = {'request': request, 'data': data}
@@ -136,7 +139,7 @@ async def get_table_row_append(request: Request, main_class: str, main_data: str
   return HTMLResponse(content=output)
 
 
-class BaseView():
+class BaseView(ListPageMixin):
   '''
     It depends on a model class and its meta class to provide all the necessary 
     information required for loading data for create, update, or delete.
@@ -249,6 +252,8 @@ class BaseView():
 
     data_string = ''
 
+    self.list_layout = await self.get_list_layout(get_type)
+
     if get_type in ['get_create']:
       data = self.model_class.new_dict()
     else:
@@ -256,7 +261,6 @@ class BaseView():
 
     self.page_layout = await self.get_page_layout(get_type)
     self.page_designer = await self.get_page_designer(get_type)
-    self.list_layout = await self.get_list_layout(get_type)
 
     if get_type in ['get_list']:
       model_data = self.model_class(**self.model_class.new_dict())
@@ -336,6 +340,7 @@ class BaseView():
         query = self.get_query('find', collection=self.model_name)
       model_query = self.get_query('find_one', collection='model', query={'name': self.model_name})
       model_data = await find_one(model_query)
+      model = None
       if model_data:
         model = Model(**model_data)
         if model.order_by:
@@ -343,7 +348,15 @@ class BaseView():
           for item in model.order_by:
             sort[item] = 1
           query.sort = sort
-      data = await find(query)
+      query.projection = self.get_list_projection()
+      query.default_read_preference = SECONDARY_READ_PREFERENCE
+      page_size = self.get_page_size(model)
+      if page_size:
+        self.apply_page(query, page_size)
+        data = self.set_page(await find(query))
+      else:
+        data = await find(query)
+      await self.record_projection(query, data)
     return data
 
   def get_query(self, query_type: str, collection: str, query: dict = {}, data: dict = None):
@@ -406,11 +419,13 @@ class BaseView():
       database=DATABASE_NAME,
       aggregate=self.model_class.Meta.name,
       pipeline=pipeline_list,
-      cursor={}
+      cursor={},
+      default_read_preference=SECONDARY_READ_PREFERENCE,
     )
     return pipeline
 
   async def post(self, request: Request, post_type: str, _id: str = '', is_modal: bool = False):
+    pin_primary_reads()  # read-after-write: the rest of this request reads from the primary
     self.request = request
     self._id = _id
     self.initialize_route_urls(_id)
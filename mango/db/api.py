@@ -4,7 +4,6 @@ from typing import (
     Deque, Dict, FrozenSet, List, Optional, Sequence, Set, Tuple, Union
 )
 from fastapi import APIRouter, Depends, HTTPException
-from pymongo import MongoClient
 from bson import json_util, ObjectId
 
 DATABASE_CLUSTER = os.environ.get('DATABASE_CLUSTER')
@@ -12,14 +11,16 @@ DATABASE_USERNAME = os.environ.get('DATABASE_USERNAME')
 DATABASE_PASSWORD = os.environ.get('DATABASE_PASSWORD')
 DATABASE_NAME = os.environ.get('DATABASE_NAME')
 
+from mango.db.bulk import run_bulk_write, stream_bulk_write, BULK_WRITE_CHUNK_SIZE, BULK_WRITE_CONCURRENCY
+from mango.db.cache import pipeline_cache, query_cache
+from mango.db.counts import run_count_async
+from mango.db.executor import execute, execute_async, execute_plan_async
+from mango.db.metadata_version import bump_after_stream, metadata_written, metadata_written_sync
+from mango.db.metrics import instrument
 from mango.db.models import datetime_parser, mongo_to_json, json_from_mongo, Query, QueryOne, Count, InsertOne, InsertMany, Update, UpdateOne, UpdateMany, Delete, DeleteOne, DeleteMany, BulkWrite, AggregatePipeline
-
-uri = f'mongodb+srv://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_CLUSTER}.mongodb.net/{DATABASE_NAME}?retryWrites=true&w=majority'
-# uri = f'mongodb://summit.local:27017/?serverSelectionTimeoutMS=5000&connectTimeoutMS=10000&3t.uriVersion=3&3t.connection.name=Local+Dev&3t.alwaysShowAuthDB=true&3t.alwaysShowDBFromUserRole=true'
-client = MongoClient(uri)
-db = client.test
-
-print(uri)
+from mango.db.routing import read_collection, resolve_read_preference
+from mango.db.single_flight import single_flight
+from mango.db.tenants import get_async_database, get_collection, get_database, tenant_limited
 
 router = APIRouter(
   prefix = '/api',
@@ -27,209 +28,261 @@ router = APIRouter(
 )
 
 @router.post('/find')
+@instrument
+@tenant_limited
 async def find(query: Query):
   database = query.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = query.buildExpression()
-  entity = db[query.collection]
-  cursor = eval(expr)
-  results = list(cursor)
+  db = get_async_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='find', default=query.default_read_preference)
+  plan = query.buildPlan()
+  results = await single_flight.run(single_flight.plan_key(database, entity, plan), lambda: execute_plan_async(entity, plan))
+  if query.isPaged():
+    return query.buildPage(results)
   return results
 
+@instrument
+@tenant_limited
 def find_sync(query: Query):
   database = query.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = query.buildExpression()
-  entity = db[query.collection]
-  cursor = eval(expr)
+  db = get_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='find', default=query.default_read_preference)
+  cursor = execute(entity, query)
   results = list(cursor)
+  if query.isPaged():
+    return query.buildPage(results)
   return results
 
+@instrument
+@tenant_limited
 def find_one_sync(query: Query):
   database = query.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = query.buildExpression()
-  entity = db[query.collection]
-  result = eval(expr)
+  db = get_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='find_one', default=query.default_read_preference)
+  result = execute(entity, query)
   data = json.loads(json.dumps(result))
   return data
 
+@instrument
+@tenant_limited
 def insert_one_sync(payload: InsertOne):
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_database(database)
+  entity = get_collection(db, payload.collection)
+  result = execute(entity, payload)
+  query_cache.bump(database, payload.collection)
+  metadata_written_sync(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'inserted_id': result.inserted_id}))
   return data
 
 
 @router.post('/findOne')
+@instrument
+@tenant_limited
 async def find_one(query: QueryOne):
   database = query.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = query.buildExpression()
-  entity = db[query.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='find_one', default=query.default_read_preference)
+  plan = query.buildPlan()
+  result = await single_flight.run(single_flight.plan_key(database, entity, plan), lambda: execute_plan_async(entity, plan))
   return result
 
 @router.post('/count')
+@instrument
+@tenant_limited
 async def count(query: Count):
   database = query.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = query.buildExpression()
-  entity = db[query.collection]
-  result = eval(expr)
-  data = json.loads(json.dumps(result))
-  return {'count': data}
+  db = get_async_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='count', default=query.default_read_preference)
+  result, mode = await run_count_async(entity, database, query)
+  return {'count': result, 'mode': mode}
 
 @router.post('/bulkRead')
+@instrument
+@tenant_limited
 async def bulk_read(batch: List[Union[Query, QueryOne]]):
   payload = []
   for query in batch:
     database = query.database
     if not database:
       database = DATABASE_NAME
-    db = client[database]
-    expr = query.buildExpression()
-    entity = db[query.collection]
-    cursor = eval(expr)
-    results = list(cursor)
+    db = get_async_database(database)
+    entity = read_collection(db, query.collection, query.read_preference, endpoint='bulk_read', default=query.default_read_preference)
+    results = await execute_async(entity, query)
     data = json.loads(json.dumps(results))
     payload.append(data)
   return payload
 
 @router.post('/insertOne')
+@instrument
+@tenant_limited
 async def insert_one(payload: InsertOne):
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'inserted_id': result.inserted_id}))
   return data
 
 @router.post('/insertMany')
+@instrument
+@tenant_limited
 async def insert_many(payload: InsertMany):
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'inserted_ids': result.inserted_ids}))
   return data
 
 @router.post('/update')
+@instrument
+@tenant_limited
 async def update(payload: Update):
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'matched_count': result.matched_count, 'modified_count': result.modified_count}))
   return data
 
 @router.post('/updateOne')
+@instrument
+@tenant_limited
 async def update_one(payload: UpdateOne):
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'matched_count': result.matched_count, 'modified_count': result.modified_count}))
   return data
 
 @router.post('/updateMany')
+@instrument
+@tenant_limited
 async def update_many(payload: UpdateMany):
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'matched_count': result.matched_count, 'modified_count': result.modified_count}))
   return data
 
 @router.post('/delete')
+@instrument
+@tenant_limited
 async def delete(payload: Delete):
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'deleted_count': result.deleted_count}))
   return data
 
 @router.post('/deleteOne')
+@instrument
+@tenant_limited
 async def delete_one(payload: DeleteOne):
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'deleted_count': result.deleted_count}))
   return data
 
 @router.post('/deleteMany')
+@instrument
+@tenant_limited
 async def delete_many(payload: DeleteMany):
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'deleted_count': result.deleted_count}))
   return data
 
 @router.post('/bulkWrite')
-async def bulk_write(batch: BulkWrite):
+@instrument
+@tenant_limited
+async def bulk_write(batch: BulkWrite, ordered:bool = False, chunk_size:int = BULK_WRITE_CHUNK_SIZE, concurrency:int = BULK_WRITE_CONCURRENCY, progress:bool = False):
   database = batch.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  entity = db[batch.collection]
+  db = get_async_database(database)
+  entity = get_collection(db, batch.collection)
   payload = batch.buildPayload()
-  result = entity.bulk_write(payload)
-  data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'deleted_count': result.deleted_count, 'inserted_count': result.inserted_count, 'matched_count': result.matched_count, 'modified_count': result.modified_count, 'upserted_count': result.upserted_count, 'upserted_ids': result.upserted_ids}))
+  on_chunk = lambda summary: query_cache.bump(database, batch.collection)
+  if progress:
+    response = stream_bulk_write(entity, payload, chunk_size=chunk_size, ordered=ordered, concurrency=concurrency, on_chunk=on_chunk)
+    return bump_after_stream(response, database, batch.collection)
+  result = await run_bulk_write(entity, payload, chunk_size=chunk_size, ordered=ordered, concurrency=concurrency, on_chunk=on_chunk)
+  await metadata_written(database, batch.collection)
+  data = json.loads(json_util.dumps(result))
   return data
 
 @router.post('/runPipeline')
+@instrument
+@tenant_limited
 async def run_pipeline(ap: AggregatePipeline):
   ap.pipeline = json.loads(json_util.dumps(ap.pipeline), object_hook=datetime_parser)
   database = ap.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
+  db = get_async_database(database)
   command = {"aggregate": ap.aggregate, "pipeline": ap.pipeline, "cursor": ap.cursor}
-  result = db.command(command)  
+  preference = resolve_read_preference(ap.aggregate, ap.read_preference, endpoint='run_pipeline', default=ap.default_read_preference)
+  cache_key = pipeline_cache.key(database, ap.aggregate, ap.pipeline, variant=['api', ap.cursor], ttl=ap.cache_ttl, read_preference=preference.document)
+  hit, data = pipeline_cache.get(cache_key)
+  if hit:
+    return data
+  key = single_flight.key(database, ap.aggregate, command, preference.document, pipeline_cache.pipeline_generations(database, ap.aggregate, ap.pipeline))
+  result = await single_flight.run(key, lambda: db.command(command, read_preference=preference))
   # return result
   data = json.loads(json.dumps(result, default=mongo_to_json))
+  pipeline_cache.set(cache_key, data, ttl=ap.cache_ttl)
   return data
   # data = json.loads(json_util.dumps(result), object_hook=json_from_mongo)
   # data = json.loads(json.dumps(result, default=json_from_mongo), object_hook=json_from_mongo)
@@ -0,0 +1,62 @@
+'''
+  Batch
+
+  Folds a batch of Query/QueryOne reads against one database into a single
+  aggregation, so the whole batch costs one round trip. Each query becomes a
+  $match/$sort/$skip/$limit/$project sub-pipeline; the first runs on its own
+  collection and the rest are appended with $unionWith. Every result is
+  tagged with its position in the batch and split back out in input order.
+'''
+from typing import List
+from mango.db.models import MongoPlan
+
+BATCH_TAG = '__mango_batch'
+BATCH_DOC = '__mango_doc'
+
+
+def can_fold(batch: List, default_database: str = None):
+  databases = set(query.database or default_database for query in batch)
+  paged = any(query.isPaged() for query in batch)
+  return len(batch) > 1 and len(databases) == 1 and not paged
+
+def plan_to_stages(plan: MongoPlan, position: int):
+  options = plan.kwargs
+  stages = [{'$match': plan.args[0] or {}}]
+  if options.get('sort'):
+    stages.append({'$sort': dict(options['sort'])})
+  if options.get('skip'):
+    stages.append({'$skip': options['skip']})
+  if plan.method == 'find_one':
+    stages.append({'$limit': 1})
+  elif options.get('limit'):
+    stages.append({'$limit': options['limit']})
+  if options.get('projection'):
+    stages.append({'$project': options['projection']})
+  stages.append({'$replaceRoot': {'newRoot': {BATCH_TAG: position, BATCH_DOC: '$$ROOT'}}})
+  return stages
+
+def fold_pipeline(batch: List, plans: List[MongoPlan]):
+  '''
+    Returns the collection to aggregate on and the folded pipeline.
+  '''
+  pipeline = plan_to_stages(plans[0], 0)
+  for position in range(1, len(batch)):
+    pipeline.append({
+      '$unionWith': {
+        'coll': batch[position].collection,
+        'pipeline': plan_to_stages(plans[position], position),
+      }
+    })
+  return batch[0].collection, pipeline
+
+def unfold_results(plans: List[MongoPlan], docs: List[dict]):
+  results = [[] for _ in plans]
+  for doc in docs:
+    results[doc[BATCH_TAG]].append(doc[BATCH_DOC])
+  payload = []
+  for plan, result in zip(plans, results):
+    if plan.method == 'find_one':
+      payload.append(result[0] if result else None)
+    else:
+      payload.append(result)
+  return payload
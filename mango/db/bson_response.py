@@ -0,0 +1,78 @@
+'''
+  BSON Response
+
+  Binary responses for service-to-service reads. A caller that sends
+  `Accept: application/bson` to /rest/find, /rest/findOne or /rest/runPipeline
+  gets BSON back instead of JSON. The collection is read with RawBSONDocument
+  as its document class, so the documents go into the response as the server
+  sent them, without being decoded into dicts and encoded again.
+
+  Two media types are served:
+    application/bson         - one BSON document: find and runPipeline wrap
+                               their results as {'data': [...]} (keyset pages
+                               keep their {'data', 'next', 'previous'} shape),
+                               findOne sends the document itself, or 204 No
+                               Content when nothing matched
+    application/x-bson-seq   - the result documents back to back, each prefixed
+                               by its own length as every BSON document is,
+                               written batch by batch like stream=true with
+                               stream_format=bson
+
+  BSON reads skip the query cache, the pipeline cache and single flight, which
+  all hold decoded results.
+'''
+import bson
+from bson.raw_bson import RawBSONDocument
+from fastapi import Request
+from fastapi.responses import Response
+from mango.db.metrics import count_documents, observe_documents
+
+BSON_MEDIA_TYPE = 'application/bson'
+BSON_SEQ_MEDIA_TYPE = 'application/x-bson-seq'
+BSON_MEDIA_TYPES = (BSON_MEDIA_TYPE, BSON_SEQ_MEDIA_TYPE)
+
+
+def quality(param: str):
+  name, _, value = param.partition('=')
+  if name.strip().lower() != 'q':
+    return None
+  try:
+    return float(value)
+  except ValueError:
+    return None
+
+def accepts_bson(request: Request = None):
+  '''
+    The BSON media type the request's Accept header names, if any. Only
+    explicit types count: a wildcard still gets JSON.
+  '''
+  if request is None:
+    return None
+  for item in request.headers.get('accept', '').split(','):
+    media_type, *params = [x.strip() for x in item.split(';')]
+    if media_type.lower() not in BSON_MEDIA_TYPES:
+      continue
+    if any(quality(x) == 0 for x in params):
+      continue
+    return media_type.lower()
+  return None
+
+def raw_collection(entity):
+  '''
+    The collection (pymongo or Motor) returning RawBSONDocument results.
+  '''
+  codec_options = entity.codec_options.with_options(document_class=RawBSONDocument)
+  return entity.with_options(codec_options=codec_options)
+
+def encode_raw(data) -> bytes:
+  if isinstance(data, RawBSONDocument):
+    return data.raw
+  elif isinstance(data, list):
+    data = {'data': data}
+  return bson.encode(data)
+
+def bson_response(data, status_code: int = 200, headers: dict = None):
+  observe_documents(count_documents(data))
+  if data is None:
+    return Response(status_code=204, headers=headers)
+  return Response(content=encode_raw(data), status_code=status_code, headers=headers, media_type=BSON_MEDIA_TYPE)
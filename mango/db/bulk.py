@@ -0,0 +1,134 @@
+'''
+  Bulk
+
+  Runs a bulk write as a series of chunks instead of one giant request.
+  Unordered writes submit up to `concurrency` chunks at a time and a failing
+  document only fails itself; ordered writes run chunk by chunk and stop after
+  the first chunk that reports an error. Each chunk's BulkWriteResult (or
+  BulkWriteError details) is reduced to a summary and the summaries are added
+  up into one result, with write errors indexed into the original batch.
+
+  Settings (environment):
+    BULK_WRITE_CHUNK_SIZE   operations per bulk_write call (default 1000)
+    BULK_WRITE_CONCURRENCY  chunks in flight for unordered writes (default 4)
+'''
+import asyncio
+import os
+from typing import Callable, List
+from bson import json_util
+from fastapi.responses import StreamingResponse
+from pymongo.errors import BulkWriteError
+
+BULK_WRITE_CHUNK_SIZE = int(os.environ.get('BULK_WRITE_CHUNK_SIZE', 1000))
+BULK_WRITE_CONCURRENCY = int(os.environ.get('BULK_WRITE_CONCURRENCY', 4))
+BULK_WRITE_COUNTS = {
+  'inserted_count': 'nInserted',
+  'matched_count': 'nMatched',
+  'modified_count': 'nModified',
+  'deleted_count': 'nRemoved',
+  'upserted_count': 'nUpserted',
+}
+
+
+def chunk_requests(requests: List, chunk_size: int = BULK_WRITE_CHUNK_SIZE):
+  if chunk_size < 1:
+    chunk_size = BULK_WRITE_CHUNK_SIZE
+  return [(offset, requests[offset:offset + chunk_size]) for offset in range(0, len(requests), chunk_size)]
+
+def result_summary(offset: int, size: int, result):
+  summary = {'offset': offset, 'size': size, 'acknowledged': result.acknowledged}
+  for name in BULK_WRITE_COUNTS:
+    summary[name] = getattr(result, name)
+  summary['upserted_ids'] = {offset + index: _id for index, _id in result.upserted_ids.items()}
+  summary['errors'] = []
+  return summary
+
+def error_summary(offset: int, size: int, details: dict):
+  summary = {'offset': offset, 'size': size, 'acknowledged': True}
+  for name, key in BULK_WRITE_COUNTS.items():
+    summary[name] = details.get(key, 0)
+  summary['upserted_ids'] = {offset + x['index']: x['_id'] for x in details.get('upserted', [])}
+  summary['errors'] = [
+    {'index': offset + x['index'], 'code': x.get('code'), 'message': x.get('errmsg')}
+    for x in details.get('writeErrors', [])
+  ]
+  summary['errors'] += [
+    {'index': None, 'code': x.get('code'), 'message': x.get('errmsg')}
+    for x in details.get('writeConcernErrors', [])
+  ]
+  return summary
+
+async def write_chunk(entity, offset: int, requests: List, ordered: bool = False):
+  try:
+    result = await entity.bulk_write(requests, ordered=ordered)
+  except BulkWriteError as e:
+    return error_summary(offset, len(requests), e.details)
+  return result_summary(offset, len(requests), result)
+
+async def iter_bulk_write(entity, requests: List, chunk_size: int = BULK_WRITE_CHUNK_SIZE, ordered: bool = False, concurrency: int = BULK_WRITE_CONCURRENCY):
+  '''
+    Yields the summary of every chunk as it finishes.
+  '''
+  chunks = chunk_requests(requests, chunk_size)
+  if ordered:
+    for offset, chunk in chunks:
+      summary = await write_chunk(entity, offset, chunk, ordered=True)
+      yield summary
+      if summary['errors']:
+        return
+    return
+  semaphore = asyncio.Semaphore(max(concurrency, 1))
+  async def run(offset, chunk):
+    async with semaphore:
+      return await write_chunk(entity, offset, chunk)
+  tasks = [asyncio.ensure_future(run(offset, chunk)) for offset, chunk in chunks]
+  try:
+    for future in asyncio.as_completed(tasks):
+      yield await future
+  finally:
+    for task in tasks:
+      task.cancel()
+
+def new_totals(total_chunks: int = None):
+  totals = {'acknowledged': True}
+  for name in BULK_WRITE_COUNTS:
+    totals[name] = 0
+  totals['upserted_ids'] = {}
+  totals['errors'] = []
+  totals['chunks'] = 0
+  totals['total_chunks'] = total_chunks
+  return totals
+
+def add_summary(totals: dict, summary: dict):
+  totals['acknowledged'] = totals['acknowledged'] and summary['acknowledged']
+  for name in BULK_WRITE_COUNTS:
+    totals[name] += summary[name]
+  totals['upserted_ids'].update(summary['upserted_ids'])
+  totals['errors'] += summary['errors']
+  totals['chunks'] += 1
+  return totals
+
+async def run_bulk_write(entity, requests: List, chunk_size: int = BULK_WRITE_CHUNK_SIZE, ordered: bool = False, concurrency: int = BULK_WRITE_CONCURRENCY, on_chunk: Callable = None):
+  totals = new_totals(len(chunk_requests(requests, chunk_size)))
+  async for summary in iter_bulk_write(entity, requests, chunk_size=chunk_size, ordered=ordered, concurrency=concurrency):
+    add_summary(totals, summary)
+    if on_chunk:
+      on_chunk(summary)
+  return totals
+
+async def iter_progress(entity, requests: List, chunk_size: int = BULK_WRITE_CHUNK_SIZE, ordered: bool = False, concurrency: int = BULK_WRITE_CONCURRENCY, on_chunk: Callable = None):
+  '''
+    One NDJSON line per finished chunk, then a final line with the totals.
+  '''
+  totals = new_totals(len(chunk_requests(requests, chunk_size)))
+  async for summary in iter_bulk_write(entity, requests, chunk_size=chunk_size, ordered=ordered, concurrency=concurrency):
+    add_summary(totals, summary)
+    if on_chunk:
+      on_chunk(summary)
+    line = dict(summary, completed=totals['chunks'], total_chunks=totals['total_chunks'])
+    yield json_util.dumps(line).encode('utf-8') + b'\n'
+  yield json_util.dumps(dict(totals, done=True)).encode('utf-8') + b'\n'
+
+def stream_bulk_write(entity, requests: List, chunk_size: int = BULK_WRITE_CHUNK_SIZE, ordered: bool = False, concurrency: int = BULK_WRITE_CONCURRENCY, on_chunk: Callable = None):
+  content = iter_progress(entity, requests, chunk_size=chunk_size, ordered=ordered, concurrency=concurrency, on_chunk=on_chunk)
+  return StreamingResponse(content, media_type='application/x-ndjson')
@@ -0,0 +1,250 @@
+'''
+  Cache
+
+  Opt-in result cache for reads of slow-changing collections.
+
+  Entries are keyed on the database, collection, normalized call plan and
+  read preference of a Query/QueryOne/Count, plus the collection's generation
+  counter. Reads pinned to the primary (read-after-write paths) never get
+  rows a lagging secondary returned. Every write
+  that goes through mango bumps the generation, so older entries are never
+  served again and age out through TTL or LRU eviction. The cache is per
+  process: writes made by other processes are only picked up once the TTL
+  expires, so keep QUERY_CACHE_TTL short for collections written elsewhere.
+
+  Pipeline results live in a second cache keyed on a fingerprint of the
+  database, aggregate and pipeline. Its key carries the generation of every
+  collection the pipeline reads, the aggregate plus the $lookup, $graphLookup
+  and $unionWith targets at any depth, so a write to any of them invalidates
+  it. Pipelines that write ($out, $merge) or are not repeatable ($sample,
+  $rand, $$NOW, ...) are never cached. AggregatePipeline.cache_ttl overrides
+  PIPELINE_CACHE_TTL per pipeline; 0 disables caching.
+
+  Settings (environment):
+    QUERY_CACHE_COLLECTIONS  comma separated collections to cache, e.g. lookup,model
+    QUERY_CACHE_TTL          seconds an entry stays valid (default 60)
+    QUERY_CACHE_MAX_SIZE     maximum number of entries (default 1024)
+    PIPELINE_CACHE_TTL       seconds a pipeline result stays valid, 0 caches only
+                             pipelines with a cache_ttl (default 0)
+    PIPELINE_CACHE_MAX_SIZE  maximum number of pipeline results (default 256)
+'''
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from bson import json_util
+from mango.db.models import MongoPlan
+
+QUERY_CACHE_COLLECTIONS = os.environ.get('QUERY_CACHE_COLLECTIONS', '')
+QUERY_CACHE_TTL = float(os.environ.get('QUERY_CACHE_TTL', 60))
+QUERY_CACHE_MAX_SIZE = int(os.environ.get('QUERY_CACHE_MAX_SIZE', 1024))
+PIPELINE_CACHE_TTL = float(os.environ.get('PIPELINE_CACHE_TTL', 0))
+PIPELINE_CACHE_MAX_SIZE = int(os.environ.get('PIPELINE_CACHE_MAX_SIZE', 256))
+UNCACHEABLE_STAGES = {'$out', '$merge', '$sample', '$currentOp', '$listSessions', '$listLocalSessions', '$collStats', '$indexStats', '$planCacheStats', '$changeStream'}
+UNCACHEABLE_EXPRESSIONS = ('"$rand"', '"$$NOW"', '"$$CLUSTER_TIME"')
+
+
+def clone(value):
+  '''
+    Copies JSON-style data so callers cannot mutate cached results.
+  '''
+  if isinstance(value, dict):
+    return {k: clone(v) for k, v in value.items()}
+  elif isinstance(value, list):
+    return [clone(v) for v in value]
+  return value
+
+def normalize(value):
+  return json_util.dumps(value, sort_keys=True)
+
+def lookup_target(value):
+  if isinstance(value, dict):
+    return value.get('coll')
+  return value
+
+def pipeline_collections(aggregate: str, pipeline: list, collections: set = None):
+  '''
+    The collections a pipeline reads, or None when it must not be cached.
+  '''
+  if collections is None:
+    collections = {aggregate}
+  for stage in pipeline:
+    if not isinstance(stage, dict):
+      continue
+    for name, spec in stage.items():
+      if name in UNCACHEABLE_STAGES:
+        return None
+      elif name in ('$lookup', '$graphLookup') and isinstance(spec, dict):
+        target = lookup_target(spec.get('from'))
+        if target:
+          collections.add(target)
+        if isinstance(spec.get('pipeline'), list) and pipeline_collections(target, spec['pipeline'], collections) is None:
+          return None
+      elif name == '$unionWith':
+        target = lookup_target(spec)
+        if target:
+          collections.add(target)
+        if isinstance(spec, dict) and isinstance(spec.get('pipeline'), list) and pipeline_collections(target, spec['pipeline'], collections) is None:
+          return None
+      elif name == '$facet' and isinstance(spec, dict):
+        for facet in spec.values():
+          if isinstance(facet, list) and pipeline_collections(aggregate, facet, collections) is None:
+            return None
+  collections.discard(None)
+  return collections
+
+
+class QueryCache():
+
+  def __init__(self, collections: list = [], ttl: float = QUERY_CACHE_TTL, max_size: int = QUERY_CACHE_MAX_SIZE):
+    self.ttl = ttl
+    self.max_size = max_size
+    self.collections = set(collections)
+    self.entries = OrderedDict()
+    self.generations = {}
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self._lock = threading.Lock()
+
+  def is_enabled(self, collection: str):
+    return collection in self.collections
+
+  def enable(self, collection: str):
+    self.collections.add(collection)
+
+  def disable(self, collection: str):
+    self.collections.discard(collection)
+    with self._lock:
+      for key in [k for k in self.entries if k[1] == collection]:
+        del self.entries[key]
+
+  def generation(self, database: str, collection: str):
+    return self.generations.get((database, collection), 0)
+
+  def bump(self, database: str, collection: str):
+    with self._lock:
+      self.generations[(database, collection)] = self.generation(database, collection) + 1
+
+  def key(self, database: str, collection: str, plan: MongoPlan, force: bool = False, read_preference: dict = None):
+    '''
+      Returns None when the collection is not cached, unless `force` is set.
+    '''
+    if plan is None or not (force or self.is_enabled(collection)):
+      return None
+    shape = normalize([plan.method, plan.args, plan.kwargs, read_preference])
+    return (database, collection, self.generation(database, collection), shape)
+
+  def get(self, key, copy: bool = True):
+    '''
+      Returns (hit, value).
+    '''
+    if key is None:
+      return False, None
+    with self._lock:
+      entry = self.entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return False, None
+      expires, value = entry
+      if expires < time.monotonic():
+        del self.entries[key]
+        self.misses += 1
+        return False, None
+      self.entries.move_to_end(key)
+      self.hits += 1
+    if copy:
+      return True, clone(value)
+    return True, value
+
+  def set(self, key, value, ttl: float = None):
+    if key is None:
+      return
+    with self._lock:
+      self.entries[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), clone(value))
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_size:
+        self.entries.popitem(last=False)
+        self.evictions += 1
+
+  def key_reads(self, key, database: str, collection: str):
+    return key[0] == database and key[1] == collection
+
+  def evict(self, database: str, collection: str):
+    '''
+      Drops the entries that read a collection, e.g. once it is dropped.
+    '''
+    with self._lock:
+      for key in [k for k in self.entries if self.key_reads(k, database, collection)]:
+        del self.entries[key]
+
+  def clear(self):
+    with self._lock:
+      self.entries.clear()
+
+  def stats(self):
+    lookups = self.hits + self.misses
+    return {
+      'collections': sorted(self.collections),
+      'size': len(self.entries),
+      'max_size': self.max_size,
+      'ttl': self.ttl,
+      'hits': self.hits,
+      'misses': self.misses,
+      'evictions': self.evictions,
+      'hit_ratio': self.hits / lookups if lookups else 0.0,
+    }
+
+
+class PipelineCache(QueryCache):
+  '''
+    Pipeline results. Generations are the query cache's, so the writes that
+    bump a collection there invalidate the pipelines reading it here.
+  '''
+  def __init__(self, queries: QueryCache, ttl: float = PIPELINE_CACHE_TTL, max_size: int = PIPELINE_CACHE_MAX_SIZE):
+    super().__init__(ttl=ttl, max_size=max_size)
+    self.queries = queries
+
+  def generation(self, database: str, collection: str):
+    return self.queries.generation(database, collection)
+
+  def bump(self, database: str, collection: str):
+    self.queries.bump(database, collection)
+
+  def key_reads(self, key, database: str, collection: str):
+    return key[0] == database and any(name == collection for name, _ in key[3])
+
+  def collection_generations(self, database: str, collections: set):
+    return tuple((name, self.generation(database, name)) for name in sorted(collections))
+
+  def pipeline_generations(self, database: str, aggregate: str, pipeline: list):
+    '''
+      The generations of every collection a pipeline reads (just the
+      aggregate's for pipelines that are never cached).
+    '''
+    return self.collection_generations(database, pipeline_collections(aggregate, pipeline) or {aggregate})
+
+  def key(self, database: str, aggregate: str, pipeline: list, variant = None, ttl: float = None, read_preference: dict = None):
+    '''
+      Returns None when the pipeline is not cached: its TTL is 0 or it
+      writes or is not repeatable. `variant` tells apart callers that keep
+      different shapes of the same result.
+    '''
+    if (self.ttl if ttl is None else ttl) <= 0:
+      return None
+    text = normalize(pipeline)
+    if any(x in text for x in UNCACHEABLE_EXPRESSIONS):
+      return None
+    collections = pipeline_collections(aggregate, pipeline)
+    if collections is None:
+      return None
+    generations = self.collection_generations(database, collections)
+    digest = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    return (database, aggregate, digest, generations, normalize([variant, read_preference]))
+
+
+query_cache = QueryCache(
+  collections=[x.strip() for x in QUERY_CACHE_COLLECTIONS.split(',') if x.strip()],
+)
+pipeline_cache = PipelineCache(query_cache)
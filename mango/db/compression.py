@@ -0,0 +1,306 @@
+'''
+  Compression
+
+  ASGI middleware that compresses responses with the best encoding the client
+  accepts, in COMPRESSION_ENCODINGS order: zstd (needs the zstandard package),
+  br (needs brotli) and gzip. It covers every route, so the rest list and
+  pipeline responses and the rendered list pages of the views are compressed
+  alike.
+
+  A complete response is compressed in one go when its body is at least
+  COMPRESSION_MIN_SIZE bytes. A streamed response (stream=true on the rest
+  endpoints, bulk writes, ingest) is compressed chunk by chunk, flushing after
+  every chunk so each batch still reaches the client as soon as it is sent.
+  Responses that are already encoded, or whose media type does not compress,
+  pass through untouched.
+
+  compression_stats counts responses and bytes before and after compression
+  per encoding; ratio is uncompressed / compressed bytes. They are served on
+  /metrics and /api_admin/compression_stats.
+
+  Settings (environment):
+    COMPRESSION_ENABLED        set to false to send every response as is (default true)
+    COMPRESSION_ENCODINGS      encodings in order of preference (default zstd,br,gzip)
+    COMPRESSION_MIN_SIZE       smallest complete body compressed, in bytes (default 1024)
+    COMPRESSION_GZIP_LEVEL     gzip level, 1 to 9 (default 6)
+    COMPRESSION_ZSTD_LEVEL     zstd level (default 3)
+    COMPRESSION_BROTLI_QUALITY brotli quality, 0 to 11 (default 4)
+'''
+import os
+import threading
+import zlib
+from starlette.datastructures import Headers, MutableHeaders
+from mango.db.metrics import format_labels, metrics
+
+try:
+  import zstandard
+except ImportError:
+  zstandard = None
+
+try:
+  import brotli
+except ImportError:
+  brotli = None
+
+COMPRESSION_ENABLED = os.environ.get('COMPRESSION_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+COMPRESSION_ENCODINGS = os.environ.get('COMPRESSION_ENCODINGS', 'zstd,br,gzip')
+COMPRESSION_MIN_SIZE = int(os.environ.get('COMPRESSION_MIN_SIZE', 1024))
+COMPRESSION_GZIP_LEVEL = int(os.environ.get('COMPRESSION_GZIP_LEVEL', 6))
+COMPRESSION_ZSTD_LEVEL = int(os.environ.get('COMPRESSION_ZSTD_LEVEL', 3))
+COMPRESSION_BROTLI_QUALITY = int(os.environ.get('COMPRESSION_BROTLI_QUALITY', 4))
+COMPRESSIBLE_TYPES = (
+  'text/',
+  'application/json',
+  'application/x-ndjson',
+  'application/javascript',
+  'application/xml',
+  'application/bson',
+  'application/x-bson-seq',
+  'image/svg+xml',
+)
+
+
+class GzipEncoder():
+
+  def __init__(self):
+    self.compressor = zlib.compressobj(COMPRESSION_GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+  def compress(self, data: bytes, flush: bool = False):
+    chunk = self.compressor.compress(data)
+    if flush:
+      chunk += self.compressor.flush(zlib.Z_SYNC_FLUSH)
+    return chunk
+
+  def finish(self):
+    return self.compressor.flush()
+
+
+class ZstdEncoder():
+
+  def __init__(self):
+    self.compressor = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compressobj()
+
+  def compress(self, data: bytes, flush: bool = False):
+    chunk = self.compressor.compress(data)
+    if flush:
+      chunk += self.compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+    return chunk
+
+  def finish(self):
+    return self.compressor.flush()
+
+
+class BrotliEncoder():
+
+  def __init__(self):
+    self.compressor = brotli.Compressor(quality=COMPRESSION_BROTLI_QUALITY)
+
+  def compress(self, data: bytes, flush: bool = False):
+    chunk = self.compressor.process(data)
+    if flush:
+      chunk += self.compressor.flush()
+    return chunk
+
+  def finish(self):
+    return self.compressor.finish()
+
+
+ENCODERS = {'gzip': GzipEncoder}
+if zstandard is not None:
+  ENCODERS['zstd'] = ZstdEncoder
+if brotli is not None:
+  ENCODERS['br'] = BrotliEncoder
+
+
+def get_encodings(names: str = COMPRESSION_ENCODINGS):
+  '''
+    The configured encodings that are installed, in order of preference.
+  '''
+  encodings = []
+  for name in (names or '').split(','):
+    name = name.strip().lower()
+    if name in ENCODERS and name not in encodings:
+      encodings.append(name)
+  return encodings
+
+def parse_accept_encoding(header: str):
+  '''
+    {encoding: quality} of an Accept-Encoding header.
+  '''
+  accepted = {}
+  for item in (header or '').split(','):
+    name, *params = [x.strip() for x in item.split(';')]
+    if not name:
+      continue
+    quality = 1.0
+    for param in params:
+      key, _, value = param.partition('=')
+      if key.strip().lower() == 'q':
+        try:
+          quality = float(value)
+        except ValueError:
+          quality = 0.0
+    accepted[name.lower()] = quality
+  return accepted
+
+def choose_encoding(header: str, encodings: list):
+  accepted = parse_accept_encoding(header)
+  for name in encodings:
+    quality = accepted.get(name, accepted.get('*', 0.0))
+    if quality > 0:
+      return name
+  return None
+
+def is_compressible(headers: Headers):
+  if 'content-encoding' in headers:
+    return False
+  media_type = headers.get('content-type', '').split(';')[0].strip().lower()
+  return any(media_type.startswith(x) for x in COMPRESSIBLE_TYPES)
+
+
+class CompressionStats():
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.encodings = {}
+    self.skipped = 0
+
+  def record(self, encoding: str, uncompressed: int, compressed: int, streamed: bool = False):
+    with self._lock:
+      stats = self.encodings.get(encoding)
+      if stats is None:
+        stats = self.encodings[encoding] = {'responses': 0, 'streamed': 0, 'uncompressed_bytes': 0, 'compressed_bytes': 0}
+      stats['responses'] += 1
+      stats['streamed'] += int(streamed)
+      stats['uncompressed_bytes'] += uncompressed
+      stats['compressed_bytes'] += compressed
+
+  def skip(self):
+    with self._lock:
+      self.skipped += 1
+
+  def stats(self):
+    with self._lock:
+      encodings = {name: dict(stats) for name, stats in self.encodings.items()}
+      skipped = self.skipped
+    for stats in encodings.values():
+      stats['ratio'] = stats['uncompressed_bytes'] / stats['compressed_bytes'] if stats['compressed_bytes'] else 0.0
+    return {'available': get_encodings(), 'min_size': COMPRESSION_MIN_SIZE, 'skipped_small': skipped, 'encodings': encodings}
+
+  def text(self):
+    stats = self.stats()
+    lines = []
+    series = [
+      ('mango_http_compressed_responses_total', 'counter', 'Responses compressed.', 'responses'),
+      ('mango_http_compression_uncompressed_bytes_total', 'counter', 'Response bytes before compression.', 'uncompressed_bytes'),
+      ('mango_http_compression_compressed_bytes_total', 'counter', 'Response bytes after compression.', 'compressed_bytes'),
+      ('mango_http_compression_ratio', 'gauge', 'Uncompressed / compressed response bytes.', 'ratio'),
+    ]
+    for name, kind, help_text, field in series:
+      lines.append(f'# HELP {name} {help_text}')
+      lines.append(f'# TYPE {name} {kind}')
+      for encoding, x in stats['encodings'].items():
+        lines.append(f'{name}{{{format_labels(encoding=encoding)}}} {x[field]:g}')
+    lines.append('# HELP mango_http_compression_skipped_total Compressible responses below COMPRESSION_MIN_SIZE.')
+    lines.append('# TYPE mango_http_compression_skipped_total counter')
+    lines.append(f'mango_http_compression_skipped_total {stats["skipped_small"]}')
+    return '\n'.join(lines) + '\n'
+
+
+class CompressionMiddleware():
+  '''
+    app.add_middleware(CompressionMiddleware)
+  '''
+  def __init__(self, app, min_size: int = COMPRESSION_MIN_SIZE, encodings: str = COMPRESSION_ENCODINGS, enabled: bool = COMPRESSION_ENABLED):
+    self.app = app
+    self.min_size = min_size
+    self.encodings = get_encodings(encodings)
+    self.enabled = enabled
+
+  async def __call__(self, scope, receive, send):
+    if scope['type'] != 'http' or not self.enabled:
+      await self.app(scope, receive, send)
+      return
+    encoding = choose_encoding(Headers(scope=scope).get('accept-encoding'), self.encodings)
+    if encoding is None:
+      await self.app(scope, receive, send)
+      return
+    responder = CompressionResponder(send, encoding, self.min_size)
+    await self.app(scope, receive, responder.send)
+
+
+class CompressionResponder():
+  '''
+    Wraps `send` for one response. The start message is held back until the
+    first body message shows whether the body is complete or streamed.
+  '''
+  def __init__(self, send, encoding: str, min_size: int):
+    self._send = send
+    self.encoding = encoding
+    self.min_size = min_size
+    self.start = None
+    self.encoder = None
+    self.passthrough = False
+    self.uncompressed = 0
+    self.compressed = 0
+
+  async def send(self, message):
+    if message['type'] == 'http.response.start':
+      self.start = message
+      headers = Headers(raw=message['headers'])
+      if not is_compressible(headers):
+        self.passthrough = True
+        await self._send(message)
+      return
+    if message['type'] != 'http.response.body' or self.passthrough:
+      await self._send(message)
+      return
+    body = message.get('body', b'')
+    more_body = message.get('more_body', False)
+    if self.encoder is None:
+      if not more_body:
+        await self.send_complete(body)
+        return
+      await self.start_stream()
+    self.uncompressed += len(body)
+    chunk = self.encoder.compress(body, flush=more_body)
+    if not more_body:
+      chunk += self.encoder.finish()
+      compression_stats.record(self.encoding, self.uncompressed, self.compressed + len(chunk), streamed=True)
+    self.compressed += len(chunk)
+    await self._send({'type': 'http.response.body', 'body': chunk, 'more_body': more_body})
+
+  def encoded_headers(self):
+    headers = MutableHeaders(raw=list(self.start['headers']))
+    headers['Content-Encoding'] = self.encoding
+    headers.add_vary_header('Accept-Encoding')
+    del headers['Content-Length']
+    self.start['headers'] = headers.raw
+    return headers
+
+  async def send_complete(self, body: bytes):
+    if len(body) < self.min_size:
+      compression_stats.skip()
+      headers = MutableHeaders(raw=list(self.start['headers']))
+      headers.add_vary_header('Accept-Encoding')
+      self.start['headers'] = headers.raw
+      await self._send(self.start)
+      await self._send({'type': 'http.response.body', 'body': body})
+      return
+    encoder = ENCODERS[self.encoding]()
+    content = encoder.compress(body) + encoder.finish()
+    compression_stats.record(self.encoding, len(body), len(content))
+    headers = self.encoded_headers()
+    headers['Content-Length'] = str(len(content))
+    self.start['headers'] = headers.raw
+    await self._send(self.start)
+    await self._send({'type': 'http.response.body', 'body': content})
+
+  async def start_stream(self):
+    self.encoder = ENCODERS[self.encoding]()
+    self.encoded_headers()
+    await self._send(self.start)
+
+
+compression_stats = CompressionStats()
+metrics.add_collector(compression_stats.text)
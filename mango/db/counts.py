@@ -0,0 +1,64 @@
+'''
+  Counts
+
+  Answers a Count in one of three modes:
+    exact     - count_documents with the full filter.
+    estimated - estimated_document_count from collection metadata when the
+                filter is empty; falls back to exact otherwise.
+    cached    - an exact count memoized in the query cache, dropped by the
+                next write to the collection through mango.
+  Without a mode, collections enabled in the query cache count in cached mode
+  and all others in exact mode. Every call returns the mode that answered it:
+  a cached call that misses reports exact.
+'''
+from mango.db.cache import query_cache
+from mango.db.executor import execute_plan, execute_plan_async
+from mango.db.models import Count
+
+
+def resolve_mode(query: Count):
+  if query.mode:
+    return query.mode
+  if query_cache.is_enabled(query.collection):
+    return 'cached'
+  return 'exact'
+
+async def run_count_async(entity, database: str, query: Count):
+  '''
+    Returns (count, mode).
+  '''
+  mode = resolve_mode(query)
+  plan = query.buildPlan()
+  if mode == 'estimated':
+    if not plan.args[0]:
+      return await entity.estimated_document_count(), 'estimated'
+    mode = 'exact'
+  if mode == 'cached':
+    key = query_cache.key(database, query.collection, plan, force=True, read_preference=entity.read_preference.document)
+    hit, result = query_cache.get(key)
+    if hit:
+      return result, 'cached'
+    result = await execute_plan_async(entity, plan)
+    query_cache.set(key, result)
+    return result, 'exact'
+  return await execute_plan_async(entity, plan), 'exact'
+
+def run_count(entity, database: str, query: Count):
+  '''
+    Returns (count, mode).
+  '''
+  mode = resolve_mode(query)
+  plan = query.buildPlan()
+  if mode == 'estimated':
+    if not plan.args[0]:
+      return entity.estimated_document_count(), 'estimated'
+    mode = 'exact'
+  if mode == 'cached':
+    key = query_cache.key(database, query.collection, plan, force=True, read_preference=entity.read_preference.document)
+    hit, result = query_cache.get(key)
+    if hit:
+      return result, 'cached'
+    result = execute_plan(entity, plan)
+    query_cache.set(key, result)
+    return result, 'exact'
+  return execute_plan(entity, plan), 'exact'
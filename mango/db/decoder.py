@@ -0,0 +1,248 @@
+'''
+  Decoder
+
+  Converts request JSON (queries, update documents, inserted data) into BSON
+  values in a single in-place pass.
+
+  Collections with registered ModelField definitions get a decoder compiled
+  from each field's field_type (DateField, IntegerField, ...), or its
+  data_type when the field_type says nothing about the value, so a value is
+  converted by what the field is rather than by what its name or contents
+  look like: `*_id` fields become ObjectIds, bool/int/float/date fields are
+  coerced and text fields are only unquoted. {'$date': ...} values always
+  become datetimes, whatever the field. Operators ($set, $and, $in, $gte,
+  ...) are walked with the same schema.
+
+  Collections without a schema, and keys a schema does not know, fall back to
+  the json_to_mongo heuristics.
+'''
+import re
+import threading
+from datetime import datetime
+from urllib.parse import unquote
+from bson import ObjectId
+
+ISO_DATETIME = re.compile(r'^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}(\.\d{1,6})?$')
+COMPARISON_OPERATORS = {'$eq', '$ne', '$gt', '$gte', '$lt', '$lte', '$in', '$nin', '$all'}
+
+_lock = threading.Lock()
+_decoders = {}
+
+
+def decode_heuristic_value(key: str, value):
+  if isinstance(value, list):
+    for item in value:
+      if type(item) is dict:
+        decode_heuristic(item)
+    return value
+  elif isinstance(value, dict):
+    if '$date' in value:
+      return to_datetime(value)
+    return decode_heuristic(value)
+  elif key.endswith('_id') and value:
+    return ObjectId(value)
+  elif type(value) is str:
+    if value == 'true':
+      return True
+    elif value == 'false':
+      return False
+    return unquote(value)
+  return value
+
+def decode_heuristic(d):
+  '''
+    The json_to_mongo rules: `*_id` keys become ObjectIds, 'true'/'false'
+    become booleans and every other string is unquoted.
+  '''
+  if isinstance(d, ObjectId):
+    return d
+  for key, value in d.items():
+    d[key] = decode_heuristic_value(key, value)
+  return d
+
+def to_object_id(value):
+  if value and type(value) is str:
+    return ObjectId(value)
+  return value
+
+def to_str(value):
+  if type(value) is str:
+    return unquote(value)
+  return value
+
+def to_bool(value):
+  if value == 'true':
+    return True
+  elif value == 'false':
+    return False
+  return value
+
+def to_int(value):
+  if type(value) is str:
+    try:
+      return int(value)
+    except ValueError:
+      return unquote(value)
+  return value
+
+def to_float(value):
+  if type(value) is str:
+    try:
+      return float(value)
+    except ValueError:
+      return unquote(value)
+  return value
+
+def parse_datetime(value: str):
+  if '.' in value:
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f')
+  return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S')
+
+def to_datetime(value):
+  if type(value) is str:
+    if ISO_DATETIME.match(value):
+      return parse_datetime(value)
+    return unquote(value)
+  elif type(value) is dict and '$date' in value:
+    date = value['$date']
+    if isinstance(date, str):
+      return datetime.fromisoformat(date)
+    elif isinstance(date, (int, float)):
+      return datetime.fromtimestamp(date / 1000.0)
+  return value
+
+def to_document(value):
+  if type(value) is dict:
+    return decode_heuristic(value)
+  return value
+
+def to_list(value):
+  if type(value) is list:
+    for item in value:
+      if type(item) is dict:
+        decode_heuristic(item)
+  return value
+
+FIELD_TYPE_CONVERTERS = {
+  'DateField': to_datetime,
+  'DateTimeField': to_datetime,
+  'IntegerField': to_int,
+  'FloatField': to_float,
+  'BooleanField': to_bool,
+  'StringField': to_str,
+  'TextAreaField': to_str,
+  'EmailField': to_str,
+  'PasswordField': to_str,
+  'HiddenField': to_str,
+  'SelectField': to_str,
+  'RadioField': to_str,
+  'SelectMultipleField': to_list,
+  'FieldList': to_list,
+  'FormField': to_document,
+}
+
+# data_type values as DATA_TYPES in mango.core.choices stores them, lowercased
+DATA_TYPE_CONVERTERS = {
+  'str': to_str,
+  'int': to_int,
+  'positiveint': to_int,
+  'float': to_float,
+  'bool': to_bool,
+  'datetime': to_datetime,
+  'date': to_datetime,
+  'dict': to_document,
+  'list': to_list,
+  'objectid': to_object_id,
+}
+
+
+def field_attr(field, name: str):
+  if isinstance(field, dict):
+    return field.get(name)
+  return getattr(field, name, None)
+
+def compile_field(field):
+  name = field_attr(field, 'name')
+  if name.endswith('_id'):
+    return name, to_object_id
+  converter = FIELD_TYPE_CONVERTERS.get(field_attr(field, 'field_type') or '')
+  if converter is None:
+    converter = DATA_TYPE_CONVERTERS.get((field_attr(field, 'data_type') or '').lower())
+  return name, converter
+
+def is_date(value):
+  return type(value) is dict and '$date' in value
+
+def convert_operand(convert, value):
+  if is_date(value):
+    return to_datetime(value)
+  return convert(value)
+
+
+class SchemaDecoder():
+
+  def __init__(self, fields: list):
+    self.converters = {}
+    for field in fields:
+      name, converter = compile_field(field)
+      if converter:
+        self.converters[name] = converter
+
+  def decode_field(self, key: str, value, convert):
+    if type(value) is dict and value and all(k.startswith('$') for k in value):
+      if is_date(value):
+        return to_datetime(value)
+      for op, operand in value.items():
+        if op in COMPARISON_OPERATORS:
+          if type(operand) is list:
+            value[op] = [convert_operand(convert, item) for item in operand]
+          else:
+            value[op] = convert_operand(convert, operand)
+        else:
+          value[op] = decode_heuristic_value(op, operand)
+      return value
+    return convert_operand(convert, value)
+
+  def decode(self, d: dict):
+    if not isinstance(d, dict):
+      return d
+    for key, value in d.items():
+      if key.startswith('$'):
+        if type(value) is dict:
+          self.decode(value)
+        elif type(value) is list:
+          for item in value:
+            if type(item) is dict:
+              self.decode(item)
+        continue
+      convert = self.converters.get(key)
+      if convert is None:
+        d[key] = decode_heuristic_value(key, value)
+      else:
+        d[key] = self.decode_field(key, value, convert)
+    return d
+
+
+def register_schema(collection: str, fields: list):
+  '''
+    Compiles and registers the decoder for a collection from its ModelField
+    definitions (ModelField objects or dicts with name, field_type and
+    data_type).
+  '''
+  decoder = SchemaDecoder(fields)
+  with _lock:
+    _decoders[collection] = decoder
+  return decoder
+
+def unregister_schema(collection: str):
+  with _lock:
+    _decoders.pop(collection, None)
+
+def has_schema(collection: str):
+  return collection in _decoders
+
+def decode(collection: str, d):
+  decoder = _decoders.get(collection)
+  if decoder is None:
+    return decode_heuristic(d)
+  return decoder.decode(d)
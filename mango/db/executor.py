@@ -0,0 +1,60 @@
+'''
+  Executor
+
+  Runs the MongoPlan produced by a model's buildPlan() directly against a
+  pymongo collection, or awaits it against a Motor collection. Nothing is
+  formatted to source text or evaluated.
+'''
+from mango.db.models import MongoPlan
+
+CURSOR_METHODS = ['find', 'aggregate']
+
+
+def execute(entity, model):
+  plan = model.buildPlan()
+  return execute_plan(entity, plan)
+
+def execute_plan(entity, plan: MongoPlan):
+  if plan is None:
+    raise ValueError('Nothing to execute: the request has no query or data.')
+  method = getattr(entity, plan.method)
+  return method(*plan.args, **plan.kwargs)
+
+def fetch_plan(entity, plan: MongoPlan):
+  '''
+    execute_plan with find/aggregate cursors drained into lists, as
+    execute_plan_async does.
+  '''
+  result = execute_plan(entity, plan)
+  if plan.method in CURSOR_METHODS:
+    return list(result)
+  return result
+
+async def execute_async(entity, model):
+  plan = model.buildPlan()
+  return await execute_plan_async(entity, plan)
+
+async def execute_plan_async(entity, plan: MongoPlan):
+  '''
+    Motor returns cursors for find/aggregate and awaitables for everything
+    else, so cursor results are drained with to_list().
+  '''
+  if plan is None:
+    raise ValueError('Nothing to execute: the request has no query or data.')
+  method = getattr(entity, plan.method)
+  result = method(*plan.args, **plan.kwargs)
+  if plan.method in CURSOR_METHODS:
+    return await result.to_list(length=None)
+  return await result
+
+def open_cursor(entity, model, batch_size: int = 0):
+  '''
+    Builds the cursor for a find plan without draining it, for streaming.
+  '''
+  plan = model.buildPlan()
+  if plan is None or plan.method != 'find':
+    raise ValueError('Only find queries can be opened as a cursor.')
+  options = dict(plan.kwargs)
+  if batch_size:
+    options['batch_size'] = batch_size
+  return entity.find(*plan.args, **options)
@@ -0,0 +1,203 @@
+'''
+  Index Advisor
+
+  A metrics sink that remembers the filter/sort shapes reads actually run
+  (Query, QueryOne, Count, bulk reads, and the leading $match/$sort stages of
+  a pipeline) and turns them into compound index suggestions.
+
+  Each shape becomes an index key in ESR order: equality fields, then the
+  sort fields with their directions, then range fields. Shapes an existing
+  index already serves are dropped, a suggestion that is a prefix of a longer
+  one is folded into it, and what is left is ranked by benefit_ms: the time
+  spent in the reads the index would serve since the process started (an
+  upper bound on what it can save).
+
+  Settings (environment):
+    INDEX_ADVISOR_MAX_SHAPES  index keys tracked per process (default 1000)
+'''
+import os
+import threading
+from typing import List, Tuple
+from mango.db.metrics import metrics, Operation
+
+INDEX_ADVISOR_MAX_SHAPES = int(os.environ.get('INDEX_ADVISOR_MAX_SHAPES', 1000))
+INDEX_ADVISOR_OPERATIONS = {'find', 'find_one', 'count', 'run_pipeline', 'bulk_read'}
+EQUALITY_OPERATORS = {'$eq', '$in'}
+UNINDEXABLE_OPERATORS = {'$or', '$nor', '$expr', '$text', '$where', '$jsonSchema'}
+
+
+def filter_fields(query: dict, equality: list, ranges: list):
+  '''
+    Splits the fields of a filter into equality and range fields. Only the
+    top level and $and are walked; $or and friends need indexes per branch.
+  '''
+  for key, value in (query or {}).items():
+    if key == '$and' and isinstance(value, list):
+      for item in value:
+        if isinstance(item, dict):
+          filter_fields(item, equality, ranges)
+      continue
+    elif key.startswith('$'):
+      continue
+    if isinstance(value, dict) and value and all(k.startswith('$') for k in value):
+      target = equality if set(value) <= EQUALITY_OPERATORS else ranges
+    else:
+      target = equality
+    if key not in equality and key not in ranges:
+      target.append(key)
+  return equality, ranges
+
+def suggest_key(query: dict, sort: List[Tuple[str, int]] = None):
+  '''
+    The ESR index key for a filter and sort, and the number of equality
+    fields it starts with. None when no index would help.
+  '''
+  if any(key in UNINDEXABLE_OPERATORS for key in (query or {})):
+    return None, 0
+  equality, ranges = filter_fields(query, [], [])
+  if '_id' in equality:
+    return None, 0
+  key = [(name, 1) for name in equality]
+  used = set(equality)
+  for name, direction in sort or []:
+    if name not in used:
+      key.append((name, direction))
+      used.add(name)
+  for name in ranges:
+    if name not in used:
+      key.append((name, 1))
+      used.add(name)
+  if not key:
+    return None, 0
+  return tuple(key), len(equality)
+
+def covers(index_key: List[Tuple[str, int]], key: Tuple[Tuple[str, int], ...], equality: int):
+  '''
+    Whether an index with `index_key` serves `key`: it starts with the same
+    equality fields in any order, followed by the rest of `key` in order, in
+    the same directions or, when every direction is 1 or -1, all reversed.
+  '''
+  index_key = [(name, direction) for name, direction in index_key]
+  if len(index_key) < len(key):
+    return False
+  if set(name for name, _ in index_key[:equality]) != set(name for name, _ in key[:equality]):
+    return False
+  rest = list(zip(index_key[equality:len(key)], key[equality:]))
+  if any(a[0] != b[0] for a, b in rest):
+    return False
+  same = all(a[1] == b[1] for a, b in rest)
+  reversed_ = all(a[1] in (1, -1) and a[1] == -b[1] for a, b in rest)
+  return same or reversed_
+
+def index_name(key: Tuple[Tuple[str, int], ...]):
+  return '_'.join(f'{name}_{direction}' for name, direction in key)
+
+def read_shapes(model):
+  '''
+    (collection, filter, sort) of every read in a request model.
+  '''
+  if isinstance(model, list):
+    shapes = []
+    for item in model:
+      shapes += read_shapes(item)
+    return shapes
+  if hasattr(model, 'pipeline'):
+    query = {}
+    sort = None
+    for stage in model.pipeline:
+      if '$match' in stage and sort is None:
+        query = {'$and': [query, stage['$match']]} if query else stage['$match']
+      elif '$sort' in stage and sort is None:
+        sort = [(name, direction) for name, direction in stage['$sort'].items()]
+      else:
+        break
+    return [(model.aggregate, query, sort)]
+  if not hasattr(model, 'query'):
+    return []
+  sort = None
+  if hasattr(model, 'isPaged') and model.isPaged():
+    sort = model.pageSort()
+  elif hasattr(model, 'buildOptions'):
+    sort = model.buildOptions().get('sort')
+  return [(model.collection, model.query, sort)]
+
+
+class IndexAdvisor():
+
+  def __init__(self, max_shapes: int = INDEX_ADVISOR_MAX_SHAPES):
+    self.max_shapes = max_shapes
+    self.shapes = {}
+    self._lock = threading.Lock()
+
+  def record(self, operation: Operation):
+    if operation.error or operation.operation not in INDEX_ADVISOR_OPERATIONS:
+      return
+    for collection, query, sort in read_shapes(operation.model):
+      key, equality = suggest_key(query, sort)
+      if key is None:
+        continue
+      table_key = (operation.database, collection, key)
+      with self._lock:
+        stats = self.shapes.get(table_key)
+        if stats is None:
+          if len(self.shapes) >= self.max_shapes:
+            continue
+          stats = self.shapes[table_key] = {'equality': equality, 'calls': 0, 'latency_ms': 0.0, 'shape': operation.shape}
+        stats['calls'] += 1
+        stats['latency_ms'] += operation.latency_ms
+
+  def observed(self, database: str, collection: str = None):
+    with self._lock:
+      return [
+        (k[1], k[2], dict(stats)) for k, stats in self.shapes.items()
+        if k[0] == database and (not collection or k[1] == collection)
+      ]
+
+  def suggestions(self, database: str, get_indexes, collection: str = None):
+    '''
+      Ranked suggestions for a database. `get_indexes(collection)` returns
+      the collection's index_information().
+    '''
+    by_collection = {}
+    for name, key, stats in self.observed(database, collection):
+      by_collection.setdefault(name, []).append((key, stats))
+    suggestions = []
+    for name, shapes in by_collection.items():
+      indexes = [x['key'] for x in get_indexes(name).values()]
+      pending = []
+      for key, stats in shapes:
+        if any(covers(index_key, key, stats['equality']) for index_key in indexes):
+          continue
+        pending.append({
+          'collection': name,
+          'name': index_name(key),
+          'key': list(key),
+          'equality': stats['equality'],
+          'calls': stats['calls'],
+          'benefit_ms': stats['latency_ms'],
+          'shapes': [stats['shape']],
+          'extends': [index_name(tuple(x)) for x in indexes if len(x) < len(key) and covers(key, tuple(x), 0)],
+        })
+      pending.sort(key=lambda x: len(x['key']), reverse=True)
+      merged = []
+      for suggestion in pending:
+        target = next((x for x in merged if covers(x['key'], tuple(suggestion['key']), suggestion['equality'])), None)
+        if target is None:
+          merged.append(suggestion)
+          continue
+        target['calls'] += suggestion['calls']
+        target['benefit_ms'] += suggestion['benefit_ms']
+        target['shapes'] += suggestion['shapes']
+      suggestions += merged
+    for suggestion in suggestions:
+      del suggestion['equality']
+    suggestions.sort(key=lambda x: x['benefit_ms'], reverse=True)
+    return suggestions
+
+  def clear(self):
+    with self._lock:
+      self.shapes = {}
+
+
+index_advisor = IndexAdvisor()
+metrics.add_sink(index_advisor)
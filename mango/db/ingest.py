@@ -0,0 +1,177 @@
+'''
+  Ingest
+
+  Loads an NDJSON or CSV request body into a collection while it is being
+  received. The body is decoded line by line, every row goes through the
+  collection's decoder (see mango.db.decoder) and rows are inserted unordered
+  in batches of `batch_size`. At most `concurrency` batches are in flight; the
+  body is not read any further until one of them finishes, so memory stays
+  bounded by batch_size * concurrency rows whatever the size of the upload.
+
+  Rows are numbered from 0 in the order they appear (the CSV header is not a
+  row). Rows that cannot be parsed or decoded, and rows the server rejects,
+  are reported by that number in `errors`.
+
+  Settings (environment):
+    INGEST_BATCH_SIZE   rows per insert (default 1000)
+    INGEST_CONCURRENCY  inserts in flight (default 2)
+    INGEST_MAX_ERRORS   errors kept in the result (default 1000)
+'''
+import asyncio
+import codecs
+import csv
+import os
+from typing import AsyncIterator, Callable, Literal
+from bson import json_util
+from bson.errors import BSONError, InvalidId
+from pymongo import InsertOne
+from mango.db.bulk import add_summary, new_totals, write_chunk
+from mango.db.decoder import decode
+
+INGEST_BATCH_SIZE = int(os.environ.get('INGEST_BATCH_SIZE', 1000))
+INGEST_CONCURRENCY = int(os.environ.get('INGEST_CONCURRENCY', 2))
+INGEST_MAX_ERRORS = int(os.environ.get('INGEST_MAX_ERRORS', 1000))
+INGEST_MEDIA_TYPES = {
+  'application/x-ndjson': 'ndjson',
+  'application/ndjson': 'ndjson',
+  'application/jsonl': 'ndjson',
+  'text/csv': 'csv',
+}
+
+IngestFormat = Literal['ndjson', 'csv']
+
+
+def get_ingest_format(content_type: str = None, default: IngestFormat = 'ndjson'):
+  media_type = (content_type or '').split(';')[0].strip().lower()
+  return INGEST_MEDIA_TYPES.get(media_type, default)
+
+async def iter_lines(chunks: AsyncIterator[bytes]):
+  decoder = codecs.getincrementaldecoder('utf-8-sig')()
+  buffer = ''
+  async for chunk in chunks:
+    buffer += decoder.decode(chunk)
+    lines = buffer.split('\n')
+    buffer = lines.pop()
+    for line in lines:
+      yield line
+  buffer += decoder.decode(b'', final=True)
+  if buffer:
+    yield buffer
+
+async def iter_ndjson_rows(lines: AsyncIterator[str]):
+  '''
+    Yields (row, error) pairs.
+  '''
+  async for line in lines:
+    line = line.strip()
+    if not line:
+      continue
+    try:
+      row = json_util.loads(line)
+    except (ValueError, BSONError, ArithmeticError) as e:
+      # ArithmeticError: decimal.InvalidOperation from a bad $numberDecimal
+      yield None, f'Invalid JSON: {e}'
+      continue
+    if not isinstance(row, dict):
+      yield None, 'Expected a JSON object'
+      continue
+    yield row, None
+
+async def iter_csv_rows(lines: AsyncIterator[str], delimiter: str = ','):
+  '''
+    Yields (row, error) pairs keyed by the header. Quoted fields may span
+    lines: a record is complete once its quotes are balanced.
+  '''
+  header = None
+  record = []
+  quotes = 0
+  async for line in lines:
+    record.append(line)
+    quotes += line.count('"')
+    if quotes % 2:
+      continue
+    text = '\n'.join(record)
+    record = []
+    quotes = 0
+    values = next(csv.reader([text], delimiter=delimiter), [])
+    if not values:
+      continue
+    if header is None:
+      header = values
+      continue
+    if len(values) != len(header):
+      yield None, f'Expected {len(header)} columns, found {len(values)}'
+      continue
+    yield dict(zip(header, values)), None
+  if record:
+    yield None, 'Unterminated quoted field'
+
+def add_error(totals: dict, index: int, message: str, code: int = None):
+  totals['error_count'] += 1
+  if len(totals['errors']) < INGEST_MAX_ERRORS:
+    totals['errors'].append({'index': index, 'code': code, 'message': message})
+
+async def ingest_rows(entity, collection: str, rows: AsyncIterator, batch_size: int = INGEST_BATCH_SIZE, concurrency: int = INGEST_CONCURRENCY, on_chunk: Callable = None):
+  if batch_size < 1:
+    batch_size = INGEST_BATCH_SIZE
+  totals = new_totals()
+  totals['rows'] = 0
+  totals['error_count'] = 0
+  pending = set()
+
+  async def insert(positions, requests):
+    return positions, await write_chunk(entity, 0, requests)
+
+  def collect(tasks):
+    for task in tasks:
+      positions, summary = task.result()
+      errors = summary['errors']
+      summary['errors'] = []
+      add_summary(totals, summary)
+      for error in errors:
+        index = positions[error['index']] if error['index'] is not None else None
+        add_error(totals, index, error['message'], error['code'])
+      if on_chunk:
+        on_chunk(summary)
+
+  positions = []
+  requests = []
+  try:
+    async for row, error in rows:
+      index = totals['rows']
+      totals['rows'] += 1
+      if error:
+        add_error(totals, index, error)
+        continue
+      try:
+        document = decode(collection, row)
+      except (InvalidId, TypeError, ValueError) as e:
+        add_error(totals, index, str(e))
+        continue
+      positions.append(index)
+      requests.append(InsertOne(document))
+      if len(requests) >= batch_size:
+        pending.add(asyncio.ensure_future(insert(positions, requests)))
+        positions = []
+        requests = []
+        if len(pending) >= max(concurrency, 1):
+          done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+          collect(done)
+    if requests:
+      pending.add(asyncio.ensure_future(insert(positions, requests)))
+    if pending:
+      done, pending = await asyncio.wait(pending)
+      collect(done)
+  finally:
+    for task in pending:
+      task.cancel()
+  totals['total_chunks'] = totals['chunks']
+  return totals
+
+async def ingest_stream(entity, collection: str, chunks: AsyncIterator[bytes], ingest_format: IngestFormat = 'ndjson', delimiter: str = ',', batch_size: int = INGEST_BATCH_SIZE, concurrency: int = INGEST_CONCURRENCY, on_chunk: Callable = None):
+  lines = iter_lines(chunks)
+  if ingest_format == 'csv':
+    rows = iter_csv_rows(lines, delimiter=delimiter)
+  else:
+    rows = iter_ndjson_rows(lines)
+  return await ingest_rows(entity, collection, rows, batch_size=batch_size, concurrency=concurrency, on_chunk=on_chunk)
@@ -0,0 +1,74 @@
+'''
+  Metadata Version
+
+  The version counter behind mango.core.metadata's snapshots: one document,
+  {_id: 'metadata', version: n}, in the `_metadata` collection of each
+  database. The rest and api write endpoints bump it after every write to a
+  metadata collection (apps, model, model_field), with Motor on the async
+  paths and pymongo on the sync helpers; a streamed bulk write bumps it once
+  its body has been sent. Dropping a metadata collection from /api_admin
+  bumps it as well, and dropping a database carries it over the drop.
+'''
+from pymongo import ReturnDocument
+from mango.db.tenants import get_async_database, get_database
+
+METADATA_COLLECTION = '_metadata'
+METADATA_VERSION_ID = 'metadata'
+METADATA_COLLECTIONS = {'apps', 'model', 'model_field'}
+
+
+def read_version(database: str = None):
+  doc = get_database(database)[METADATA_COLLECTION].find_one({'_id': METADATA_VERSION_ID}, {'version': 1})
+  return (doc or {}).get('version', 0)
+
+def bump_metadata_version(database: str = None):
+  doc = get_database(database)[METADATA_COLLECTION].find_one_and_update(
+    {'_id': METADATA_VERSION_ID},
+    {'$inc': {'version': 1}},
+    upsert=True,
+    return_document=ReturnDocument.AFTER,
+  )
+  return doc['version']
+
+def set_metadata_version(database: str, version: int):
+  '''
+    Moves the version up to `version`, e.g. to carry it over a dropped
+    database so it never goes back to a value a snapshot was loaded at.
+  '''
+  get_database(database)[METADATA_COLLECTION].update_one(
+    {'_id': METADATA_VERSION_ID},
+    {'$max': {'version': version}},
+    upsert=True,
+  )
+
+async def bump_metadata_version_async(database: str = None):
+  doc = await get_async_database(database)[METADATA_COLLECTION].find_one_and_update(
+    {'_id': METADATA_VERSION_ID},
+    {'$inc': {'version': 1}},
+    upsert=True,
+    return_document=ReturnDocument.AFTER,
+  )
+  return doc['version']
+
+async def metadata_written(database: str, collection: str):
+  if collection in METADATA_COLLECTIONS:
+    await bump_metadata_version_async(database)
+
+def metadata_written_sync(database: str, collection: str):
+  if collection in METADATA_COLLECTIONS:
+    bump_metadata_version(database)
+
+async def _bump_after(database: str, body_iterator):
+  try:
+    async for chunk in body_iterator:
+      yield chunk
+  finally:
+    await bump_metadata_version_async(database)
+
+def bump_after_stream(response, database: str, collection: str):
+  '''
+    Bumps the version once a streamed write response has been sent.
+  '''
+  if collection in METADATA_COLLECTIONS:
+    response.body_iterator = _bump_after(database, response.body_iterator)
+  return response
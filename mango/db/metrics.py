@@ -0,0 +1,388 @@
+'''
+  Metrics
+
+  Per-operation instrumentation for mango.db. Every endpoint and sync helper
+  decorated with @instrument produces one Operation record:
+    operation   - the function name without _sync, e.g. find, update_one
+    database, collection
+    shape       - the query/pipeline with every value replaced by '?', and its
+                  short hash, so the same query with different values groups
+                  together
+    latency_ms  - until the result is returned, or until a streamed response
+                  has sent its last byte
+    documents   - documents returned
+    bytes       - bytes serialized into the response (0 for Python callers,
+                  which get objects back)
+    error       - the operation raised
+
+  The Operation also keeps the request model (not part of as_dict()), so a
+  sink can look at the query itself, e.g. mango.db.slow_queries. The model is
+  only there while the sinks run: it is dropped once they have all seen the
+  operation, so the ring buffer does not hold on to request payloads. A sink
+  that needs the query later copies what it needs in record().
+
+  Records go to every registered sink. By default a ring buffer keeps the
+  most recent ones and an aggregate sink keeps totals per operation/collection
+  and per shape, served as Prometheus text on /metrics. Add a sink with
+  metrics.add_sink(); a sink is any object with record(operation). Other
+  modules add their own series to /metrics with metrics.add_collector(), a
+  function returning Prometheus text.
+
+  /metrics takes the same login as the /api_admin endpoints unless
+  METRICS_PUBLIC opts in to serving it to anyone who can reach the app. The
+  aggregate sink keeps the most recently used METRICS_MAX_SERIES entries per
+  table, so a caller cycling through collection names or query shapes cannot
+  grow it without bound.
+
+  Settings (environment):
+    METRICS_ENABLED     set to false to turn recording off (default true)
+    METRICS_RING_SIZE   operations kept in the ring buffer (default 1000)
+    METRICS_MAX_SERIES  operation/collection and shape entries kept each (default 1000)
+    METRICS_PUBLIC      set to true to serve /metrics without a login (default false)
+'''
+import contextvars
+import functools
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+from collections import deque, OrderedDict
+from fastapi import APIRouter, Depends, Request
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+
+DATABASE_NAME = os.environ.get('DATABASE_NAME')
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+METRICS_RING_SIZE = int(os.environ.get('METRICS_RING_SIZE', 1000))
+METRICS_MAX_SERIES = int(os.environ.get('METRICS_MAX_SERIES', 1000))
+METRICS_PUBLIC = os.environ.get('METRICS_PUBLIC', 'false').lower() in ('1', 'true', 'yes')
+
+current_operation = contextvars.ContextVar('current_operation', default=None)
+
+
+def query_shape(value):
+  if isinstance(value, dict):
+    return {key: query_shape(v) for key, v in value.items()}
+  elif isinstance(value, (list, tuple)):
+    if value and all(isinstance(v, dict) for v in value):
+      return [query_shape(v) for v in value]
+    return ['?']
+  return '?'
+
+def shape_hash(shape):
+  text = json.dumps(shape, sort_keys=True)
+  return hashlib.sha1(text.encode('utf-8')).hexdigest()[:12]
+
+def count_documents(result):
+  if result is None:
+    return 0
+  elif isinstance(result, list):
+    return sum(len(x) if isinstance(x, list) else int(x is not None) for x in result)
+  elif isinstance(result, dict):
+    if isinstance(result.get('data'), list):
+      return len(result['data'])
+    elif isinstance(result.get('cursor'), dict):
+      return len(result['cursor'].get('firstBatch', []))
+    elif 'count' in result or 'acknowledged' in result:
+      return 0
+    return 1
+  return 0
+
+
+class Operation():
+  __slots__ = ('operation', 'database', 'collection', 'shape', 'shape_hash', 'model', 'started', 'latency_ms', 'documents', 'bytes', 'error', 'timestamp')
+
+  def __init__(self, operation: str, database: str = None, collection: str = None, shape = None, model = None):
+    self.operation = operation
+    self.database = database
+    self.collection = collection
+    self.shape = shape
+    self.model = model
+    self.shape_hash = shape_hash(shape) if shape is not None else None
+    self.started = time.perf_counter()
+    self.timestamp = time.time()
+    self.latency_ms = 0.0
+    self.documents = None
+    self.bytes = 0
+    self.error = False
+
+  def add_documents(self, count: int):
+    self.documents = (self.documents or 0) + count
+
+  def finish(self):
+    self.latency_ms = (time.perf_counter() - self.started) * 1000
+
+  def as_dict(self):
+    return {
+      'operation': self.operation,
+      'database': self.database,
+      'collection': self.collection,
+      'shape': self.shape,
+      'shape_hash': self.shape_hash,
+      'latency_ms': self.latency_ms,
+      'documents': self.documents or 0,
+      'bytes': self.bytes,
+      'error': self.error,
+      'timestamp': self.timestamp,
+    }
+
+
+class RingBufferSink():
+  '''
+    Keeps the most recent operations.
+  '''
+  def __init__(self, size: int = METRICS_RING_SIZE):
+    self.operations = deque(maxlen=size)
+
+  def record(self, operation: Operation):
+    self.operations.append(operation)
+
+  def recent(self, limit: int = 100):
+    operations = list(self.operations)[-limit:]
+    return [x.as_dict() for x in reversed(operations)]
+
+
+class AggregateSink():
+  '''
+    Totals per (operation, database, collection) and per query shape.
+  '''
+  def __init__(self, max_size: int = METRICS_MAX_SERIES):
+    self._lock = threading.Lock()
+    self.max_size = max_size
+    self.totals = OrderedDict()
+    self.shapes = OrderedDict()
+
+  def _add(self, table: OrderedDict, key: tuple, operation: Operation):
+    stats = table.get(key)
+    if stats is None:
+      stats = table[key] = {'calls': 0, 'errors': 0, 'latency_ms_sum': 0.0, 'latency_ms_max': 0.0, 'documents': 0, 'bytes': 0}
+      while len(table) > self.max_size:
+        table.popitem(last=False)
+    else:
+      table.move_to_end(key)
+    stats['calls'] += 1
+    stats['errors'] += int(operation.error)
+    stats['latency_ms_sum'] += operation.latency_ms
+    stats['latency_ms_max'] = max(stats['latency_ms_max'], operation.latency_ms)
+    stats['documents'] += operation.documents or 0
+    stats['bytes'] += operation.bytes
+    return stats
+
+  def record(self, operation: Operation):
+    with self._lock:
+      self._add(self.totals, (operation.operation, operation.database, operation.collection), operation)
+      if operation.shape_hash:
+        stats = self._add(self.shapes, (operation.operation, operation.collection, operation.shape_hash), operation)
+        stats['shape'] = operation.shape
+
+  def stats(self):
+    with self._lock:
+      totals = [dict(stats, operation=k[0], database=k[1], collection=k[2]) for k, stats in self.totals.items()]
+      shapes = [dict(stats, operation=k[0], collection=k[1], shape_hash=k[2]) for k, stats in self.shapes.items()]
+    totals.sort(key=lambda x: x['latency_ms_sum'], reverse=True)
+    shapes.sort(key=lambda x: x['latency_ms_sum'], reverse=True)
+    return {'collections': totals, 'shapes': shapes}
+
+  def text(self):
+    stats = self.stats()
+    lines = []
+    series = [
+      ('mango_db_operations_total', 'counter', 'Operations run.', 'calls', 1),
+      ('mango_db_operation_errors_total', 'counter', 'Operations that raised.', 'errors', 1),
+      ('mango_db_operation_seconds_sum', 'counter', 'Total operation latency.', 'latency_ms_sum', 0.001),
+      ('mango_db_operation_seconds_max', 'gauge', 'Slowest operation.', 'latency_ms_max', 0.001),
+      ('mango_db_documents_total', 'counter', 'Documents returned.', 'documents', 1),
+      ('mango_db_bytes_total', 'counter', 'Bytes serialized into responses.', 'bytes', 1),
+    ]
+    for name, kind, help_text, field, scale in series:
+      lines.append(f'# HELP {name} {help_text}')
+      lines.append(f'# TYPE {name} {kind}')
+      for x in stats['collections']:
+        labels = format_labels(operation=x['operation'], database=x['database'], collection=x['collection'])
+        lines.append(f'{name}{{{labels}}} {x[field] * scale:g}')
+    shape_series = [
+      ('mango_db_shape_operations_total', 'counter', 'Operations run per query shape.', 'calls', 1),
+      ('mango_db_shape_seconds_sum', 'counter', 'Total latency per query shape.', 'latency_ms_sum', 0.001),
+      ('mango_db_shape_seconds_max', 'gauge', 'Slowest operation per query shape.', 'latency_ms_max', 0.001),
+    ]
+    for name, kind, help_text, field, scale in shape_series:
+      lines.append(f'# HELP {name} {help_text}')
+      lines.append(f'# TYPE {name} {kind}')
+      for x in stats['shapes']:
+        labels = format_labels(operation=x['operation'], collection=x['collection'], shape=x['shape_hash'])
+        lines.append(f'{name}{{{labels}}} {x[field] * scale:g}')
+    return '\n'.join(lines) + '\n'
+
+
+def format_labels(**labels):
+  def escape(value):
+    return str(value or '').replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+  return ','.join(f'{key}="{escape(value)}"' for key, value in labels.items())
+
+
+class Metrics():
+
+  def __init__(self, sinks: list = [], enabled: bool = METRICS_ENABLED):
+    self.enabled = enabled
+    self.sinks = list(sinks)
+    self.collectors = []
+
+  def add_sink(self, sink):
+    self.sinks.append(sink)
+
+  def remove_sink(self, sink):
+    self.sinks.remove(sink)
+
+  def add_collector(self, collector):
+    self.collectors.append(collector)
+
+  def text(self):
+    return aggregates.text() + ''.join(collector() for collector in self.collectors)
+
+  def record(self, operation: Operation):
+    try:
+      for sink in self.sinks:
+        sink.record(operation)
+    finally:
+      operation.model = None
+
+
+ring_buffer = RingBufferSink()
+aggregates = AggregateSink()
+metrics = Metrics([ring_buffer, aggregates])
+
+
+def request_model(args: tuple, kwargs: dict):
+  '''
+    The request model of a call (or list of models for bulk reads).
+  '''
+  values = list(args) + list(kwargs.values())
+  return next((x for x in values if hasattr(x, 'database') or isinstance(x, list)), None)
+
+def describe(model, kwargs: dict):
+  '''
+    Database, collection and query shape of a call, taken from its request
+    model.
+  '''
+  if isinstance(model, list):
+    first = model[0] if model else None
+    database = getattr(first, 'database', None)
+    collections = sorted(set(getattr(x, 'collection', '') for x in model))
+    shape = [query_shape(getattr(x, 'query', None) or {}) for x in model]
+    return database or DATABASE_NAME, ','.join(collections), shape
+  if model is None:
+    return kwargs.get('database') or DATABASE_NAME, kwargs.get('collection'), None
+  database = model.database or DATABASE_NAME
+  collection = getattr(model, 'collection', None) or getattr(model, 'aggregate', None)
+  if hasattr(model, 'pipeline'):
+    shape = query_shape(model.pipeline)
+  elif hasattr(model, 'batch'):
+    shape = [x.bulk_type for x in model.batch]
+  elif hasattr(model, 'query'):
+    shape = {'filter': query_shape(model.query or {})}
+    if getattr(model, 'sort', None):
+      shape['sort'] = list(model.sort)
+  else:
+    shape = None
+  return database, collection, shape
+
+def start_operation(name: str, args: tuple, kwargs: dict):
+  model = request_model(args, kwargs)
+  database, collection, shape = describe(model, kwargs)
+  return Operation(name, database, collection, shape, model=model)
+
+async def _measure_stream(operation: Operation, body_iterator):
+  try:
+    async for chunk in body_iterator:
+      operation.bytes += len(chunk)
+      yield chunk
+  except Exception:
+    operation.error = True
+    raise
+  finally:
+    operation.finish()
+    metrics.record(operation)
+
+def finish_operation(operation: Operation, result):
+  '''
+    Records the operation, deferring streamed responses until they finish.
+  '''
+  if isinstance(result, StreamingResponse):
+    result.body_iterator = _measure_stream(operation, result.body_iterator)
+    return result
+  if isinstance(result, Response):
+    operation.bytes = len(result.body or b'')
+  elif operation.documents is None:
+    operation.documents = count_documents(result)
+  operation.finish()
+  metrics.record(operation)
+  return result
+
+def fail_operation(operation: Operation):
+  operation.error = True
+  operation.finish()
+  metrics.record(operation)
+
+def instrument(func):
+  '''
+    Records an Operation for every call of an endpoint or sync helper.
+  '''
+  name = func.__name__
+  if name.endswith('_sync'):
+    name = name[:-len('_sync')]
+  if inspect.iscoroutinefunction(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+      if not metrics.enabled:
+        return await func(*args, **kwargs)
+      operation = start_operation(name, args, kwargs)
+      token = current_operation.set(operation)
+      try:
+        result = await func(*args, **kwargs)
+      except Exception:
+        fail_operation(operation)
+        raise
+      finally:
+        current_operation.reset(token)
+      return finish_operation(operation, result)
+    return wrapper
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    if not metrics.enabled:
+      return func(*args, **kwargs)
+    operation = start_operation(name, args, kwargs)
+    token = current_operation.set(operation)
+    try:
+      result = func(*args, **kwargs)
+    except Exception:
+      fail_operation(operation)
+      raise
+    finally:
+      current_operation.reset(token)
+    return finish_operation(operation, result)
+  return wrapper
+
+def observe_documents(count: int):
+  '''
+    Adds to the documents of the operation in progress, if any.
+  '''
+  operation = current_operation.get()
+  if operation is not None:
+    operation.add_documents(count)
+
+
+async def metrics_user(request: Request):
+  if METRICS_PUBLIC:
+    return None
+  # mango.auth imports mango.db.rest, which imports this module
+  from mango.auth.auth import manager
+  return await manager(request)
+
+router = APIRouter(
+  tags = ['Metrics']
+)
+
+@router.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics(user=Depends(metrics_user)):
+  return PlainTextResponse(metrics.text())
@@ -7,7 +7,7 @@ import bson.objectid
 import json, re
 from decimal import *
 from typing import (
-    Deque, Dict, FrozenSet, List, Literal, Optional, Sequence, Set, Tuple, Type, Union
+    Deque, Dict, FrozenSet, List, Literal, NamedTuple, Optional, Sequence, Set, Tuple, Type, Union
 )
 from enum import Enum, IntEnum
 from fastapi import File, Form
@@ -23,6 +23,9 @@ from pymongo import (
 from bson import ObjectId
 from bson.errors import InvalidId
 from datetime import datetime
+from mango.db.decoder import decode, decode_heuristic, has_schema
+from mango.db.pagination import build_page, decode_cursor, keyset_filter, keyset_projection, keyset_sort, reverse_sort
+from mango.db.routing import ReadPreferenceMode
 
 
 class DateTimeAwareEncoder(json.JSONEncoder):
@@ -87,27 +90,15 @@ def json_to_mongo(d):
     This method needs to recursively walk the object graph and adjust accordingly.
     We want to be sure that we support JSON Schema moving forward!!!
   '''
-  if isinstance(d, ObjectId):
+  return decode_heuristic(d)
+
+def decode_dates(collection: str, d):
+  '''
+    Collections with a registered schema decode $date values in buildPlan.
+  '''
+  if has_schema(collection):
     return d
-  for k, v in d.copy().items():
-    if isinstance(v, list):
-      for sv in v:
-        if type(sv) is dict:
-          json_to_mongo(sv)
-    elif isinstance(v, dict):
-      json_to_mongo(v)
-    else:
-      if k.endswith('_id') and v:
-        d[k] = ObjectId(v)
-      else:
-        if type(v) is str:
-          if v == 'true':
-            d[k] = True
-          elif v == 'false':
-            d[k] = False
-          else:
-            d[k] = unquote(v)
-  return d
+  return convert_dates_to_datetime(d)
 
 def convert_dates_to_datetime(data):
   if isinstance(data, dict):
@@ -133,11 +124,14 @@ def convert_dates_to_datetime(data):
         new_data.append(item)
     return new_data
 
+DATETIME_MICROSECONDS = re.compile('^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d*$')
+DATETIME_SECONDS = re.compile('^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$')
+
 def datetime_parser(dct):
   for (k, v) in dct.items():
-    if type(v) is str and re.match('^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}\.\d*$', v):
+    if type(v) is str and DATETIME_MICROSECONDS.match(v):
       dct[k] = datetime.strptime(v, "%Y-%m-%dT%H:%M:%S.%f")
-    elif type(v) is str and re.match('^\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:\d{2}$', v):
+    elif type(v) is str and DATETIME_SECONDS.match(v):
       dct[k] = datetime.strptime(v, "%Y-%m-%dT%H:%M:%S")
     else:
       pass
@@ -199,6 +193,14 @@ def as_form(cls: Type[BaseModel]):
 #   email: str
 #   password: str
 
+class MongoPlan(NamedTuple):
+  '''
+    A direct pymongo call: the collection method to invoke and its arguments.
+  '''
+  method: str
+  args: tuple = ()
+  kwargs: dict = {}
+
 class BaseMongo(BaseModel):
   database: str 
   collection: str
@@ -209,89 +211,92 @@ class QueryOne(BaseMongo):
   projection: Optional[dict]
   sort: Optional[dict]
   skip: Optional[int]
-  def buildExpression(self):
-    if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
-    expr = f'entity.{self.query_type}({self.query}'
+  read_preference: Optional[ReadPreferenceMode]  # None: the collection's, endpoint's or default mode (see mango.db.routing)
+  default_read_preference: Optional[ReadPreferenceMode]  # the caller's default, below the collection's mode
+  def buildOptions(self):
+    options = {}
     if self.projection and any(self.projection):
-      projection_pairs = self.projection.items()
-      expr += ', {'
-      for key, value in projection_pairs:
-        expr += f'"{key}": {int(value)}, '
-      expr += '}'
+      options['projection'] = {key: int(value) for key, value in self.projection.items()}
     if self.sort and self.sort.items():
-      sort_pairs = self.sort.items()
-      expr += f', sort=['
-      for key, value in sort_pairs:
-        expr += f'("{key}", {int(value)}),'
-      expr = expr[:-1]
-      expr += f']'
+      options['sort'] = [(key, int(value)) for key, value in self.sort.items()]
     if self.skip:
-      expr += f', skip={self.skip}'
-    expr += f')'
-    return expr
+      options['skip'] = self.skip
+    return options
+  def buildPlan(self):
+    if self.query and any(self.query):
+      self.query = decode(self.collection, self.query)
+    return MongoPlan(self.query_type, (self.query,), self.buildOptions())
+  def isPaged(self):
+    return False
 
 @as_form
 class Query(QueryOne):
   query_type: Literal['find_one', 'find'] = 'find'
   limit: Optional[int]
-  def buildExpression(self):
+  paginate: bool = False  # return a keyset page: {'data', 'next', 'previous'}
+  after: Optional[str]  # cursor of the row to continue after
+  before: Optional[str]  # cursor of the row to walk back from
+  def isPaged(self):
+    return self.query_type == 'find' and bool(self.paginate or self.after or self.before)
+  def pageSort(self):
+    return keyset_sort(self.buildOptions().get('sort'))
+  def buildPlan(self):
     if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
+      self.query = decode(self.collection, self.query)
     else:
       self.query = {}
-    expr = f'entity.{self.query_type}({self.query}'
-    if self.projection and any(self.projection):
-      projection_pairs = self.projection.items()
-      expr += ', {'
-      for key, value in projection_pairs:
-        expr += f'"{key}": {int(value)}, '
-      expr += '}'
-    if self.sort and self.sort.items():
-      sort_pairs = self.sort.items()
-      expr += f', sort=['
-      for key, value in sort_pairs:
-        expr += f'("{key}", {int(value)}),'
-      expr = expr[:-1]
-      expr += f']'
-    if self.skip:
-      expr += f', skip={self.skip}'
-    if self.query_type == 'find':
-      if self.limit:
-        expr += f', limit={self.limit}'
-    expr += f')'
-    return expr
+    options = self.buildOptions()
+    if not self.isPaged():
+      if self.query_type == 'find':
+        if self.limit:
+          options['limit'] = self.limit
+      return MongoPlan(self.query_type, (self.query,), options)
+    sort = keyset_sort(options.get('sort'))
+    query = self.query
+    cursor = self.before or self.after
+    if cursor:
+      values = decode_cursor(cursor, sort)
+      seek = keyset_filter(sort, values, before=bool(self.before))
+      query = {'$and': [query, seek]} if query else seek
+    options['sort'] = reverse_sort(sort) if self.before else sort
+    if options.get('projection'):
+      options['projection'] = keyset_projection(options['projection'], sort)
+    if self.limit:
+      options['limit'] = self.limit + 1
+    return MongoPlan(self.query_type, (query,), options)
+  def buildPage(self, docs: list):
+    return build_page(docs, self.pageSort(), limit=self.limit or 0, after=self.after, before=self.before)
 
 @as_form
 class Count(BaseMongo):
   query: Optional[dict]
-  def buildExpression(self):
+  mode: Optional[Literal['exact', 'estimated', 'cached']]  # None: cached if the collection is in the query cache, else exact
+  read_preference: Optional[ReadPreferenceMode]
+  default_read_preference: Optional[ReadPreferenceMode]
+  def buildPlan(self):
     if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
+      self.query = decode(self.collection, self.query)
     else:
       self.query = {}
-    expr = f'entity.count_documents({self.query})'
-    return expr
+    return MongoPlan('count_documents', (self.query,))
 
 @as_form
 class InsertOne(BaseMongo):
   insert_type: Literal['insert_one', 'insert_many'] = 'insert_one'
   data: dict
-  def buildExpression(self):
+  def buildPlan(self):
     if self.data and any(self.data):
-      self.data = json_to_mongo(self.data)
-      expr = f'entity.{self.insert_type}({self.data})'
-      return expr
+      self.data = decode(self.collection, self.data)
+      return MongoPlan(self.insert_type, (self.data,))
     return None
 
 @as_form
 class InsertMany(BaseMongo):
   insert_type: Literal['insert_one', 'insert_many'] = 'insert_many'
   data: List[dict]
-  def buildExpression(self):
+  def buildPlan(self):
     if (self.data):
-      expr = f'entity.{self.insert_type}({self.data})'
-      return expr
+      return MongoPlan(self.insert_type, (self.data,))
     return None
 
 @as_form
@@ -300,15 +305,14 @@ class UpdateOne(BaseMongo):
   query: Optional[dict]
   data: dict
   upsert: bool = False
-  def buildExpression(self):
+  def buildPlan(self):
     if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
+      self.query = decode(self.collection, self.query)
     else:
       self.query = {}
     if self.data and any(self.data):
-      self.data = json_to_mongo(self.data)
-      expr = f'entity.{self.update_type}({self.query}, {self.data}, upsert={self.upsert})'
-      return expr
+      self.data = decode(self.collection, self.data)
+      return MongoPlan(self.update_type, (self.query, self.data), {'upsert': self.upsert})
     return None
 
 @as_form
@@ -316,14 +320,13 @@ class UpdateMany(BaseMongo):
   update_type: Literal['update_one', 'update_many'] = 'update_many'
   query: Optional[dict]
   data: dict
-  def buildExpression(self):
+  def buildPlan(self):
     if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
+      self.query = decode(self.collection, self.query)
     else:
       self.query = {}
     if self.data:
-      expr = f'entity.{self.update_type}({self.query}, {self.data})'
-      return expr
+      return MongoPlan(self.update_type, (self.query, self.data))
     return None
 
 @as_form
@@ -331,47 +334,43 @@ class Update(BaseMongo):
   update_type: Literal['update_one', 'update_many'] = 'update_one'
   query: Optional[dict]
   data: dict
-  def buildExpression(self):
+  def buildPlan(self):
     if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
+      self.query = decode(self.collection, self.query)
     else:
       self.query = {}
     if self.data:
-      expr = f'entity.{self.update_type}({self.query}, {self.data})'
-      return expr
+      return MongoPlan(self.update_type, (self.query, self.data))
     return None
 
 @as_form
 class Delete(BaseMongo):
   delete_type: Literal['delete_one', 'delete_many'] = 'delete_one'
   query: Optional[dict]
-  def buildExpression(self):
+  def buildPlan(self):
     if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
-      expr = f'entity.{self.delete_type}({self.query})'
-      return expr
+      self.query = decode(self.collection, self.query)
+      return MongoPlan(self.delete_type, (self.query,))
     return None
 
 @as_form
 class DeleteOne(BaseMongo):
   delete_type: Literal['delete_one', 'delete_many'] = 'delete_one'
   query: Optional[dict]
-  def buildExpression(self):
+  def buildPlan(self):
     if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
-      expr = f'entity.{self.delete_type}({self.query})'
-      return expr
+      self.query = decode(self.collection, self.query)
+      return MongoPlan(self.delete_type, (self.query,))
     return None
 
 @as_form
 class DeleteMany(BaseMongo):
   delete_type: Literal['delete_one', 'delete_many'] = 'delete_many'
   query: Optional[dict]
-  def buildExpression(self):
+  def buildPlan(self):
     if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
-      expr = f'entity.{self.delete_type}({self.query})'
-      return expr
+      self.query = decode(self.collection, self.query)
+      return MongoPlan(self.delete_type, (self.query,))
     return None
 
 @as_form
@@ -390,9 +389,9 @@ class BulkUpdate(BaseModel):
   bulk_type: Literal['update_one', 'update_many'] = 'update_one'
   query: dict
   data: dict
-  def buildWrite(self):
+  def buildWrite(self, collection: str = ''):
     if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
+      self.query = decode(collection, self.query)
     else:
       self.query = {}
     if self.bulk_type == 'update_many':
@@ -404,9 +403,9 @@ class BulkUpdate(BaseModel):
 class BulkDelete(BaseModel):
   bulk_type: Literal['delete_one', 'delete_many'] = 'delete_one'
   query: dict
-  def buildWrite(self):
+  def buildWrite(self, collection: str = ''):
     if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
+      self.query = decode(collection, self.query)
     else:
       self.query = {}
     if self.bulk_type == 'delete_many':
@@ -419,9 +418,9 @@ class BulkReplace(BaseModel):
   bulk_type: Literal['replace_one'] = 'replace_one'
   query: dict
   data: dict
-  def buildWrite(self):
+  def buildWrite(self, collection: str = ''):
     if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
+      self.query = decode(collection, self.query)
     else:
       self.query = {}
     result = BulkReplaceOne(self.query, self.data)
@@ -430,16 +429,16 @@ class BulkReplace(BaseModel):
 class BulkInsert(BaseModel):
   bulk_type: Literal['insert_one'] = 'insert_one'
   data: dict
-  def buildWrite(self):
+  def buildWrite(self, collection: str = ''):
     result = BulkInsertOne(self.data)
     return result
 
 class BulkCount(BaseModel):
   bulk_type: Literal['bulk_count'] = 'bulk_count'
   query: Optional[dict]
-  def buildWrite(self):
+  def buildWrite(self, collection: str = ''):
     if self.query and any(self.query):
-      self.query = json_to_mongo(self.query)
+      self.query = decode(collection, self.query)
     else:
       self.query = {}
     result = BulkInsertOne(self.data)
@@ -450,7 +449,7 @@ class BulkWrite(BaseMongo):
   def buildPayload(self):
     payload = []
     for x in self.batch:
-      obj = x.buildWrite()
+      obj = x.buildWrite(self.collection)
       payload.append(obj)
     return payload
 '''
@@ -461,4 +460,7 @@ class AggregatePipeline(BaseModel):
   aggregate: str
   pipeline: List[dict]
   cursor: dict
+  read_preference: Optional[ReadPreferenceMode]
+  default_read_preference: Optional[ReadPreferenceMode]
+  cache_ttl: Optional[float]  # seconds to cache the result; None: PIPELINE_CACHE_TTL, 0: never
 
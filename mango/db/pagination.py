@@ -0,0 +1,123 @@
+'''
+  Pagination
+
+  Keyset (cursor) pagination for find queries. A page is read by seeking past
+  the sort key values of the last row served instead of skipping an offset, so
+  deep pages cost the same as the first one. `_id` is appended to the sort as
+  a tie breaker, which makes the order total and every cursor unambiguous.
+
+  Cursors are opaque: the sort key values of a boundary row as canonical
+  extended JSON, base64url encoded. `after` continues forward from a row and
+  `before` walks back from it.
+'''
+import base64
+import binascii
+from collections.abc import Mapping
+from typing import List, Tuple
+from bson import json_util
+from bson.json_util import CANONICAL_JSON_OPTIONS
+
+SortSpec = List[Tuple[str, int]]
+
+
+def keyset_sort(sort: SortSpec = None) -> SortSpec:
+  sort = list(sort or [])
+  if not any(key == '_id' for key, _ in sort):
+    direction = sort[-1][1] if sort else 1
+    sort.append(('_id', direction))
+  return sort
+
+def reverse_sort(sort: SortSpec) -> SortSpec:
+  return [(key, -direction) for key, direction in sort]
+
+def get_path(doc: dict, key: str):
+  value = doc
+  for part in key.split('.'):
+    if not isinstance(value, Mapping):
+      return None
+    value = value.get(part)
+  return value
+
+def encode_cursor(doc: dict, sort: SortSpec) -> str:
+  values = [get_path(doc, key) for key, _ in sort]
+  raw = json_util.dumps(values, json_options=CANONICAL_JSON_OPTIONS)
+  return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str, sort: SortSpec) -> list:
+  try:
+    raw = base64.urlsafe_b64decode(cursor.encode('ascii'))
+    values = json_util.loads(raw)
+  except (binascii.Error, UnicodeError, ValueError) as e:
+    raise ValueError(f'Invalid page cursor: {cursor}') from e
+  if not isinstance(values, list) or len(values) != len(sort):
+    raise ValueError(f'Invalid page cursor: {cursor}')
+  return values
+
+def seek_clause(key: str, value, ascending: bool):
+  '''
+    The condition on `key` for rows past `value`. MongoDB sorts null and
+    missing values before everything else, which $gt / $lt alone miss: past
+    a null comes every non-null value going up and nothing going down, and
+    going down from a value the nulls still follow. None when no row can be
+    past `value`.
+  '''
+  if value is None:
+    return {key: {'$ne': None}} if ascending else None
+  if ascending:
+    return {key: {'$gt': value}}
+  return {'$or': [{key: {'$lt': value}}, {key: None}]}
+
+def keyset_filter(sort: SortSpec, values: list, before: bool = False) -> dict:
+  '''
+    Matches the rows strictly after (or before) the row holding `values`.
+  '''
+  clauses = []
+  for position, (key, direction) in enumerate(sort):
+    ascending = direction > 0
+    if before:
+      ascending = not ascending
+    seek = seek_clause(key, values[position], ascending)
+    if seek is None:
+      continue
+    clause = {sort[i][0]: values[i] for i in range(position)}
+    clause.update(seek)
+    clauses.append(clause)
+  if not clauses:
+    return {'_id': {'$exists': False}}
+  if len(clauses) == 1:
+    return clauses[0]
+  return {'$or': clauses}
+
+def keyset_projection(projection: dict, sort: SortSpec) -> dict:
+  '''
+    Keeps the sort keys in the results so the boundary rows can be encoded.
+  '''
+  if not projection:
+    return projection
+  if any(value for key, value in projection.items() if key != '_id'):
+    projection = dict(projection)
+    for key, _ in sort:
+      projection[key] = 1
+    return projection
+  return {key: value for key, value in projection.items() if key not in dict(sort)}
+
+def build_page(docs: list, sort: SortSpec, limit: int = 0, after: str = None, before: str = None) -> dict:
+  '''
+    Trims the look-ahead row fetched past `limit`, restores the requested
+    order for `before` pages and computes the neighbouring cursors.
+  '''
+  has_more = bool(limit) and len(docs) > limit
+  if has_more:
+    docs = docs[:limit]
+  if before:
+    docs = docs[::-1]
+    has_next = True
+    has_previous = has_more
+  else:
+    has_next = has_more
+    has_previous = bool(after)
+  return {
+    'data': docs,
+    'next': encode_cursor(docs[-1], sort) if docs and has_next else None,
+    'previous': encode_cursor(docs[0], sort) if docs and has_previous else None,
+  }
@@ -0,0 +1,228 @@
+'''
+  Pool
+
+  One process-wide MongoClient and AsyncIOMotorClient shared by every db module.
+  Clients are created lazily on first use, so importing mango does not resolve
+  DNS or open sockets. Call init_pool() from the application's startup event
+  to connect and warm the pools before serving.
+
+  Wire compression between the app and MongoDB is negotiated with the server
+  from DATABASE_COMPRESSORS, in order of preference. zstd needs the zstandard
+  package and snappy python-snappy (`pip install mango[compression]`); the
+  ones that are not installed are left out, zlib is always available.
+  wire_compression_stats() reads the bytes each compressor saved from the
+  server's serverStatus.
+
+  Settings (environment):
+    DATABASE_URI                          full connection string, overrides the cluster settings
+    DATABASE_MAX_POOL_SIZE                maxPoolSize (default 100)
+    DATABASE_MIN_POOL_SIZE                minPoolSize (default 0)
+    DATABASE_MAX_IDLE_TIME_MS             maxIdleTimeMS
+    DATABASE_CONNECT_TIMEOUT_MS           connectTimeoutMS
+    DATABASE_SOCKET_TIMEOUT_MS            socketTimeoutMS
+    DATABASE_SERVER_SELECTION_TIMEOUT_MS  serverSelectionTimeoutMS
+    DATABASE_WAIT_QUEUE_TIMEOUT_MS        waitQueueTimeoutMS
+    DATABASE_COMPRESSORS                  compressors, '' to turn wire compression off (default zstd,snappy,zlib)
+    DATABASE_ZLIB_COMPRESSION_LEVEL       zlibCompressionLevel, -1 to 9 (default -1, zlib's default)
+'''
+import importlib.util
+import os
+import threading
+from pymongo import MongoClient, monitoring
+from pymongo.errors import PyMongoError
+from motor.motor_asyncio import AsyncIOMotorClient
+
+DATABASE_CLUSTER = os.environ.get('DATABASE_CLUSTER')
+DATABASE_USERNAME = os.environ.get('DATABASE_USERNAME')
+DATABASE_PASSWORD = os.environ.get('DATABASE_PASSWORD')
+DATABASE_NAME = os.environ.get('DATABASE_NAME')
+DATABASE_URI = os.environ.get('DATABASE_URI')
+DATABASE_COMPRESSORS = os.environ.get('DATABASE_COMPRESSORS', 'zstd,snappy,zlib')
+DATABASE_ZLIB_COMPRESSION_LEVEL = int(os.environ.get('DATABASE_ZLIB_COMPRESSION_LEVEL', -1))
+COMPRESSOR_MODULES = {
+  'zstd': 'zstandard',
+  'snappy': 'snappy',
+  'zlib': 'zlib',
+}
+
+POOL_SETTINGS = {
+  'maxPoolSize': ('DATABASE_MAX_POOL_SIZE', 100),
+  'minPoolSize': ('DATABASE_MIN_POOL_SIZE', 0),
+  'maxIdleTimeMS': ('DATABASE_MAX_IDLE_TIME_MS', None),
+  'connectTimeoutMS': ('DATABASE_CONNECT_TIMEOUT_MS', None),
+  'socketTimeoutMS': ('DATABASE_SOCKET_TIMEOUT_MS', None),
+  'serverSelectionTimeoutMS': ('DATABASE_SERVER_SELECTION_TIMEOUT_MS', None),
+  'waitQueueTimeoutMS': ('DATABASE_WAIT_QUEUE_TIMEOUT_MS', None),
+}
+
+_lock = threading.Lock()
+_client = None
+_async_client = None
+
+
+class PoolStatsListener(monitoring.ConnectionPoolListener):
+  '''
+    Counts connection pool events for one client.
+  '''
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.counters = {
+      'pools_created': 0,
+      'pools_cleared': 0,
+      'connections_created': 0,
+      'connections_closed': 0,
+      'check_outs': 0,
+      'check_ins': 0,
+      'check_out_failures': 0,
+    }
+
+  def _inc(self, name):
+    with self._lock:
+      self.counters[name] += 1
+
+  def pool_created(self, event):
+    self._inc('pools_created')
+
+  def pool_ready(self, event):
+    pass
+
+  def pool_cleared(self, event):
+    self._inc('pools_cleared')
+
+  def pool_closed(self, event):
+    pass
+
+  def connection_created(self, event):
+    self._inc('connections_created')
+
+  def connection_ready(self, event):
+    pass
+
+  def connection_closed(self, event):
+    self._inc('connections_closed')
+
+  def connection_check_out_started(self, event):
+    pass
+
+  def connection_check_out_failed(self, event):
+    self._inc('check_out_failures')
+
+  def connection_checked_out(self, event):
+    self._inc('check_outs')
+
+  def connection_checked_in(self, event):
+    self._inc('check_ins')
+
+  def stats(self):
+    with self._lock:
+      stats = dict(self.counters)
+    stats['open_connections'] = stats['connections_created'] - stats['connections_closed']
+    stats['in_use'] = stats['check_outs'] - stats['check_ins']
+    return stats
+
+
+sync_listener = PoolStatsListener()
+async_listener = PoolStatsListener()
+
+
+def get_uri():
+  if DATABASE_URI:
+    return DATABASE_URI
+  return f'mongodb+srv://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_CLUSTER}.mongodb.net/{DATABASE_NAME}?retryWrites=true&w=majority'
+
+def get_compressors(names: str = DATABASE_COMPRESSORS):
+  '''
+    The configured wire compressors whose libraries are installed.
+  '''
+  compressors = []
+  for name in (names or '').split(','):
+    name = name.strip().lower()
+    module = COMPRESSOR_MODULES.get(name)
+    if module and name not in compressors and importlib.util.find_spec(module) is not None:
+      compressors.append(name)
+  return compressors
+
+def get_pool_options():
+  options = {}
+  for option, (env_name, default) in POOL_SETTINGS.items():
+    value = os.environ.get(env_name, default)
+    if value is not None:
+      options[option] = int(value)
+  compressors = get_compressors()
+  if compressors:
+    options['compressors'] = ','.join(compressors)
+    if 'zlib' in compressors:
+      options['zlibCompressionLevel'] = DATABASE_ZLIB_COMPRESSION_LEVEL
+  return options
+
+def get_client():
+  global _client
+  if _client is None:
+    with _lock:
+      if _client is None:
+        _client = MongoClient(get_uri(), event_listeners=[sync_listener], **get_pool_options())
+  return _client
+
+def get_async_client():
+  global _async_client
+  if _async_client is None:
+    with _lock:
+      if _async_client is None:
+        _async_client = AsyncIOMotorClient(get_uri(), event_listeners=[async_listener], **get_pool_options())
+  return _async_client
+
+def warm_pool():
+  get_client().admin.command('ping')
+
+async def warm_async_pool():
+  await get_async_client().admin.command('ping')
+
+async def init_pool():
+  warm_pool()
+  await warm_async_pool()
+
+def pool_stats():
+  return {
+    'options': get_pool_options(),
+    'sync': sync_listener.stats() if _client is not None else None,
+    'async': async_listener.stats() if _async_client is not None else None,
+  }
+
+def wire_compression_stats():
+  '''
+    Bytes in and out of each wire compressor as the server counts them, for
+    every client of the server. ratio is uncompressed / compressed bytes.
+  '''
+  try:
+    status = get_client().admin.command('serverStatus')
+  except PyMongoError as e:
+    return {'compressors': get_compressors(), 'error': str(e)}
+  compression = status.get('network', {}).get('compression', {})
+  stats = {}
+  for name, directions in compression.items():
+    stats[name] = {}
+    for direction in ('compressor', 'decompressor'):
+      counts = directions.get(direction, {})
+      bytes_in = counts.get('bytesIn', 0)
+      bytes_out = counts.get('bytesOut', 0)
+      if direction == 'compressor':
+        uncompressed, compressed = bytes_in, bytes_out
+      else:
+        uncompressed, compressed = bytes_out, bytes_in
+      stats[name][direction] = {
+        'uncompressed_bytes': uncompressed,
+        'compressed_bytes': compressed,
+        'ratio': uncompressed / compressed if compressed else 0.0,
+      }
+  return {'compressors': get_compressors(), 'server': stats}
+
+def close_pool():
+  global _client
+  global _async_client
+  with _lock:
+    if _client is not None:
+      _client.close()
+      _client = None
+    if _async_client is not None:
+      _async_client.close()
+      _async_client = None
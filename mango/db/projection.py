@@ -0,0 +1,93 @@
+'''
+  Projection
+
+  Builds the projections list views push down to find(), so only the columns
+  a page renders travel over the wire, and keeps per-collection numbers on
+  what that saved.
+
+  Savings are estimated: the full documents are never fetched, so a page is
+  compared with the collection's average document size (collStats
+  avgObjSize, cached for PROJECTION_STATS_TTL seconds).
+
+  Settings (environment):
+    PROJECTION_STATS_TTL  seconds to keep a collection's average size (default 300)
+'''
+import os
+import threading
+import time
+from typing import List
+import bson
+from bson.errors import InvalidDocument
+from pymongo.errors import PyMongoError
+
+PROJECTION_STATS_TTL = float(os.environ.get('PROJECTION_STATS_TTL', 300))
+
+
+def build_projection(fields: List[str]):
+  '''
+    An inclusion projection for `fields`. Paths under an included parent are
+    dropped, since MongoDB rejects overlapping paths.
+  '''
+  names = sorted(set(x for x in fields if x))
+  projection = {}
+  for name in names:
+    if any(name.startswith(f'{parent}.') for parent in projection):
+      continue
+    projection[name] = 1
+  return projection
+
+def document_size(doc: dict):
+  try:
+    return len(bson.encode(doc))
+  except (InvalidDocument, TypeError):
+    return 0
+
+
+class ProjectionStats():
+
+  def __init__(self, ttl: float = PROJECTION_STATS_TTL):
+    self.ttl = ttl
+    self.collections = {}
+    self.average_sizes = {}
+    self._lock = threading.Lock()
+
+  async def average_size(self, db, collection: str):
+    key = (db.name, collection)
+    cached = self.average_sizes.get(key)
+    if cached and cached[0] > time.monotonic():
+      return cached[1]
+    try:
+      stats = await db.command('collStats', collection)
+      size = stats.get('avgObjSize', 0)
+    except PyMongoError:
+      size = 0
+    self.average_sizes[key] = (time.monotonic() + self.ttl, size)
+    return size
+
+  async def record(self, db, collection: str, docs: List[dict]):
+    '''
+      Adds a projected page to the collection's totals and returns the
+      estimated bytes it saved.
+    '''
+    received = sum(document_size(doc) for doc in docs)
+    average = await self.average_size(db, collection)
+    saved = max(average * len(docs) - received, 0) if average else 0
+    with self._lock:
+      stats = self.collections.setdefault(collection, {'pages': 0, 'documents': 0, 'bytes_received': 0, 'bytes_saved': 0})
+      stats['pages'] += 1
+      stats['documents'] += len(docs)
+      stats['bytes_received'] += received
+      stats['bytes_saved'] += saved
+    return saved
+
+  def stats(self):
+    with self._lock:
+      collections = {name: dict(stats) for name, stats in self.collections.items()}
+    return {
+      'collections': collections,
+      'bytes_received': sum(x['bytes_received'] for x in collections.values()),
+      'bytes_saved': sum(x['bytes_saved'] for x in collections.values()),
+    }
+
+
+projection_stats = ProjectionStats()
@@ -1,273 +1,451 @@
+import asyncio
 import datetime
 import json, os
+from concurrent.futures import ThreadPoolExecutor
 from decimal import *
 from typing import (
     Deque, Dict, FrozenSet, List, Optional, Sequence, Set, Tuple, Union
 )
-from fastapi import APIRouter, Depends, HTTPException
-from pymongo import MongoClient
+from fastapi import APIRouter, Depends, HTTPException, Request
 from bson import json_util, ObjectId, Decimal128
 
 DATABASE_CLUSTER = os.environ.get('DATABASE_CLUSTER')
 DATABASE_USERNAME = os.environ.get('DATABASE_USERNAME')
 DATABASE_PASSWORD = os.environ.get('DATABASE_PASSWORD')
 DATABASE_NAME = os.environ.get('DATABASE_NAME')
+BULK_READ_WORKERS = int(os.environ.get('BULK_READ_WORKERS', 8))
 
-from mango.db.models import convert_dates_to_datetime, datetime_parser, json_from_mongo, mongo_to_json, Query, QueryOne, Count, InsertOne, InsertMany, Update, UpdateOne, UpdateMany, Delete, DeleteOne, DeleteMany, BulkWrite, AggregatePipeline
+from mango.db.batch import can_fold, fold_pipeline, unfold_results
+from mango.db.bson_response import accepts_bson, bson_response, raw_collection, BSON_SEQ_MEDIA_TYPE
+from mango.db.bulk import run_bulk_write, stream_bulk_write, BULK_WRITE_CHUNK_SIZE, BULK_WRITE_CONCURRENCY
+from mango.db.cache import pipeline_cache, query_cache
+from mango.db.counts import run_count, run_count_async
+from mango.db.executor import execute, execute_async, execute_plan, execute_plan_async, fetch_plan, open_cursor
+from mango.db.index_advisor import index_advisor  # registers the index advisor sink
+from mango.db.ingest import get_ingest_format, ingest_stream, IngestFormat, INGEST_BATCH_SIZE, INGEST_CONCURRENCY
+from mango.db.metadata_version import bump_after_stream, metadata_written, metadata_written_sync
+from mango.db.metrics import instrument
+from mango.db.models import convert_dates_to_datetime, datetime_parser, decode_dates, json_from_mongo, mongo_to_json, Query, QueryOne, Count, InsertOne, InsertMany, Update, UpdateOne, UpdateMany, Delete, DeleteOne, DeleteMany, BulkWrite, AggregatePipeline
+from mango.db.routing import read_collection, resolve_read_preference
+from mango.db.serializers import json_response, to_jsonable
+from mango.db.single_flight import single_flight
+from mango.db.slow_queries import slow_query_log  # registers the slow-query sink
+from mango.db.streaming import encode_document, encode_extended_document, stream_cursor, StreamFormat, STREAM_BATCH_SIZE
+from mango.db.tenants import get_async_database, get_collection, get_database, tenant_limited
 
-uri = f'mongodb+srv://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_CLUSTER}.mongodb.net/{DATABASE_NAME}?retryWrites=true&w=majority'
-# uri = f'mongodb://summit.local:27017/?serverSelectionTimeoutMS=5000&connectTimeoutMS=10000&3t.uriVersion=3&3t.connection.name=Local+Dev&3t.alwaysShowAuthDB=true&3t.alwaysShowDBFromUserRole=true'
-client = MongoClient(uri)
-db = client.test
 
-print(uri)
+bulk_read_pool = ThreadPoolExecutor(max_workers=BULK_READ_WORKERS)
 
 router = APIRouter(
   prefix = '/rest',
   tags = ['Mongodon']
 )
 
+# Read endpoints receive `request` only when FastAPI dispatches them; they then
+# return pre-encoded responses. Python callers get plain objects back. Callers
+# that accept application/bson get the raw BSON documents instead.
+
 @router.post('/find')
-async def find(query: Query, keep_native:bool = False):
-  query.query = convert_dates_to_datetime(query.query)
+@instrument
+@tenant_limited
+async def find(query: Query, keep_native:bool = False, stream:bool = False, stream_format:StreamFormat = 'ndjson', batch_size:int = STREAM_BATCH_SIZE, request:Request = None):
+  query.query = decode_dates(query.collection, query.query)
   database = query.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = query.buildExpression()
-  entity = db[query.collection]
-  cursor = eval(expr)
-  results = list(cursor)
+  db = get_async_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='find', default=query.default_read_preference)
+  accept = accepts_bson(request)
+  if accept == BSON_SEQ_MEDIA_TYPE:
+    stream, stream_format = True, 'bson'
+  raw = bool(accept) or (stream and stream_format == 'bson')
+  if raw:
+    entity = raw_collection(entity)
+  if stream and query.query_type == 'find' and not query.isPaged():
+    cursor = open_cursor(entity, query, batch_size=batch_size)
+    return stream_cursor(cursor, encode=encode_document, stream_format=stream_format, batch_size=batch_size)
+  try:
+    plan = query.buildPlan()
+  except ValueError as e:
+    raise HTTPException(status_code=400, detail=str(e))
+  if raw:
+    results = await execute_plan_async(entity, plan)
+    if query.isPaged():
+      results = query.buildPage(results)
+    return bson_response(results)
   if keep_native:
-    data = results
-  else:
-    data = json.loads(json.dumps(results, default=json_from_mongo))
+    results = await execute_plan_async(entity, plan)
+    if query.isPaged():
+      return query.buildPage(results)
+    return results
+  key = query_cache.key(database, query.collection, plan, read_preference=entity.read_preference.document)
+  hit, data = query_cache.get(key, copy=not request)
+  if not hit:
+    results = await single_flight.run(single_flight.plan_key(database, entity, plan), lambda: execute_plan_async(entity, plan))
+    if query.isPaged():
+      results = query.buildPage(results)
+    data = to_jsonable(results)
+    query_cache.set(key, data)
+  if request:
+    return json_response(data)
   return data
 
+@instrument
+@tenant_limited
 def find_sync(query: Query):
-  query.query = convert_dates_to_datetime(query.query)
+  query.query = decode_dates(query.collection, query.query)
   database = query.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = query.buildExpression()
-  entity = db[query.collection]
-  cursor = eval(expr)
-  results = list(cursor)
-  data = json.loads(json.dumps(results, default=json_from_mongo))
+  db = get_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='find', default=query.default_read_preference)
+  plan = query.buildPlan()
+  key = query_cache.key(database, query.collection, plan, read_preference=entity.read_preference.document)
+  hit, data = query_cache.get(key)
+  if not hit:
+    results = single_flight.run_sync(single_flight.plan_key(database, entity, plan), lambda: fetch_plan(entity, plan))
+    if query.isPaged():
+      results = query.buildPage(results)
+    data = to_jsonable(results)
+    query_cache.set(key, data)
   return data
 
+@instrument
+@tenant_limited
 def find_one_sync(query: Query):
-  query.query = convert_dates_to_datetime(query.query)
+  query.query = decode_dates(query.collection, query.query)
   database = query.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = query.buildExpression()
-  entity = db[query.collection]
-  result = eval(expr)
-  data = json.loads(json.dumps(result, default=json_from_mongo))
+  db = get_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='find_one', default=query.default_read_preference)
+  plan = query.buildPlan()
+  key = query_cache.key(database, query.collection, plan, read_preference=entity.read_preference.document)
+  hit, data = query_cache.get(key)
+  if not hit:
+    result = single_flight.run_sync(single_flight.plan_key(database, entity, plan), lambda: fetch_plan(entity, plan))
+    data = to_jsonable(result)
+    query_cache.set(key, data)
   return data
 
+@instrument
+@tenant_limited
 def insert_one_sync(payload: InsertOne):
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_database(database)
+  entity = get_collection(db, payload.collection)
+  result = execute(entity, payload)
+  query_cache.bump(database, payload.collection)
+  metadata_written_sync(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'inserted_id': result.inserted_id}))
   return data
 
-def bulk_read_sync(batch: List[Union[Query, QueryOne]]):
-  payload = []
-  for query in batch:
-    database = query.database
-    if not database:
-      database = DATABASE_NAME
-    db = client[database]
-    expr = query.buildExpression()
-    entity = db[query.collection]
-    cursor = eval(expr)
-    if query.query_type == 'find_one':
-      results = cursor
-    else:
-      results = list(cursor)
-    data = json.loads(json.dumps(results, default=json_from_mongo))
-    payload.append(data)
-  return payload
+def read_one_sync(query: Union[Query, QueryOne]):
+  database = query.database
+  if not database:
+    database = DATABASE_NAME
+  db = get_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='bulk_read', default=query.default_read_preference)
+  plan = query.buildPlan()
+  key = query_cache.key(database, query.collection, plan, read_preference=entity.read_preference.document)
+  hit, data = query_cache.get(key)
+  if not hit:
+    results = single_flight.run_sync(single_flight.plan_key(database, entity, plan), lambda: fetch_plan(entity, plan))
+    if query.isPaged():
+      results = query.buildPage(results)
+    data = to_jsonable(results)
+    query_cache.set(key, data)
+  return data
+
+def bulk_read_folded_sync(batch: List[Union[Query, QueryOne]]):
+  plans = [query.buildPlan() for query in batch]
+  collection, pipeline = fold_pipeline(batch, plans)
+  database = batch[0].database or DATABASE_NAME
+  entity = read_collection(get_database(database), collection, batch[0].read_preference, endpoint='bulk_read', default=batch[0].default_read_preference)
+  docs = list(entity.aggregate(pipeline))
+  return to_jsonable(unfold_results(plans, docs))
+
+@instrument
+@tenant_limited
+def bulk_read_sync(batch: List[Union[Query, QueryOne]], fold: bool = False):
+  if fold and can_fold(batch, DATABASE_NAME):
+    return bulk_read_folded_sync(batch)
+  return list(bulk_read_pool.map(read_one_sync, batch))
 
+@instrument
+@tenant_limited
 def run_pipeline_sync(ap: AggregatePipeline):
   ap.pipeline = json.loads(json_util.dumps(ap.pipeline), object_hook=datetime_parser)
   database = ap.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
+  db = get_database(database)
   command = {"aggregate": ap.aggregate, "pipeline": ap.pipeline, "cursor": ap.cursor}
-  result = db.command(command)  
-  data = json.loads(json_util.dumps(result), object_hook=json_from_mongo)
+  preference = resolve_read_preference(ap.aggregate, ap.read_preference, endpoint='run_pipeline', default=ap.default_read_preference)
+  cache_key = pipeline_cache.key(database, ap.aggregate, ap.pipeline, variant=['command', ap.cursor], ttl=ap.cache_ttl, read_preference=preference.document)
+  hit, data = pipeline_cache.get(cache_key)
+  if hit:
+    return data
+  key = single_flight.key(database, ap.aggregate, command, preference.document, pipeline_cache.pipeline_generations(database, ap.aggregate, ap.pipeline))
+  result = single_flight.run_sync(key, lambda: db.command(command, read_preference=preference))
+  data = to_jsonable(result, extended=True)
+  pipeline_cache.set(cache_key, data, ttl=ap.cache_ttl)
   return data
 
 @router.post('/findOne')
-async def find_one(query: QueryOne, keep_native:bool = False):
-  query.query = convert_dates_to_datetime(query.query)
+@instrument
+@tenant_limited
+async def find_one(query: QueryOne, keep_native:bool = False, request:Request = None):
+  query.query = decode_dates(query.collection, query.query)
   database = query.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = query.buildExpression()
-  entity = db[query.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='find_one', default=query.default_read_preference)
+  if accepts_bson(request):
+    return bson_response(await execute_async(raw_collection(entity), query))
   if keep_native:
-    data = result
-  else:
-    data = json.loads(json.dumps(result, default=json_from_mongo))
+    return await execute_async(entity, query)
+  plan = query.buildPlan()
+  key = query_cache.key(database, query.collection, plan, read_preference=entity.read_preference.document)
+  hit, data = query_cache.get(key, copy=not request)
+  if not hit:
+    result = await single_flight.run(single_flight.plan_key(database, entity, plan), lambda: execute_plan_async(entity, plan))
+    data = to_jsonable(result)
+    query_cache.set(key, data)
+  if request:
+    return json_response(data)
   return data
 
 @router.post('/count')
+@instrument
+@tenant_limited
 async def count(query: Count):
   database = query.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = query.buildExpression()
-  entity = db[query.collection]
-  result = eval(expr)
-  data = json.loads(json.dumps(result, default=json_from_mongo))
-  return {'count': data}
+  db = get_async_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='count', default=query.default_read_preference)
+  result, mode = await run_count_async(entity, database, query)
+  return {'count': result, 'mode': mode}
+
+@instrument
+@tenant_limited
+def count_sync(query: Count):
+  database = query.database
+  if not database:
+    database = DATABASE_NAME
+  db = get_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='count', default=query.default_read_preference)
+  result, mode = run_count(entity, database, query)
+  return {'count': result, 'mode': mode}
+
+async def read_one(query: Union[Query, QueryOne]):
+  database = query.database
+  if not database:
+    database = DATABASE_NAME
+  db = get_async_database(database)
+  entity = read_collection(db, query.collection, query.read_preference, endpoint='bulk_read', default=query.default_read_preference)
+  plan = query.buildPlan()
+  key = query_cache.key(database, query.collection, plan, read_preference=entity.read_preference.document)
+  hit, data = query_cache.get(key)
+  if not hit:
+    results = await single_flight.run(single_flight.plan_key(database, entity, plan), lambda: execute_plan_async(entity, plan))
+    if query.isPaged():
+      results = query.buildPage(results)
+    data = to_jsonable(results)
+    query_cache.set(key, data)
+  return data
+
+async def bulk_read_folded(batch: List[Union[Query, QueryOne]]):
+  plans = [query.buildPlan() for query in batch]
+  collection, pipeline = fold_pipeline(batch, plans)
+  database = batch[0].database or DATABASE_NAME
+  entity = read_collection(get_async_database(database), collection, batch[0].read_preference, endpoint='bulk_read', default=batch[0].default_read_preference)
+  docs = await entity.aggregate(pipeline).to_list(length=None)
+  return unfold_results(plans, docs)
 
 @router.post('/bulkRead')
-async def bulk_read(batch: List[Union[Query, QueryOne]]):
-  payload = []
-  for query in batch:
-    database = query.database
-    if not database:
-      database = DATABASE_NAME
-    db = client[database]
-    expr = query.buildExpression()
-    entity = db[query.collection]
-    cursor = eval(expr)
-    if isinstance(query, Query):
-      results = list(cursor)
-      data = json.loads(json.dumps(results, default=json_from_mongo))
-    else:
-      data = json.loads(json.dumps(cursor, default=json_from_mongo))
-    payload.append(data)
-  return payload
+@instrument
+@tenant_limited
+async def bulk_read(batch: List[Union[Query, QueryOne]], fold:bool = False, request:Request = None):
+  '''
+    Runs the queries concurrently, or as one $unionWith aggregation when fold
+    is set and every query targets the same database. Results keep input order.
+  '''
+  if fold and can_fold(batch, DATABASE_NAME):
+    payload = await bulk_read_folded(batch)
+  else:
+    payload = await asyncio.gather(*[read_one(query) for query in batch])
+  if request:
+    return json_response(payload)
+  return to_jsonable(payload)
 
 @router.post('/insertOne')
+@instrument
+@tenant_limited
 async def insert_one(payload: InsertOne):
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'inserted_id': result.inserted_id}))
   return data
 
 @router.post('/insertMany')
+@instrument
+@tenant_limited
 async def insert_many(payload: InsertMany):
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'inserted_ids': result.inserted_ids}))
   return data
 
+@router.post('/ingest')
+@instrument
+@tenant_limited
+async def ingest(request: Request, collection: str, database: str = '', ingest_format: Optional[IngestFormat] = None, delimiter: str = ',', batch_size: int = INGEST_BATCH_SIZE, concurrency: int = INGEST_CONCURRENCY):
+  '''
+    Streams an NDJSON or CSV body into a collection. The format defaults to
+    the request's Content-Type (text/csv or application/x-ndjson).
+  '''
+  if not database:
+    database = DATABASE_NAME
+  if not ingest_format:
+    ingest_format = get_ingest_format(request.headers.get('content-type'))
+  db = get_async_database(database)
+  entity = get_collection(db, collection)
+  on_chunk = lambda summary: query_cache.bump(database, collection)
+  result = await ingest_stream(entity, collection, request.stream(), ingest_format=ingest_format, delimiter=delimiter, batch_size=batch_size, concurrency=concurrency, on_chunk=on_chunk)
+  await metadata_written(database, collection)
+  data = json.loads(json_util.dumps(result))
+  return data
+
 @router.post('/update')
+@instrument
+@tenant_limited
 async def update(payload: Update):
-  payload.query = convert_dates_to_datetime(payload.query)
+  payload.query = decode_dates(payload.collection, payload.query)
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'matched_count': result.matched_count, 'modified_count': result.modified_count}))
   return data
 
 @router.post('/updateOne')
+@instrument
+@tenant_limited
 async def update_one(payload: UpdateOne):
-  payload.query = convert_dates_to_datetime(payload.query)
+  payload.query = decode_dates(payload.collection, payload.query)
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'matched_count': result.matched_count, 'modified_count': result.modified_count}))
   return data
 
 @router.post('/updateMany')
+@instrument
+@tenant_limited
 async def update_many(payload: UpdateMany):
-  payload.query = convert_dates_to_datetime(payload.query)
+  payload.query = decode_dates(payload.collection, payload.query)
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'matched_count': result.matched_count, 'modified_count': result.modified_count}))
   return data
 
 @router.post('/delete')
+@instrument
+@tenant_limited
 async def delete(payload: Delete):
-  payload.query = convert_dates_to_datetime(payload.query)
+  payload.query = decode_dates(payload.collection, payload.query)
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'deleted_count': result.deleted_count}))
   return data
 
 @router.post('/deleteOne')
+@instrument
+@tenant_limited
 async def delete_one(payload: DeleteOne):
-  payload.query = convert_dates_to_datetime(payload.query)
+  payload.query = decode_dates(payload.collection, payload.query)
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'deleted_count': result.deleted_count}))
   return data
 
 @router.post('/deleteMany')
+@instrument
+@tenant_limited
 async def delete_many(payload: DeleteMany):
-  payload.query = convert_dates_to_datetime(payload.query)
+  payload.query = decode_dates(payload.collection, payload.query)
   database = payload.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  expr = payload.buildExpression()
-  entity = db[payload.collection]
-  result = eval(expr)
+  db = get_async_database(database)
+  entity = get_collection(db, payload.collection)
+  result = await execute_async(entity, payload)
+  query_cache.bump(database, payload.collection)
+  await metadata_written(database, payload.collection)
   data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'deleted_count': result.deleted_count}))
   return data
 
 @router.post('/bulkWrite')
-async def bulk_write(batch: BulkWrite):
+@instrument
+@tenant_limited
+async def bulk_write(batch: BulkWrite, ordered:bool = False, chunk_size:int = BULK_WRITE_CHUNK_SIZE, concurrency:int = BULK_WRITE_CONCURRENCY, progress:bool = False):
   database = batch.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  entity = db[batch.collection]
+  db = get_async_database(database)
+  entity = get_collection(db, batch.collection)
   payload = batch.buildPayload()
-  result = entity.bulk_write(payload)
-  data = json.loads(json_util.dumps({'acknowledged': result.acknowledged, 'deleted_count': result.deleted_count, 'inserted_count': result.inserted_count, 'matched_count': result.matched_count, 'modified_count': result.modified_count, 'upserted_count': result.upserted_count, 'upserted_ids': result.upserted_ids}))
+  on_chunk = lambda summary: query_cache.bump(database, batch.collection)
+  if progress:
+    response = stream_bulk_write(entity, payload, chunk_size=chunk_size, ordered=ordered, concurrency=concurrency, on_chunk=on_chunk)
+    return bump_after_stream(response, database, batch.collection)
+  result = await run_bulk_write(entity, payload, chunk_size=chunk_size, ordered=ordered, concurrency=concurrency, on_chunk=on_chunk)
+  await metadata_written(database, batch.collection)
+  data = json.loads(json_util.dumps(result))
   return data
 
 # @router.post('/runPipeline')
@@ -276,21 +454,42 @@ async def bulk_write(batch: BulkWrite):
 #   database = ap.database
 #   if not database:
 #     database = DATABASE_NAME
-#   db = client[database]
+#   db = get_client()[database]
 #   command = {"aggregate": ap.aggregate, "pipeline": ap.pipeline, "cursor": ap.cursor}
 #   result = db.command(command)
 #   data = json.loads(json_util.dumps(result), object_hook=json_from_mongo)
 #   return data
 
 @router.post('/runPipeline')
-async def run_pipeline(ap: AggregatePipeline):
+@instrument
+@tenant_limited
+async def run_pipeline(ap: AggregatePipeline, stream:bool = False, stream_format:StreamFormat = 'ndjson', batch_size:int = STREAM_BATCH_SIZE, request:Request = None):
   ap.pipeline = json.loads(json_util.dumps(ap.pipeline), object_hook=datetime_parser)
   database = ap.database
   if not database:
     database = DATABASE_NAME
-  db = client[database]
-  entity = db[ap.aggregate]
-  cursor = entity.aggregate(ap.pipeline)
-  result = list(cursor)
-  data = json.loads(json_util.dumps(result), object_hook=json_from_mongo)
+  db = get_async_database(database)
+  entity = read_collection(db, ap.aggregate, ap.read_preference, endpoint='run_pipeline', default=ap.default_read_preference)
+  accept = accepts_bson(request)
+  if accept == BSON_SEQ_MEDIA_TYPE:
+    stream, stream_format = True, 'bson'
+  raw = bool(accept) or (stream and stream_format == 'bson')
+  if raw:
+    entity = raw_collection(entity)
+  if stream:
+    cursor = entity.aggregate(ap.pipeline, batchSize=batch_size)
+    return stream_cursor(cursor, encode=encode_extended_document, stream_format=stream_format, batch_size=batch_size)
+  if raw:
+    return bson_response(await entity.aggregate(ap.pipeline).to_list(length=None))
+  cache_key = pipeline_cache.key(database, ap.aggregate, ap.pipeline, variant='list', ttl=ap.cache_ttl, read_preference=entity.read_preference.document)
+  hit, data = pipeline_cache.get(cache_key, copy=not request)
+  if not hit:
+    key = single_flight.key(database, ap.aggregate, ap.pipeline, entity.read_preference.document, pipeline_cache.pipeline_generations(database, ap.aggregate, ap.pipeline))
+    result = await single_flight.run(key, lambda: entity.aggregate(ap.pipeline).to_list(length=None))
+    if cache_key is None and request:
+      return json_response(result, extended=True)
+    data = to_jsonable(result, extended=True)
+    pipeline_cache.set(cache_key, data, ttl=ap.cache_ttl)
+  if request:
+    return json_response(data)
   return data
@@ -0,0 +1,114 @@
+'''
+  Routing
+
+  Picks the read preference each read runs with, so list and search traffic
+  can be served by secondaries while read-after-write paths stay on the
+  primary. The first of these that is set wins:
+    1. primary, when the request pinned its reads with pin_primary_reads()
+       or primary_reads() (read-after-write paths such as BaseView.post)
+    2. the request model's read_preference
+    3. the collection's mode, DATABASE_READ_PREFERENCE_COLLECTIONS
+    4. the request model's default_read_preference
+    5. the endpoint's mode, DATABASE_READ_PREFERENCE_ENDPOINTS
+    6. DATABASE_READ_PREFERENCE
+  Every mode other than primary is bounded by DATABASE_MAX_STALENESS_SECONDS.
+  Views set default_read_preference to SECONDARY_READ_PREFERENCE on list
+  queries, search pipelines and lookup loads, so a collection an operator
+  keeps on the primary stays there.
+
+  Settings (environment):
+    DATABASE_READ_PREFERENCE              default mode (default primary)
+    DATABASE_READ_PREFERENCE_COLLECTIONS  modes per collection, e.g. 'product=nearest,order=primary'
+    DATABASE_READ_PREFERENCE_ENDPOINTS    modes per endpoint (find, find_one, count, bulk_read,
+                                          run_pipeline), e.g. 'run_pipeline=secondaryPreferred'
+    DATABASE_MAX_STALENESS_SECONDS        maxStalenessSeconds, 90 or more (default -1, no bound)
+    DATABASE_SECONDARY_READ_PREFERENCE    mode for list, search and lookup reads (default secondaryPreferred)
+'''
+import contextlib
+import contextvars
+import os
+from typing import Literal
+from pymongo.read_preferences import Nearest, Primary, PrimaryPreferred, Secondary, SecondaryPreferred
+from mango.db.tenants import get_collection
+
+ReadPreferenceMode = Literal['primary', 'primaryPreferred', 'secondary', 'secondaryPreferred', 'nearest']
+
+READ_PREFERENCES = {
+  'primary': Primary,
+  'primaryPreferred': PrimaryPreferred,
+  'secondary': Secondary,
+  'secondaryPreferred': SecondaryPreferred,
+  'nearest': Nearest,
+}
+
+
+def parse_modes(text: str):
+  modes = {}
+  for item in (text or '').split(','):
+    name, _, mode = item.partition('=')
+    if name.strip() and mode.strip():
+      modes[name.strip()] = mode.strip()
+  return modes
+
+DATABASE_READ_PREFERENCE = os.environ.get('DATABASE_READ_PREFERENCE', 'primary')
+DATABASE_READ_PREFERENCE_COLLECTIONS = parse_modes(os.environ.get('DATABASE_READ_PREFERENCE_COLLECTIONS'))
+DATABASE_READ_PREFERENCE_ENDPOINTS = parse_modes(os.environ.get('DATABASE_READ_PREFERENCE_ENDPOINTS'))
+DATABASE_MAX_STALENESS_SECONDS = int(os.environ.get('DATABASE_MAX_STALENESS_SECONDS', -1))
+SECONDARY_READ_PREFERENCE = os.environ.get('DATABASE_SECONDARY_READ_PREFERENCE', 'secondaryPreferred')
+
+_pinned = contextvars.ContextVar('primary_reads', default=False)
+_read_preferences = {}
+
+
+def read_preference(mode: str):
+  '''
+    The pymongo read preference for a mode, with the staleness bound.
+  '''
+  preference = _read_preferences.get(mode)
+  if preference is None:
+    if mode not in READ_PREFERENCES:
+      raise ValueError(f'Unknown read preference: {mode}')
+    if mode == 'primary':
+      preference = Primary()
+    else:
+      preference = READ_PREFERENCES[mode](max_staleness=DATABASE_MAX_STALENESS_SECONDS)
+    _read_preferences[mode] = preference
+  return preference
+
+def resolve_mode(collection: str, mode: str = None, endpoint: str = None, default: str = None):
+  if _pinned.get():
+    return 'primary'
+  return (
+    mode
+    or DATABASE_READ_PREFERENCE_COLLECTIONS.get(collection)
+    or default
+    or DATABASE_READ_PREFERENCE_ENDPOINTS.get(endpoint)
+    or DATABASE_READ_PREFERENCE
+  )
+
+def resolve_read_preference(collection: str, mode: str = None, endpoint: str = None, default: str = None):
+  return read_preference(resolve_mode(collection, mode, endpoint, default))
+
+def read_collection(db, collection: str, mode: str = None, endpoint: str = None, default: str = None):
+  '''
+    The collection (pymongo or Motor) with the resolved read preference,
+    cached by the tenant registry for the databases it handed out.
+  '''
+  preference = resolve_read_preference(collection, mode, endpoint, default)
+  if isinstance(preference, Primary):
+    return get_collection(db, collection)
+  return get_collection(db, collection, read_preference=preference)
+
+def pin_primary_reads():
+  '''
+    Sends the rest of the current request's reads to the primary.
+  '''
+  _pinned.set(True)
+
+@contextlib.contextmanager
+def primary_reads():
+  token = _pinned.set(True)
+  try:
+    yield
+  finally:
+    _pinned.reset(token)
@@ -0,0 +1,109 @@
+'''
+  Serializers
+
+  Maps BSON values straight to JSON in a single pass, replacing the
+  json.loads(json.dumps(...)) round trips on the read paths.
+
+  Two rule sets are kept so existing responses do not change shape:
+    native   - the find/findOne rules of json_from_mongo used as a json default:
+               ObjectId -> str, datetime -> isoformat(), Decimal128 -> str.
+    extended - the runPipeline rules of json_util.dumps followed by the
+               json_from_mongo object_hook: ObjectId -> str, datetime -> the
+               json_util $date value, Decimal128 -> quantized $numberDecimal.
+  Timestamp is written as {'$timestamp': {'t': ..., 'i': ...}} in both.
+  Extended output writes NaN and +-Infinity as json_util does,
+  {'$numberDouble': 'NaN' | 'Infinity' | '-Infinity'}; native output keeps
+  the bare NaN / Infinity tokens json.dumps has always written.
+
+  dumps() produces response bytes, to_jsonable() produces the same structure as
+  plain Python objects for callers inside the framework.
+'''
+import json
+import math
+from datetime import datetime
+from bson import json_util, Decimal128, ObjectId
+from bson.timestamp import Timestamp
+from fastapi.responses import Response
+from mango.db.metrics import count_documents, observe_documents
+from mango.db.models import json_from_mongo
+
+NATIVE_TYPES = (str, int, float, bool, type(None))
+
+
+def native_default(o):
+  if isinstance(o, ObjectId):
+    return str(o)
+  elif isinstance(o, datetime):
+    return o.isoformat()
+  elif isinstance(o, Decimal128):
+    return str(o)
+  elif isinstance(o, Timestamp):
+    return {'$timestamp': {'t': o.time, 'i': o.inc}}
+  raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+
+def extended_default(o):
+  if isinstance(o, ObjectId):
+    return str(o)
+  elif isinstance(o, Decimal128):
+    return json_from_mongo({'$numberDecimal': str(o)})
+  elif isinstance(o, Timestamp):
+    return {'$timestamp': {'t': o.time, 'i': o.inc}}
+  return json_from_mongo(json_util.default(o))
+
+def extended_float(value: float):
+  if math.isnan(value):
+    return {'$numberDouble': 'NaN'}
+  return {'$numberDouble': 'Infinity' if value > 0 else '-Infinity'}
+
+def get_default(extended: bool = False):
+  if extended:
+    return extended_default
+  return native_default
+
+def dumps(data, extended: bool = False) -> bytes:
+  if extended:
+    try:
+      return _dumps(data, extended_default, allow_nan=False)
+    except ValueError:
+      # json.dumps never hands floats to `default`, so documents holding a
+      # non-finite float take the converting pass instead.
+      return _dumps(to_jsonable(data, extended=True), extended_default, allow_nan=False)
+  return _dumps(data, native_default, allow_nan=True)
+
+def _dumps(data, default, allow_nan: bool) -> bytes:
+  return json.dumps(
+    data,
+    default=default,
+    ensure_ascii=False,
+    allow_nan=allow_nan,
+    separators=(',', ':'),
+  ).encode('utf-8')
+
+def _key(k):
+  if isinstance(k, str):
+    return k
+  elif k is True:
+    return 'true'
+  elif k is False:
+    return 'false'
+  elif k is None:
+    return 'null'
+  return str(k)
+
+def _convert(value, default, extended: bool):
+  if isinstance(value, float) and extended and not math.isfinite(value):
+    return extended_float(value)
+  elif isinstance(value, NATIVE_TYPES):
+    return value
+  elif isinstance(value, dict):
+    return {_key(k): _convert(v, default, extended) for k, v in value.items()}
+  elif isinstance(value, (list, tuple)):
+    return [_convert(v, default, extended) for v in value]
+  return _convert(default(value), default, extended)
+
+def to_jsonable(data, extended: bool = False):
+  return _convert(data, get_default(extended), extended)
+
+def json_response(data, extended: bool = False, status_code: int = 200, headers: dict = None):
+  observe_documents(count_documents(data))
+  return Response(content=dumps(data, extended=extended), status_code=status_code, headers=headers, media_type='application/json')
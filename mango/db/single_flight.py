@@ -0,0 +1,130 @@
+'''
+  Single Flight
+
+  Coalesces identical reads that are in flight at the same time. The first
+  caller for a key runs the database call; callers that arrive with the same
+  key before it finishes wait for it and get the same result (each their own
+  copy) instead of issuing the call again. Nothing is kept once the call
+  finishes: this is not a cache, the next caller starts a new flight.
+
+  Keys are the database, collection, normalized plan (or command) and read
+  preference of the read, plus the query cache generation of the collections
+  it reads: a read sent after a write never joins a flight that started
+  before it, so neither it nor the query cache get the rows from before the
+  write. Async callers share one task, so a cancelled caller
+  does not cancel the call the others wait for; sync callers (the *_sync
+  helpers, run from worker threads) wait on an event.
+
+  Settings (environment):
+    SINGLE_FLIGHT_ENABLED  set to false to run every read on its own (default true)
+'''
+import asyncio
+import os
+import threading
+from typing import Awaitable, Callable
+from mango.db.cache import clone, normalize, query_cache
+
+SINGLE_FLIGHT_ENABLED = os.environ.get('SINGLE_FLIGHT_ENABLED', 'true').lower() not in ('0', 'false', 'no')
+
+
+class Flight():
+  __slots__ = ('task', 'event', 'result', 'error', 'followers')
+
+  def __init__(self, task: asyncio.Future = None):
+    self.task = task
+    self.event = threading.Event()
+    self.result = None
+    self.error = None
+    self.followers = 0
+
+
+class SingleFlight():
+
+  def __init__(self, enabled: bool = SINGLE_FLIGHT_ENABLED):
+    self.enabled = enabled
+    self.flights = {}
+    self.tasks = {}
+    self.collections = {}
+    self._lock = threading.Lock()
+
+  def key(self, database: str, collection: str, *parts):
+    return (database, collection, normalize(parts))
+
+  def plan_key(self, database: str, entity, plan):
+    generation = query_cache.generation(database, entity.name)
+    return self.key(database, entity.name, generation, plan.method, plan.args, plan.kwargs, entity.read_preference.document)
+
+  def count(self, key, collapsed: bool):
+    stats = self.collections.setdefault(key[1], {'flights': 0, 'collapsed': 0})
+    stats['collapsed' if collapsed else 'flights'] += 1
+
+  async def run(self, key, fn: Callable[[], Awaitable]):
+    '''
+      Awaits fn() once for every caller with the same key in flight.
+    '''
+    if key is None or not self.enabled:
+      return await fn()
+    flight = self.tasks.get(key)
+    if flight is None or flight.task.done():
+      flight = Flight(asyncio.ensure_future(fn()))
+      self.tasks[key] = flight
+      flight.task.add_done_callback(lambda task: self.tasks.pop(key) if self.tasks.get(key) is flight else None)
+      with self._lock:
+        self.count(key, collapsed=False)
+    else:
+      flight.followers += 1
+      with self._lock:
+        self.count(key, collapsed=True)
+    result = await asyncio.shield(flight.task)
+    if flight.followers:
+      return clone(result)
+    return result
+
+  def run_sync(self, key, fn: Callable):
+    '''
+      Calls fn() once for every thread with the same key in flight.
+    '''
+    if key is None or not self.enabled:
+      return fn()
+    with self._lock:
+      flight = self.flights.get(key)
+      leader = flight is None
+      if leader:
+        flight = self.flights[key] = Flight()
+      else:
+        flight.followers += 1
+      self.count(key, collapsed=not leader)
+    if not leader:
+      flight.event.wait()
+      if flight.error is not None:
+        raise flight.error
+      return clone(flight.result)
+    try:
+      result = fn()
+    except Exception as e:
+      flight.error = e
+      raise
+    finally:
+      with self._lock:
+        del self.flights[key]
+      if flight.error is None and flight.followers:
+        flight.result = clone(result)
+      flight.event.set()
+    return result
+
+  def stats(self):
+    with self._lock:
+      collections = {name: dict(stats) for name, stats in self.collections.items()}
+    flights = sum(x['flights'] for x in collections.values())
+    collapsed = sum(x['collapsed'] for x in collections.values())
+    return {
+      'enabled': self.enabled,
+      'in_flight': len(self.flights) + len(self.tasks),
+      'flights': flights,
+      'collapsed': collapsed,
+      'collapse_ratio': collapsed / (flights + collapsed) if flights + collapsed else 0.0,
+      'collections': collections,
+    }
+
+
+single_flight = SingleFlight()
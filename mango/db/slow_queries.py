@@ -0,0 +1,190 @@
+'''
+  Slow Queries
+
+  A metrics sink that explains slow reads. When a find, count or run_pipeline
+  operation takes SLOW_QUERY_MS or longer, its query is explained with
+  executionStats on a background thread, after the response has been
+  returned, and the result is stored in the capped `_slow_queries` collection
+  of the operation's database:
+    operation, collection, shape, shape_hash, latency_ms, timestamp
+    winning_plan   - the planner's winning plan (extended JSON text)
+    stages         - every stage in the winning plan, e.g. ['FETCH', 'IXSCAN']
+    collscan       - the plan scans the whole collection
+    index_names    - indexes the plan uses
+    keys_examined, docs_examined, returned
+    examined_ratio - documents examined per document returned
+
+  Each query shape is explained at most once every SLOW_QUERY_INTERVAL
+  seconds, so a hot slow query does not turn into a stream of explains. The
+  last SLOW_QUERY_MAX_SHAPES shapes explained are remembered for that; the
+  oldest are forgotten first.
+
+  Settings (environment):
+    SLOW_QUERY_MS          threshold in milliseconds, 0 turns the log off (default 200)
+    SLOW_QUERY_INTERVAL    seconds between explains of the same shape (default 300)
+    SLOW_QUERY_SIZE        capped collection size in bytes (default 16777216)
+    SLOW_QUERY_MAX         capped collection document limit (default 10000)
+    SLOW_QUERY_MAX_SHAPES  shapes remembered for SLOW_QUERY_INTERVAL (default 10000)
+'''
+import copy
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from bson import json_util
+from pymongo.errors import CollectionInvalid, PyMongoError
+from mango.db.metrics import metrics, Operation
+from mango.db.pool import get_client
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 200))
+SLOW_QUERY_INTERVAL = float(os.environ.get('SLOW_QUERY_INTERVAL', 300))
+SLOW_QUERY_SIZE = int(os.environ.get('SLOW_QUERY_SIZE', 16 * 1024 * 1024))
+SLOW_QUERY_MAX = int(os.environ.get('SLOW_QUERY_MAX', 10000))
+SLOW_QUERY_MAX_SHAPES = int(os.environ.get('SLOW_QUERY_MAX_SHAPES', 10000))
+SLOW_QUERY_COLLECTION = '_slow_queries'
+SLOW_QUERY_OPERATIONS = {'find', 'count', 'run_pipeline'}
+
+
+def explain_command(operation: Operation):
+  '''
+    The command to explain for an operation, rebuilt from its request model
+    (whose query has already been decoded by the call).
+  '''
+  model = operation.model
+  if operation.operation == 'run_pipeline' and hasattr(model, 'pipeline'):
+    return {'aggregate': model.aggregate, 'pipeline': model.pipeline, 'cursor': {}}
+  elif operation.operation == 'count' and hasattr(model, 'query'):
+    return {'count': model.collection, 'query': model.query or {}}
+  elif operation.operation == 'find' and hasattr(model, 'buildOptions'):
+    command = {'find': model.collection, 'filter': model.query or {}}
+    options = model.buildOptions()
+    if options.get('sort'):
+      command['sort'] = dict(options['sort'])
+    if options.get('projection'):
+      command['projection'] = options['projection']
+    if options.get('skip'):
+      command['skip'] = options['skip']
+    if getattr(model, 'limit', None):
+      command['limit'] = model.limit
+    return command
+  return None
+
+def find_key(doc, key: str):
+  '''
+    The first value of `key` anywhere in an explain document. Where the plan
+    and stats live depends on the command and server version.
+  '''
+  if isinstance(doc, dict):
+    if key in doc:
+      return doc[key]
+    values = doc.values()
+  elif isinstance(doc, list):
+    values = doc
+  else:
+    return None
+  for value in values:
+    found = find_key(value, key)
+    if found is not None:
+      return found
+  return None
+
+def collect_values(doc, key: str, values: list):
+  if isinstance(doc, dict):
+    for k, value in doc.items():
+      if k == key and isinstance(value, str):
+        values.append(value)
+      else:
+        collect_values(value, key, values)
+  elif isinstance(doc, list):
+    for value in doc:
+      collect_values(value, key, values)
+  return values
+
+def summarize_explain(explain: dict):
+  winning_plan = find_key(explain, 'winningPlan') or {}
+  stats = find_key(explain, 'executionStats') or {}
+  stages = collect_values(winning_plan, 'stage', [])
+  returned = stats.get('nReturned', 0)
+  examined = stats.get('totalDocsExamined', 0)
+  return {
+    'winning_plan': json_util.dumps(winning_plan),
+    'stages': stages,
+    'collscan': 'COLLSCAN' in stages,
+    'index_names': sorted(set(collect_values(winning_plan, 'indexName', []))),
+    'keys_examined': stats.get('totalKeysExamined', 0),
+    'docs_examined': examined,
+    'returned': returned,
+    'examined_ratio': examined / max(returned, 1),
+    'execution_ms': stats.get('executionTimeMillis', 0),
+  }
+
+
+class SlowQueryLog():
+
+  def __init__(self, threshold_ms: float = SLOW_QUERY_MS, interval: float = SLOW_QUERY_INTERVAL, max_shapes: int = SLOW_QUERY_MAX_SHAPES):
+    self.threshold_ms = threshold_ms
+    self.interval = interval
+    self.max_shapes = max_shapes
+    self.last_explained = {}
+    self.created = set()
+    self._lock = threading.Lock()
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='slow-query')
+
+  def should_explain(self, operation: Operation):
+    if self.threshold_ms <= 0 or operation.error:
+      return False
+    if operation.operation not in SLOW_QUERY_OPERATIONS or operation.latency_ms < self.threshold_ms:
+      return False
+    if operation.collection == SLOW_QUERY_COLLECTION:
+      return False
+    key = (operation.database, operation.collection, operation.operation, operation.shape_hash)
+    now = time.monotonic()
+    with self._lock:
+      last = self.last_explained.get(key)
+      if last is not None and now - last < self.interval:
+        return False
+      # reinserted so the dict stays in explain order, oldest first
+      self.last_explained.pop(key, None)
+      self.last_explained[key] = now
+      while len(self.last_explained) > self.max_shapes:
+        self.last_explained.pop(next(iter(self.last_explained)))
+    return True
+
+  def record(self, operation: Operation):
+    if not self.should_explain(operation):
+      return
+    command = explain_command(operation)
+    if command is None:
+      return
+    entry = {
+      'operation': operation.operation,
+      'collection': operation.collection,
+      'shape': json_util.dumps(operation.shape),
+      'shape_hash': operation.shape_hash,
+      'latency_ms': operation.latency_ms,
+      'timestamp': datetime.utcnow(),
+    }
+    self._executor.submit(self.capture, operation.database, copy.deepcopy(command), entry)
+
+  def get_collection(self, database: str):
+    db = get_client()[database]
+    if database not in self.created:
+      try:
+        db.create_collection(SLOW_QUERY_COLLECTION, capped=True, size=SLOW_QUERY_SIZE, max=SLOW_QUERY_MAX)
+      except CollectionInvalid:
+        pass
+      self.created.add(database)
+    return db[SLOW_QUERY_COLLECTION]
+
+  def capture(self, database: str, command: dict, entry: dict):
+    try:
+      explain = get_client()[database].command('explain', command, verbosity='executionStats')
+      entry.update(summarize_explain(explain))
+      self.get_collection(database).insert_one(entry)
+    except PyMongoError:
+      pass
+
+
+slow_query_log = SlowQueryLog()
+metrics.add_sink(slow_query_log)
@@ -0,0 +1,85 @@
+'''
+  Streaming
+
+  Encodes documents batch by batch as a Motor cursor produces them, so only one
+  batch is held in memory and the first bytes go out before the cursor is
+  exhausted. Three wire formats are supported:
+    ndjson - one JSON document per line (application/x-ndjson)
+    json   - a single JSON array written in chunks (application/json)
+    bson   - BSON documents back to back (application/x-bson-seq); the cursor
+             must come from raw_collection(), its documents are written as is
+'''
+import os
+from typing import Callable, Literal
+from fastapi.responses import StreamingResponse
+from mango.db.bson_response import BSON_SEQ_MEDIA_TYPE
+from mango.db.metrics import current_operation, Operation
+from mango.db.serializers import dumps
+
+STREAM_BATCH_SIZE = int(os.environ.get('STREAM_BATCH_SIZE', 500))
+STREAM_MEDIA_TYPES = {
+  'ndjson': 'application/x-ndjson',
+  'json': 'application/json',
+  'bson': BSON_SEQ_MEDIA_TYPE,
+}
+
+StreamFormat = Literal['ndjson', 'json', 'bson']
+
+
+def encode_document(doc):
+  return dumps(doc)
+
+def encode_extended_document(doc):
+  return dumps(doc, extended=True)
+
+async def iter_ndjson(cursor, encode: Callable = encode_document, batch_size: int = STREAM_BATCH_SIZE, operation: Operation = None):
+  chunk = []
+  async for doc in cursor:
+    chunk.append(encode(doc))
+    if operation:
+      operation.add_documents(1)
+    if len(chunk) >= batch_size:
+      yield b'\n'.join(chunk) + b'\n'
+      chunk = []
+  if chunk:
+    yield b'\n'.join(chunk) + b'\n'
+
+async def iter_json_array(cursor, encode: Callable = encode_document, batch_size: int = STREAM_BATCH_SIZE, operation: Operation = None):
+  yield b'['
+  chunk = []
+  separator = b''
+  async for doc in cursor:
+    chunk.append(encode(doc))
+    if operation:
+      operation.add_documents(1)
+    if len(chunk) >= batch_size:
+      yield separator + b','.join(chunk)
+      separator = b','
+      chunk = []
+  if chunk:
+    yield separator + b','.join(chunk)
+  yield b']'
+
+async def iter_bson(cursor, batch_size: int = STREAM_BATCH_SIZE, operation: Operation = None):
+  chunk = []
+  async for doc in cursor:
+    chunk.append(doc.raw)
+    if operation:
+      operation.add_documents(1)
+    if len(chunk) >= batch_size:
+      yield b''.join(chunk)
+      chunk = []
+  if chunk:
+    yield b''.join(chunk)
+
+def stream_cursor(cursor, encode: Callable = encode_document, stream_format: StreamFormat = 'ndjson', batch_size: int = STREAM_BATCH_SIZE):
+  if batch_size < 1:
+    batch_size = STREAM_BATCH_SIZE
+  operation = current_operation.get()
+  if stream_format == 'json':
+    content = iter_json_array(cursor, encode=encode, batch_size=batch_size, operation=operation)
+  elif stream_format == 'bson':
+    content = iter_bson(cursor, batch_size=batch_size, operation=operation)
+  else:
+    content = iter_ndjson(cursor, encode=encode, batch_size=batch_size, operation=operation)
+  return StreamingResponse(content, media_type=STREAM_MEDIA_TYPES[stream_format])
@@ -0,0 +1,482 @@
+'''
+  Tenants
+
+  One database per tenant: the tenant of a call is the `database` of its
+  request model. The tenant registry keeps, per tenant:
+    handles      - the Database handles (pymongo and Motor) and the Collection
+                   handles taken from them, created once instead of on every
+                   call
+    concurrency  - at most max_concurrency operations at a time; the others
+                   wait up to TENANT_QUEUE_TIMEOUT seconds for a slot
+    quota        - at most ops_per_minute operations per minute
+    pool         - tenants with dedicated_pool get their own MongoClient and
+                   AsyncIOMotorClient (max_pool_size connections each) instead
+                   of sharing the process-wide pool
+  A call over its tenant's quota, or still waiting for a slot after the
+  timeout, raises TenantLimitExceeded, a 429 for HTTP callers. Sync and async
+  calls share one limit. Nested calls hold the slot of the outermost one, and
+  a streamed response holds its slot until the body has been sent.
+
+  Tenants named in TENANT_SETTINGS stay registered; the others are created on
+  first use and the least recently used idle ones are dropped past
+  TENANT_REGISTRY_SIZE, so a caller cycling through database names cannot
+  grow the registry (or tenant_stats) without bound.
+
+  @tenant_limited applies the limits to an endpoint or sync helper; put it
+  under @instrument so rejected calls are recorded too. tenant_stats is a
+  metrics sink with calls, errors, latency and throughput per tenant, served
+  on /metrics and /api_admin/tenants.
+
+  Settings (environment):
+    TENANT_MAX_CONCURRENCY       operations in flight per tenant, 0 for no limit (default 0)
+    TENANT_OPS_PER_MINUTE        operations per tenant per minute, 0 for no quota (default 0)
+    TENANT_QUEUE_TIMEOUT         seconds to wait for a slot (default 5)
+    TENANT_DEDICATED_POOL_SIZE   maxPoolSize of dedicated pools (default 20)
+    TENANT_REGISTRY_SIZE         tenants kept registered, plus the configured ones (default 1000)
+    TENANT_COLLECTION_CACHE_SIZE collection handles cached per tenant (default 1000)
+    TENANT_SETTINGS              per-tenant overrides as JSON, e.g.
+                                 '{"acme": {"max_concurrency": 50, "ops_per_minute": 0,
+                                 "dedicated_pool": true, "max_pool_size": 50}}'
+'''
+import asyncio
+import contextvars
+import functools
+import inspect
+import json
+import os
+import threading
+import time
+import weakref
+from collections import deque, OrderedDict
+from fastapi import HTTPException
+from fastapi.responses import StreamingResponse
+from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+from mango.db.metrics import format_labels, metrics, request_model, Operation
+from mango.db.pool import get_async_client, get_client, get_pool_options, get_uri, PoolStatsListener
+
+DATABASE_NAME = os.environ.get('DATABASE_NAME')
+TENANT_MAX_CONCURRENCY = int(os.environ.get('TENANT_MAX_CONCURRENCY', 0))
+TENANT_OPS_PER_MINUTE = int(os.environ.get('TENANT_OPS_PER_MINUTE', 0))
+TENANT_QUEUE_TIMEOUT = float(os.environ.get('TENANT_QUEUE_TIMEOUT', 5))
+TENANT_DEDICATED_POOL_SIZE = int(os.environ.get('TENANT_DEDICATED_POOL_SIZE', 20))
+TENANT_REGISTRY_SIZE = int(os.environ.get('TENANT_REGISTRY_SIZE', 1000))
+TENANT_COLLECTION_CACHE_SIZE = int(os.environ.get('TENANT_COLLECTION_CACHE_SIZE', 1000))
+TENANT_SETTINGS = json.loads(os.environ.get('TENANT_SETTINGS') or '{}')
+THROUGHPUT_WINDOW = 60
+SLOT_POLL_INTERVAL = 0.01
+
+_admitted = contextvars.ContextVar('tenant_admitted', default=None)
+
+
+class TenantLimitExceeded(HTTPException):
+
+  def __init__(self, tenant: str, reason: str, retry_after: int = 1):
+    super().__init__(
+      status_code=429,
+      detail=f'Tenant {tenant} is over its {reason}.',
+      headers={'Retry-After': str(retry_after)},
+    )
+    self.tenant = tenant
+    self.reason = reason
+
+
+class Tenant():
+
+  def __init__(self, name: str, max_concurrency: int = TENANT_MAX_CONCURRENCY, ops_per_minute: int = TENANT_OPS_PER_MINUTE,
+               dedicated_pool: bool = False, max_pool_size: int = TENANT_DEDICATED_POOL_SIZE):
+    self.name = name
+    self.max_concurrency = max_concurrency
+    self.ops_per_minute = ops_per_minute
+    self.dedicated_pool = dedicated_pool
+    self.max_pool_size = max_pool_size
+    self.in_flight = 0
+    self.rejected = {'quota': 0, 'concurrency': 0}
+    self.window = 0
+    self.window_ops = 0
+    self.client = None
+    self.async_client = None
+    self.sync_listener = PoolStatsListener()
+    self.async_listener = PoolStatsListener()
+    self.databases = {}
+    self.collections = {}
+    self._lock = threading.Lock()
+    self._semaphore = threading.BoundedSemaphore(max_concurrency) if max_concurrency else None
+
+  def pool_options(self):
+    return dict(get_pool_options(), maxPoolSize=self.max_pool_size)
+
+  def get_client(self):
+    if not self.dedicated_pool:
+      return get_client()
+    if self.client is None:
+      with self._lock:
+        if self.client is None:
+          self.client = MongoClient(get_uri(), event_listeners=[self.sync_listener], **self.pool_options())
+    return self.client
+
+  def get_async_client(self):
+    if not self.dedicated_pool:
+      return get_async_client()
+    if self.async_client is None:
+      with self._lock:
+        if self.async_client is None:
+          self.async_client = AsyncIOMotorClient(get_uri(), event_listeners=[self.async_listener], **self.pool_options())
+    return self.async_client
+
+  def take_quota(self):
+    if not self.ops_per_minute:
+      return
+    window = int(time.time() // 60)
+    with self._lock:
+      if window != self.window:
+        self.window = window
+        self.window_ops = 0
+      if self.window_ops >= self.ops_per_minute:
+        self.rejected['quota'] += 1
+        raise TenantLimitExceeded(self.name, 'operation quota', retry_after=60 - int(time.time() % 60))
+      self.window_ops += 1
+
+  def reject_concurrency(self):
+    with self._lock:
+      self.rejected['concurrency'] += 1
+    raise TenantLimitExceeded(self.name, 'concurrency limit')
+
+  def enter(self):
+    with self._lock:
+      self.in_flight += 1
+
+  def leave(self):
+    with self._lock:
+      self.in_flight -= 1
+
+  def acquire(self, timeout: float = TENANT_QUEUE_TIMEOUT):
+    self.take_quota()
+    if self._semaphore is not None and not self._semaphore.acquire(timeout=timeout):
+      self.reject_concurrency()
+    self.enter()
+
+  def release(self):
+    self.leave()
+    if self._semaphore is not None:
+      self._semaphore.release()
+
+  async def acquire_async(self, timeout: float = TENANT_QUEUE_TIMEOUT):
+    '''
+      Takes a slot of the same semaphore as acquire(), polling instead of
+      blocking the event loop while the tenant is at its limit.
+    '''
+    self.take_quota()
+    if self._semaphore is not None and not self._semaphore.acquire(blocking=False):
+      deadline = time.monotonic() + timeout
+      while not self._semaphore.acquire(blocking=False):
+        if time.monotonic() >= deadline:
+          self.reject_concurrency()
+        await asyncio.sleep(SLOT_POLL_INTERVAL)
+    self.enter()
+
+  def cache_collection(self, key: tuple, entity):
+    while len(self.collections) >= TENANT_COLLECTION_CACHE_SIZE:
+      self.collections.pop(next(iter(self.collections)), None)
+    self.collections[key] = entity
+    return entity
+
+  def close(self):
+    if self.client is not None:
+      self.client.close()
+      self.client = None
+    if self.async_client is not None:
+      self.async_client.close()
+      self.async_client = None
+    self.databases = {}
+    self.collections = {}
+
+  def stats(self):
+    with self._lock:
+      stats = {
+        'max_concurrency': self.max_concurrency,
+        'ops_per_minute': self.ops_per_minute,
+        'in_flight': self.in_flight,
+        'window_ops': self.window_ops,
+        'rejected': dict(self.rejected),
+        'dedicated_pool': self.dedicated_pool,
+      }
+    if self.dedicated_pool:
+      stats['pool'] = {
+        'max_pool_size': self.max_pool_size,
+        'sync': self.sync_listener.stats() if self.client is not None else None,
+        'async': self.async_listener.stats() if self.async_client is not None else None,
+      }
+    return stats
+
+
+class TenantRegistry():
+
+  def __init__(self, settings: dict = TENANT_SETTINGS, max_size: int = TENANT_REGISTRY_SIZE):
+    self.settings = settings
+    self.max_size = max_size
+    self.tenants = OrderedDict()
+    self.evicted = 0
+    self._lock = threading.Lock()
+
+  def tenant(self, name: str = None):
+    name = name or DATABASE_NAME
+    with self._lock:
+      tenant = self.tenants.get(name)
+      if tenant is None:
+        tenant = self.tenants[name] = Tenant(name, **self.settings.get(name, {}))
+        self.evict()
+      else:
+        self.tenants.move_to_end(name)
+    return tenant
+
+  def evict(self):
+    '''
+      Drops the least recently used tenants past max_size that are neither
+      configured nor running anything. Call with the lock held.
+    '''
+    excess = sum(1 for x in self.tenants if x not in self.settings) - self.max_size
+    for name in list(self.tenants):
+      if excess <= 0:
+        break
+      tenant = self.tenants[name]
+      if name in self.settings or name == DATABASE_NAME or tenant.in_flight:
+        continue
+      del self.tenants[name]
+      tenant.close()
+      self.evicted += 1
+      excess -= 1
+
+  def register(self, name: str, **settings):
+    '''
+      Sets a tenant's limits (the Tenant arguments), replacing its entry.
+    '''
+    with self._lock:
+      previous = self.tenants.pop(name, None)
+      self.settings = dict(self.settings, **{name: settings})
+    if previous is not None:
+      previous.close()
+    return self.tenant(name)
+
+  def get_database(self, name: str = None):
+    tenant = self.tenant(name)
+    db = tenant.databases.get('sync')
+    if db is None:
+      db = tenant.databases['sync'] = tenant.get_client()[tenant.name]
+    return db
+
+  def get_async_database(self, name: str = None):
+    tenant = self.tenant(name)
+    db = tenant.databases.get('async')
+    if db is None:
+      db = tenant.databases['async'] = tenant.get_async_client()[tenant.name]
+    return db
+
+  def get_collection(self, db, name: str, read_preference=None):
+    '''
+      The collection handle of a database handle, cached when the database
+      handle came from the registry.
+    '''
+    tenant = self.tenants.get(db.name)
+    if tenant is None or not any(x is db for x in tenant.databases.values()):
+      if read_preference is None:
+        return db[name]
+      return db.get_collection(name, read_preference=read_preference)
+    key = (id(db), name, repr(read_preference) if read_preference is not None else None)
+    entity = tenant.collections.get(key)
+    if entity is None:
+      if read_preference is None:
+        entity = db[name]
+      else:
+        entity = db.get_collection(name, read_preference=read_preference)
+      tenant.cache_collection(key, entity)
+    return entity
+
+  def stats(self):
+    with self._lock:
+      tenants = dict(self.tenants)
+    return {name: tenant.stats() for name, tenant in tenants.items()}
+
+  def close(self):
+    with self._lock:
+      tenants = list(self.tenants.values())
+    for tenant in tenants:
+      tenant.close()
+
+
+tenant_registry = TenantRegistry()
+
+def get_database(name: str = None):
+  return tenant_registry.get_database(name)
+
+def get_async_database(name: str = None):
+  return tenant_registry.get_async_database(name)
+
+def get_collection(db, name: str, read_preference=None):
+  return tenant_registry.get_collection(db, name, read_preference)
+
+def close_tenants():
+  tenant_registry.close()
+
+
+def call_tenant(args: tuple, kwargs: dict):
+  model = request_model(args, kwargs)
+  if isinstance(model, list):
+    model = model[0] if model else None
+  return getattr(model, 'database', None) or kwargs.get('database') or DATABASE_NAME
+
+class SlotRelease():
+  '''
+    Releases a tenant slot once, however many paths try to.
+  '''
+  def __init__(self, tenant: Tenant):
+    self.tenant = tenant
+    self.released = False
+    self._lock = threading.Lock()
+
+  def __call__(self):
+    with self._lock:
+      if self.released:
+        return
+      self.released = True
+    self.tenant.release()
+
+async def _hold_stream(release: SlotRelease, body_iterator):
+  try:
+    async for chunk in body_iterator:
+      yield chunk
+  finally:
+    release()
+
+def hold_slot(response: StreamingResponse, release: SlotRelease):
+  '''
+    Keeps the slot until the body has been sent, or the response is dropped
+    without ever being sent.
+  '''
+  response.body_iterator = _hold_stream(release, response.body_iterator)
+  weakref.finalize(response, release)
+  return response
+
+def tenant_limited(func):
+  '''
+    Applies the tenant's quota and concurrency limit to every call.
+  '''
+  if inspect.iscoroutinefunction(func):
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+      tenant = tenant_registry.tenant(call_tenant(args, kwargs))
+      if _admitted.get() == tenant.name:
+        return await func(*args, **kwargs)
+      await tenant.acquire_async()
+      release = SlotRelease(tenant)
+      token = _admitted.set(tenant.name)
+      try:
+        result = await func(*args, **kwargs)
+      except BaseException:
+        release()
+        raise
+      finally:
+        _admitted.reset(token)
+      if isinstance(result, StreamingResponse):
+        return hold_slot(result, release)
+      release()
+      return result
+    return wrapper
+  @functools.wraps(func)
+  def wrapper(*args, **kwargs):
+    tenant = tenant_registry.tenant(call_tenant(args, kwargs))
+    if _admitted.get() == tenant.name:
+      return func(*args, **kwargs)
+    tenant.acquire()
+    token = _admitted.set(tenant.name)
+    try:
+      return func(*args, **kwargs)
+    finally:
+      _admitted.reset(token)
+      tenant.release()
+  return wrapper
+
+
+class TenantStats():
+  '''
+    Calls, errors, latency and throughput per tenant.
+  '''
+  def __init__(self, window: int = THROUGHPUT_WINDOW, max_size: int = TENANT_REGISTRY_SIZE):
+    self.window = window
+    self.max_size = max_size
+    self.tenants = OrderedDict()
+    self._lock = threading.Lock()
+
+  def record(self, operation: Operation):
+    name = operation.database or DATABASE_NAME
+    now = time.monotonic()
+    with self._lock:
+      stats = self.tenants.get(name)
+      if stats is None:
+        stats = self.tenants[name] = {'calls': 0, 'errors': 0, 'latency_ms_sum': 0.0, 'latency_ms_max': 0.0, 'documents': 0, 'recent': deque()}
+        while len(self.tenants) > self.max_size + len(tenant_registry.settings):
+          self.tenants.popitem(last=False)
+      else:
+        self.tenants.move_to_end(name)
+      stats['calls'] += 1
+      stats['errors'] += int(operation.error)
+      stats['latency_ms_sum'] += operation.latency_ms
+      stats['latency_ms_max'] = max(stats['latency_ms_max'], operation.latency_ms)
+      stats['documents'] += operation.documents or 0
+      recent = stats['recent']
+      recent.append(now)
+      while recent and now - recent[0] > self.window:
+        recent.popleft()
+
+  def stats(self):
+    now = time.monotonic()
+    limits = tenant_registry.stats()
+    with self._lock:
+      tenants = {}
+      for name, stats in self.tenants.items():
+        recent = sum(1 for x in stats['recent'] if now - x <= self.window)
+        tenants[name] = {
+          'calls': stats['calls'],
+          'errors': stats['errors'],
+          'latency_ms_avg': stats['latency_ms_sum'] / stats['calls'],
+          'latency_ms_sum': stats['latency_ms_sum'],
+          'latency_ms_max': stats['latency_ms_max'],
+          'documents': stats['documents'],
+          'ops_per_second': recent / self.window,
+        }
+    for name, tenant in limits.items():
+      tenants.setdefault(name, {}).update(limits=tenant)
+    return tenants
+
+  def text(self):
+    stats = self.stats()
+    lines = []
+    series = [
+      ('mango_tenant_operations_total', 'counter', 'Operations run per tenant.', 'calls', 1),
+      ('mango_tenant_operation_errors_total', 'counter', 'Operations that raised per tenant.', 'errors', 1),
+      ('mango_tenant_operation_seconds_sum', 'counter', 'Total operation latency per tenant.', 'latency_ms_sum', 0.001),
+      ('mango_tenant_operation_seconds_max', 'gauge', 'Slowest operation per tenant.', 'latency_ms_max', 0.001),
+      ('mango_tenant_operations_per_second', 'gauge', f'Operations per second over the last {self.window}s.', 'ops_per_second', 1),
+    ]
+    for name, kind, help_text, field, scale in series:
+      lines.append(f'# HELP {name} {help_text}')
+      lines.append(f'# TYPE {name} {kind}')
+      for tenant, x in stats.items():
+        if field in x:
+          lines.append(f'{name}{{{format_labels(tenant=tenant)}}} {x[field] * scale:g}')
+    limit_series = [
+      ('mango_tenant_in_flight', 'gauge', 'Operations in flight per tenant.', lambda x: x['in_flight']),
+      ('mango_tenant_rejected_total', 'counter', 'Operations rejected by the quota or concurrency limit.', lambda x: sum(x['rejected'].values())),
+    ]
+    for name, kind, help_text, value in limit_series:
+      lines.append(f'# HELP {name} {help_text}')
+      lines.append(f'# TYPE {name} {kind}')
+      for tenant, x in stats.items():
+        if 'limits' in x:
+          lines.append(f'{name}{{{format_labels(tenant=tenant)}}} {value(x["limits"]):g}')
+    return '\n'.join(lines) + '\n'
+
+
+tenant_stats = TenantStats()
+metrics.add_sink(tenant_stats)
+metrics.add_collector(tenant_stats.text)
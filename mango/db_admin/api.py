@@ -2,9 +2,20 @@ import requests
 from requests.auth import HTTPDigestAuth
 import json
 import os
-from pymongo import MongoClient
 from bson import json_util, ObjectId
 from typing import List, Tuple
+from mango.core.indexes import index_sync, sync_indexes
+from mango.core.metadata import metadata_store
+from mango.db.cache import pipeline_cache, query_cache
+from mango.db.compression import compression_stats
+from mango.db.index_advisor import index_advisor
+from mango.db.metadata_version import metadata_written_sync, read_version, set_metadata_version
+from mango.db.metrics import aggregates, ring_buffer
+from mango.db.pool import get_client, pool_stats, wire_compression_stats
+from mango.db.projection import projection_stats
+from mango.db.single_flight import single_flight
+from mango.db.slow_queries import SLOW_QUERY_COLLECTION
+from mango.db.tenants import tenant_stats
 
 DATABASE_CLUSTER = os.environ.get('DATABASE_CLUSTER')
 DATABASE_USERNAME = os.environ.get('DATABASE_USERNAME')
@@ -16,17 +27,12 @@ MONGODB_GROUP_ID = os.environ.get('MONGODB_GROUP_ID')
 MONGODB_CLUSTER_NAME = os.environ.get('MONGODB_CLUSTER_NAME')
 HEADERS = {'Content-Type': 'application/json'}
 
-uri = f'mongodb+srv://{DATABASE_USERNAME}:{DATABASE_PASSWORD}@{DATABASE_CLUSTER}.mongodb.net/{DATABASE_NAME}?retryWrites=true&w=majority'
-# uri = f'mongodb://summit.local:27017/?serverSelectionTimeoutMS=5000&connectTimeoutMS=10000&3t.uriVersion=3&3t.connection.name=Local+Dev&3t.alwaysShowAuthDB=true&3t.alwaysShowDBFromUserRole=true'
-client = MongoClient(uri)
-db = client.test
-
 def list_database_names():
-  names = client.list_database_names()
+  names = get_client().list_database_names()
   return names
 
 def create_database(database:str):
-  db = client[database]
+  db = get_client()[database]
   collection = 'log'
   log = db[collection]
   new_entry = {'msg': f'Database: {database} created!'}
@@ -35,16 +41,21 @@ def create_database(database:str):
   return data
 
 def drop_database(database:str):
-  client.drop_database(database)
+  version = read_version(database)
+  get_client().drop_database(database)
+  set_metadata_version(database, version + 1)
+  metadata_store.invalidate(database)
+  query_cache.clear()
+  pipeline_cache.clear()
   return {'msg': f'Database: {database} dropped!'}
 
 def list_collection_names(database:str):
-  entity = client[database]
+  entity = get_client()[database]
   names = entity.list_collection_names()
   return names
 
 def create_collection(database:str, collection:str):
-  db = client[database]
+  db = get_client()[database]
   entity = db[collection]
   new_entry = {'msg': f'Collection: {collection} created!'}
   result = entity.insert_one(new_entry)
@@ -52,25 +63,29 @@ def create_collection(database:str, collection:str):
   return data
 
 def drop_collection(database:str, collection:str):
-  db = client[database]
+  db = get_client()[database]
   entity = db[collection]
   entity.drop()
+  query_cache.bump(database, collection)
+  query_cache.evict(database, collection)
+  pipeline_cache.evict(database, collection)
+  metadata_written_sync(database, collection)
   return {'msg': f'Collection: {collection} dropped from database: {database}!'}
 
 def list_collection_indexes(database:str, collection:str):
-  db = client[database]
+  db = get_client()[database]
   entity = db[collection]
   result = entity.index_information()
   return result
 
 def create_collection_index(database:str, collection:str, fields:List[Tuple[str, int]]):
-  db = client[database]
+  db = get_client()[database]
   entity = db[collection]
   result = entity.create_index(fields)
   return result
 
 def drop_collection_index(database:str, collection:str, index_name:str):
-  db = client[database]
+  db = get_client()[database]
   entity = db[collection]
   entity.drop_index(index_name)
   return {'msg': f'Index: {index_name} dropped from collection: {collection} in database: {database}!'}
@@ -99,3 +114,87 @@ def delete_atlas_search_index(index_id:str):
   r = requests.delete(url, auth=HTTPDigestAuth(MONGODB_PUBLIC_KEY, MONGODB_PRIVATE_KEY), verify=False, headers=HEADERS)
   return r.json()
 
+def query_cache_stats():
+  return query_cache.stats()
+
+def enable_query_cache(collection:str):
+  query_cache.enable(collection)
+  return query_cache.stats()
+
+def disable_query_cache(collection:str):
+  query_cache.disable(collection)
+  return query_cache.stats()
+
+def clear_query_cache():
+  query_cache.clear()
+  return query_cache.stats()
+
+def pipeline_cache_stats():
+  return pipeline_cache.stats()
+
+def clear_pipeline_cache():
+  pipeline_cache.clear()
+  return pipeline_cache.stats()
+
+def list_projection_stats():
+  return projection_stats.stats()
+
+def list_operations(limit:int = 100):
+  return ring_buffer.recent(limit)
+
+def list_operation_stats():
+  return aggregates.stats()
+
+def list_slow_queries(database:str, collection:str = None, collscan:bool = None, limit:int = 100):
+  db = get_client()[database]
+  query = {}
+  if collection:
+    query['collection'] = collection
+  if collscan is not None:
+    query['collscan'] = collscan
+  entries = list(db[SLOW_QUERY_COLLECTION].find(query).sort('$natural', -1).limit(limit))
+  for entry in entries:
+    entry['shape'] = json_util.loads(entry['shape'])
+    entry['winning_plan'] = json_util.loads(entry['winning_plan'])
+  data = json.loads(json_util.dumps(entries))
+  return data
+
+def list_index_suggestions(database:str, collection:str = None):
+  db = get_client()[database]
+  suggestions = index_advisor.suggestions(database, lambda name: db[name].index_information(), collection=collection)
+  data = json.loads(json_util.dumps(suggestions))
+  return data
+
+def apply_index_suggestion(database:str, collection:str, index_name:str):
+  suggestions = list_index_suggestions(database, collection)
+  suggestion = next((x for x in suggestions if x['name'] == index_name), None)
+  if suggestion is None:
+    return {'msg': f'No index suggestion: {index_name} for collection: {collection} in database: {database}!'}
+  fields = [(name, direction) for name, direction in suggestion['key']]
+  result = create_collection_index(database, collection, fields)
+  return {'msg': f'Index: {result} created on collection: {collection} in database: {database}!', 'suggestion': suggestion}
+
+def list_index_drift(database:str):
+  report = sync_indexes(database, create=False)
+  data = json.loads(json_util.dumps(report))
+  return data
+
+def sync_model_indexes(database:str):
+  report = index_sync.run(database, create=True)
+  data = json.loads(json_util.dumps(report))
+  return data
+
+def single_flight_stats():
+  return single_flight.stats()
+
+def list_tenant_stats():
+  return tenant_stats.stats()
+
+def metadata_stats():
+  return metadata_store.stats()
+
+def list_compression_stats():
+  return {
+    'responses': compression_stats.stats(),
+    'wire': wire_compression_stats(),
+  }
@@ -15,6 +15,25 @@ from mango.db_admin.api import (
   create_atlas_search_index, 
   list_atlas_search_indexes,
   delete_atlas_search_index,
+  pool_stats,
+  query_cache_stats,
+  enable_query_cache,
+  disable_query_cache,
+  clear_query_cache,
+  pipeline_cache_stats,
+  clear_pipeline_cache,
+  list_projection_stats,
+  list_operations,
+  list_operation_stats,
+  list_slow_queries,
+  list_index_suggestions,
+  apply_index_suggestion,
+  list_index_drift,
+  sync_model_indexes,
+  single_flight_stats,
+  list_tenant_stats,
+  list_compression_stats,
+  metadata_stats,
 )
 
 router = APIRouter(
@@ -62,6 +81,11 @@ async def create_new_collection_index(database:str, collection:str, fields:List[
   response = create_collection_index(database, collection, fields)
   return response
 
+@router.get('/pool_stats')
+async def get_pool_stats(user=Depends(manager)):
+  response = pool_stats()
+  return response
+
 @router.post('/drop_collection_index')
 async def delete_collection_index(database:str, collection:str, index_name:str, user=Depends(manager)):
   response = drop_collection_index(database, collection, index_name)
@@ -81,4 +105,94 @@ async def get_search_indexes(collection:str, user=Depends(manager)):
 @router.delete('/delete_atlas_search_index')
 async def delete_search_index(index_id:str, user=Depends(manager)):
   response = delete_atlas_search_index(index_id=index_id)
-  return response
\ No newline at end of file
+  return response
+
+@router.get('/query_cache')
+async def get_query_cache(user=Depends(manager)):
+  response = query_cache_stats()
+  return response
+
+@router.post('/query_cache/enable')
+async def enable_collection_query_cache(collection:str, user=Depends(manager)):
+  response = enable_query_cache(collection)
+  return response
+
+@router.post('/query_cache/disable')
+async def disable_collection_query_cache(collection:str, user=Depends(manager)):
+  response = disable_query_cache(collection)
+  return response
+
+@router.post('/query_cache/clear')
+async def clear_all_query_cache(user=Depends(manager)):
+  response = clear_query_cache()
+  return response
+
+@router.get('/pipeline_cache')
+async def get_pipeline_cache(user=Depends(manager)):
+  response = pipeline_cache_stats()
+  return response
+
+@router.post('/pipeline_cache/clear')
+async def clear_all_pipeline_cache(user=Depends(manager)):
+  response = clear_pipeline_cache()
+  return response
+
+@router.get('/projection_stats')
+async def get_projection_stats(user=Depends(manager)):
+  response = list_projection_stats()
+  return response
+
+@router.get('/operations')
+async def get_operations(limit:int = 100, user=Depends(manager)):
+  response = list_operations(limit=limit)
+  return response
+
+@router.get('/operation_stats')
+async def get_operation_stats(user=Depends(manager)):
+  response = list_operation_stats()
+  return response
+
+@router.get('/slow_queries')
+async def get_slow_queries(database:str, collection:str = None, collscan:bool = None, limit:int = 100, user=Depends(manager)):
+  response = list_slow_queries(database, collection=collection, collscan=collscan, limit=limit)
+  return response
+
+@router.get('/index_suggestions')
+async def get_index_suggestions(database:str, collection:str = None, user=Depends(manager)):
+  response = list_index_suggestions(database, collection=collection)
+  return response
+
+@router.post('/index_suggestions/apply')
+async def apply_collection_index_suggestion(database:str, collection:str, index_name:str, user=Depends(manager)):
+  response = apply_index_suggestion(database, collection, index_name)
+  return response
+
+@router.get('/index_drift')
+async def get_index_drift(database:str, user=Depends(manager)):
+  response = list_index_drift(database)
+  return response
+
+@router.post('/sync_indexes')
+async def sync_indexes(database:str, user=Depends(manager)):
+  response = sync_model_indexes(database)
+  return response
+
+@router.get('/single_flight')
+async def get_single_flight(user=Depends(manager)):
+  response = single_flight_stats()
+  return response
+
+@router.get('/tenants')
+async def get_tenants(user=Depends(manager)):
+  response = list_tenant_stats()
+  return response
+
+@router.get('/compression_stats')
+async def get_compression_stats(user=Depends(manager)):
+  response = list_compression_stats()
+  return response
+
+@router.get('/metadata')
+async def get_metadata(user=Depends(manager)):
+  response = metadata_stats()
+  return response
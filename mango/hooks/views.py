@@ -27,6 +27,7 @@ ASANA_CLIENT_ID = os.environ.get('ASANA_CLIENT_ID')
 ASANA_CLIENT_SECRET = os.environ.get('ASANA_CLIENT_SECRET')
 ASANA_REDIRECT_URI = os.environ.get('ASANA_REDIRECT_URI')
 ASANA_PERSONAL_ACCESS_TOKEN = os.environ.get('ASANA_PERSONAL_ACCESS_TOKEN')
+PIPELINE_RESOURCES_CACHE_TTL = float(os.environ.get('PIPELINE_RESOURCES_CACHE_TTL', 60))
 
 templates = configure_templates(directory=TEMPLATE_DIRECTORY)
 
@@ -78,6 +79,7 @@ async def get_pipeline_resources(database: str, workflow_run_id: str):
     aggregate='xtra',
     pipeline=pipeline,
     cursor={},
+    cache_ttl=PIPELINE_RESOURCES_CACHE_TTL,
   )
   pipeline_result = await run_pipeline(ap)
   result = pipeline_result['cursor']['firstBatch']
@@ -15,6 +15,7 @@ from jinja2_simple_tags import StandaloneTag
 from wtforms import fields, FormField
 from mango.db.rest import find_sync, find_one_sync
 from mango.db.models import Query, QueryOne
+from mango.db.routing import SECONDARY_READ_PREFERENCE
 from mango.core.fields import LookupSelectField, QuerySelectField, QuerySelectMultipleField, HiddenField2
 from mango.core.fields import (
   ColorField2 as ColorField,
@@ -378,7 +379,8 @@ def db_lookup(value, data = [], lookups = {}):
         database=DATABASE_NAME,
         collection=value.collection,
         query=value.query,
-        projection=value.projection
+        projection=value.projection,
+        default_read_preference=SECONDARY_READ_PREFERENCE,
       )
       display_member = value.display_member
       value_member = value.value_member
@@ -402,7 +404,8 @@ def db_lookup(value, data = [], lookups = {}):
       database=DATABASE_NAME,
       collection=value.collection,
       query=value.query,
-      projection=value.projection
+      projection=value.projection,
+      default_read_preference=SECONDARY_READ_PREFERENCE,
     )
     display_member = value.display_member
     value_member = value.value_member
@@ -417,7 +420,8 @@ def db_lookup(value, data = [], lookups = {}):
       database=DATABASE_NAME,
       collection=value.collection,
       query=value.query,
-      projection=value.projection
+      projection=value.projection,
+      default_read_preference=SECONDARY_READ_PREFERENCE,
     )
     display_member = value.display_member
     value_member = value.value_member
@@ -42,6 +42,7 @@ setup(
       'python-bsonjs',
       'pymongo',
       'pymongo[srv]',
+      'motor',
       'requests',
       'bcrypt',
       'pyjwt',
@@ -52,4 +53,11 @@ setup(
       'click',
       'colour',
     ],
+    extras_require={
+      'compression': [
+        'zstandard',
+        'brotli',
+        'python-snappy',
+      ],
+    },
 )